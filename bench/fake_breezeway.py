@@ -0,0 +1,144 @@
+"""Stand-in for the Breezeway public API, for benchmarks and local testing.
+
+Serves the endpoints breezeway.AsyncApp uses from a generated dataset, with configurable latency and error rate:
+
+    python -m bench.fake_breezeway --port 8081 --units 10000 --people 1000 --latency 0.05 --error-rate 0.01
+
+then point the bot at it with `url: http://localhost:8081` in the breezeway config."""
+from typing import List
+import argparse
+import asyncio
+import base64
+import hashlib
+import itertools
+import json
+import random
+import time
+
+from aiohttp import web
+
+WORDS = ["Sea", "Breeze", "Villa", "Ocean", "Pine", "Casa", "Bay", "Cottage", "North", "Shore", "Palm", "Dune",
+         "Harbor", "Sunset", "Coral", "Lagoon", "Cove", "Marina", "Reef", "Tide"]
+FIRST_NAMES = ["Ana", "Ben", "Carla", "Dev", "Eli", "Fay", "Gus", "Hana", "Ivan", "Jo", "Kai", "Lena", "Mo", "Nia",
+               "Omar", "Pia", "Quinn", "Rosa", "Sam", "Tess"]
+LAST_NAMES = ["Alvarez", "Brooks", "Chen", "Diaz", "Evans", "Fox", "Garcia", "Hill", "Ito", "Jones", "Khan", "Lopez"]
+
+
+def make_units(count: int, seed: int = 1) -> List[dict]:
+    rng = random.Random(seed)
+    return [{"id": 100000 + i, "reference_property_id": f"P{i}", "company_id": 1, "status": "active",
+             "name": f"{rng.choice(WORDS)} {rng.choice(WORDS)} {rng.randint(1, 999)}",
+             "address1": f"{rng.randint(1, 9999)} {rng.choice(WORDS)} Rd", "city": "Gulf Shores", "state": "AL"}
+            for i in range(count)]
+
+
+def make_people(count: int, seed: int = 2) -> List[dict]:
+    rng = random.Random(seed)
+    return [{"id": 500000 + i, "first_name": rng.choice(FIRST_NAMES), "last_name": rng.choice(LAST_NAMES),
+             "active": True, "emails": [f"person{i}@example.com"]}
+            for i in range(count)]
+
+
+def make_token(lifetime: float) -> str:
+    def encode(data: dict) -> str:
+        return base64.urlsafe_b64encode(json.dumps(data).encode()).decode().rstrip("=")
+    return f"{encode({'alg': 'HS256', 'typ': 'JWT'})}.{encode({'exp': time.time() + lifetime})}.fake"
+
+
+class FakeBreezeway:
+
+    def __init__(self, units: int = 10000, people: int = 1000, latency: float = 0.05, jitter: float = 0.02,
+                 error_rate: float = 0.0, token_lifetime: float = 3600):
+        self.units = make_units(units)
+        self.people = make_people(people)
+        self.latency = latency
+        self.jitter = jitter
+        self.error_rate = error_rate
+        self.token_lifetime = token_lifetime
+        self.requests = {}
+        # (path, page): how many more times to answer that page with a 503
+        self.failing_pages = {}
+        self.__task_ids = itertools.count(1)
+        self.app = web.Application(middlewares=[self.__simulate])
+        self.app.router.add_post("/public/auth/v1/", self.auth)
+        self.app.router.add_post("/public/auth/v1/refresh", self.auth)
+        self.app.router.add_get("/public/inventory/v1/companies", self.companies)
+        self.app.router.add_get("/public/inventory/v1/property/external-id", self.units_handler)
+        self.app.router.add_get("/public/inventory/v1/people", self.people_handler)
+        self.app.router.add_post("/public/inventory/v1/task/", self.create_task)
+
+    @web.middleware
+    async def __simulate(self, request: web.Request, handler):
+        self.requests[request.path] = self.requests.get(request.path, 0) + 1
+        await asyncio.sleep(max(0.0, random.gauss(self.latency, self.jitter)))
+        if random.random() < self.error_rate:
+            return web.json_response({"message": "Simulated failure"}, status=503)
+        if not request.path.startswith("/public/auth/") and not request.headers.get("Authorization"):
+            return web.json_response({"message": "Unauthorized"}, status=401)
+        return await handler(request)
+
+    async def auth(self, request: web.Request):
+        return web.json_response({"access_token": make_token(self.token_lifetime),
+                                  "refresh_token": make_token(self.token_lifetime * 24)})
+
+    async def companies(self, request: web.Request):
+        return web.json_response([{"id": 1, "name": "PRVR"}])
+
+    def paginate(self, request: web.Request, records: List[dict]):
+        """The whole list, or with page and limit parameters, one page of it like Breezeway's paginated endpoints,
+        with an ETag"""
+        if "limit" not in request.query:
+            return web.json_response(records)
+        page, limit = int(request.query.get("page", 1)), int(request.query["limit"])
+        if self.failing_pages.get((request.path, page)):
+            self.failing_pages[(request.path, page)] -= 1
+            return web.json_response({"message": "Simulated failure"}, status=503)
+        body = json.dumps({"page": page, "limit": limit, "total_results": len(records),
+                           "total_pages": (len(records) + limit - 1) // limit,
+                           "results": records[(page - 1) * limit:page * limit]})
+        etag = f'"{hashlib.sha1(body.encode()).hexdigest()}"'
+        if request.headers.get("If-None-Match") == etag:
+            return web.Response(status=304, headers={"ETag": etag})
+        return web.Response(text=body, content_type="application/json", headers={"ETag": etag})
+
+    async def units_handler(self, request: web.Request):
+        return self.paginate(request, self.units)
+
+    async def people_handler(self, request: web.Request):
+        return self.paginate(request, self.people)
+
+    async def create_task(self, request: web.Request):
+        body = await request.json()
+        return web.json_response({"id": next(self.__task_ids), "name": body.get("name"),
+                                  "home_id": body.get("home_id")}, status=201)
+
+    async def start(self, host: str = "127.0.0.1", port: int = 0) -> str:
+        """Start serving and return the base URL"""
+        self.__runner = web.AppRunner(self.app, access_log=None)
+        await self.__runner.setup()
+        site = web.TCPSite(self.__runner, host, port)
+        await site.start()
+        return f"http://{host}:{self.__runner.addresses[0][1]}"
+
+    async def stop(self):
+        await self.__runner.cleanup()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8081)
+    parser.add_argument("--units", type=int, default=10000)
+    parser.add_argument("--people", type=int, default=1000)
+    parser.add_argument("--latency", type=float, default=0.05, help="mean response delay in seconds")
+    parser.add_argument("--jitter", type=float, default=0.02, help="standard deviation of the delay")
+    parser.add_argument("--error-rate", type=float, default=0.0, help="fraction of requests answered with a 503")
+    args = parser.parse_args()
+
+    fake = FakeBreezeway(units=args.units, people=args.people, latency=args.latency, jitter=args.jitter,
+                         error_rate=args.error_rate)
+    web.run_app(fake.app, host=args.host, port=args.port)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,46 @@
+"""Stand-in for the Slack Web API methods the bot calls, for benchmarks and local testing.
+
+Point the bot at it with `api-url: http://localhost:8082/api/` in the slack config."""
+import asyncio
+import itertools
+import random
+import time
+
+from aiohttp import web
+
+
+class FakeSlack:
+
+    def __init__(self, latency: float = 0.03, jitter: float = 0.01):
+        self.latency = latency
+        self.jitter = jitter
+        self.calls = {}
+        self.__ids = itertools.count(1)
+        self.app = web.Application()
+        self.app.router.add_post("/api/{method}", self.handle)
+
+    async def handle(self, request: web.Request):
+        method = request.match_info["method"]
+        self.calls[method] = self.calls.get(method, 0) + 1
+        await asyncio.sleep(max(0.0, random.gauss(self.latency, self.jitter)))
+
+        response = {"ok": True}
+        if method == "auth.test":
+            response |= {"url": "https://prvr.slack.com/", "team": "PRVR", "user": "prvrbot", "team_id": "T0001",
+                         "user_id": "U0BOT", "bot_id": "B0BOT"}
+        elif method in ("views.open", "views.update", "views.publish"):
+            view_id = f"V{next(self.__ids):08d}"
+            response["view"] = {"id": view_id, "hash": f"{time.time():.6f}.{view_id}"}
+        elif method in ("chat.postMessage", "chat.postEphemeral"):
+            response |= {"channel": "C0001", "ts": f"{time.time():.6f}", "message_ts": f"{time.time():.6f}"}
+        return web.json_response(response)
+
+    async def start(self, host: str = "127.0.0.1", port: int = 0) -> str:
+        """Start serving and return the API URL"""
+        self.__runner = web.AppRunner(self.app, access_log=None)
+        await self.__runner.setup()
+        await web.TCPSite(self.__runner, host, port).start()
+        return f"http://{host}:{self.__runner.addresses[0][1]}/api/"
+
+    async def stop(self):
+        await self.__runner.cleanup()
@@ -0,0 +1,96 @@
+"""Benchmark for message event dispatch under high-volume channel traffic.
+
+Replays a stream of message events through the Bolt app, mostly channel chatter with some DMs (commands and plain
+text), and reports dispatch throughput and latency per kind of message:
+
+    python -m bench.messages --messages 20000 --dm-ratio 0.05
+
+Only the time until Bolt has matched and started the listener counts, like the ack time in bench.run, plus the time
+until the listener finished. Logging is turned down to WARNING so the log handlers don't dominate."""
+import argparse
+import asyncio
+import copy
+import importlib
+import logging
+import os
+import random
+import tempfile
+import time
+
+from bench.fake_breezeway import FakeBreezeway
+from bench.fake_slack import FakeSlack
+from bench.run import _task_factory, dispatch, load_payload, percentile, write_config
+
+CHANNEL_TEXTS = ["Pool heater at Coral Cove 88 is showing an error code", "Who has the keys for Reef Tide 12?",
+                 "Guests checked out early at Sunset Palm 4", "Low battery on the front door lock at Dune Bay 301",
+                 "hello team, cleaners are running late today"]
+DM_TEXTS = {"dm_command": ["hi", "Hello there", "joke", "Joke", ":wave:"],
+            "dm_other": ["what's the wifi password at Sea Villa 3?", "thanks!", "jokes please"]}
+
+
+async def run(args):
+    asyncio.get_running_loop().set_task_factory(_task_factory)
+    fake_breezeway = FakeBreezeway(units=100, people=10, latency=0.001, jitter=0)
+    fake_slack = FakeSlack(latency=args.slack_latency, jitter=args.slack_latency / 3)
+    breezeway_url = await fake_breezeway.start()
+    slack_url = await fake_slack.start()
+
+    with tempfile.TemporaryDirectory() as directory:
+        os.environ["PRVRBOT_CONFIG"] = write_config(directory, breezeway_url, slack_url)
+        bot = importlib.import_module("main")
+        logging.getLogger().setLevel(logging.WARNING)
+        await bot.startup()
+
+        templates = {"channel": load_payload("message_channel"), "dm": load_payload("message_dm")}
+        rng = random.Random(5)
+        stream = []
+        for n in range(args.messages):
+            if rng.random() < args.dm_ratio:
+                kind = "dm_command" if rng.random() < 0.5 else "dm_other"
+                body = copy.deepcopy(templates["dm"])
+                body["event"]["text"] = rng.choice(DM_TEXTS[kind])
+            else:
+                kind = "channel"
+                body = copy.deepcopy(templates["channel"])
+                body["event"]["text"] = rng.choice(CHANNEL_TEXTS)
+            body["event_id"] = f"Ev{n:08d}"
+            stream.append((kind, body))
+
+        try:
+            slots = asyncio.Semaphore(args.concurrency)
+            results = {}
+
+            async def one(kind, body):
+                async with slots:
+                    ack, done = await dispatch(bot.slack, body)
+                acks, dones = results.setdefault(kind, ([], []))
+                acks.append(ack)
+                dones.append(done)
+
+            started = time.perf_counter()
+            await asyncio.gather(*(one(kind, body) for kind, body in stream))
+            elapsed = time.perf_counter() - started
+
+            print(f"{'messages':<12}{'count':>8}{'dispatch p50':>14}{'p99':>9}{'done p50':>10}{'p99':>9}")
+            for kind, (acks, dones) in sorted(results.items()):
+                print(f"{kind:<12}{len(acks):>8}{percentile(acks, 50) * 1000:>14.2f}{percentile(acks, 99) * 1000:>9.2f}"
+                      f"{percentile(dones, 50) * 1000:>10.2f}{percentile(dones, 99) * 1000:>9.2f}")
+            print(f"\n{args.messages / elapsed:.0f} messages/s")
+            print(f"Slack API calls: {fake_slack.calls}")
+        finally:
+            await bot.shutdown()
+            await fake_breezeway.stop()
+            await fake_slack.stop()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--messages", type=int, default=20000)
+    parser.add_argument("--dm-ratio", type=float, default=0.05, help="fraction of messages that are DMs")
+    parser.add_argument("--concurrency", type=int, default=50, help="messages in flight at once")
+    parser.add_argument("--slack-latency", type=float, default=0.03, help="mean Slack API response time")
+    asyncio.run(run(parser.parse_args()))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,200 @@
+"""End-to-end latency benchmark for the Slack handlers in main.py.
+
+Starts the fake Breezeway and Slack servers, loads main.py against them and replays the recorded Socket Mode payloads
+in bench/payloads through the Bolt app, as the Socket Mode handler would:
+
+    python -m bench.run --requests 200 --concurrency 10 --units 10000 --people 1000
+
+For every handler it reports the time until ack() (what Slack's 3 second deadline applies to) and until the listener
+finished, as p50/p95/p99 in milliseconds, plus throughput. Task submissions are only queued by their listener, so the
+time for the queue to drain is reported separately."""
+from typing import Callable, Dict, List
+import argparse
+import asyncio
+import contextvars
+import copy
+import importlib
+import itertools
+import json
+import logging
+import os
+import random
+import tempfile
+import time
+
+import yaml
+from slack_bolt.request.async_request import AsyncBoltRequest
+
+from bench.fake_breezeway import FakeBreezeway
+from bench.fake_slack import FakeSlack
+
+PAYLOADS = os.path.join(os.path.dirname(os.path.abspath(__file__)), "payloads")
+HANDLERS = ["shortcut", "options", "action", "view_submission", "message_dm", "message_channel", "app_home_opened"]
+
+# The first task created while dispatching a request is Bolt running the listener
+_listener = contextvars.ContextVar("listener", default=None)
+
+
+def _task_factory(loop, coro, **kwargs):
+    task = asyncio.Task(coro, loop=loop, **kwargs)
+    tracker = _listener.get()
+    if tracker is not None and not tracker:
+        tracker.append(task)
+    return task
+
+
+def percentile(values: List[float], p: float) -> float:
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(round(p / 100 * (len(ordered) - 1))))]
+
+
+def load_payload(name: str) -> dict:
+    with open(os.path.join(PAYLOADS, f"{name}.json")) as f:
+        return json.load(f)
+
+
+class Replayer:
+    """Builds a fresh variation of each recorded payload, so caches and de-duplication see realistic traffic"""
+
+    def __init__(self, units: List[dict], seed: int = 3):
+        self.__rng = random.Random(seed)
+        self.__units = units
+        self.__ids = itertools.count(1)
+        self.__templates = {name: load_payload(name) for name in HANDLERS}
+
+    def __unit(self) -> dict:
+        return self.__rng.choice(self.__units)
+
+    def make(self, name: str) -> dict:
+        body = copy.deepcopy(self.__templates[name])
+        n = next(self.__ids)
+        if "trigger_id" in body:
+            body["trigger_id"] = f"{n}.{n}.trigger"
+        if "event_id" in body:
+            body["event_id"] = f"Ev{n:08d}"
+            body["event"]["ts"] = body["event"]["event_ts"] = f"{time.time():.6f}"
+
+        if name == "shortcut":
+            unit = self.__unit()
+            body["message"]["text"] = f"The garbage disposal at {unit['name']} is jammed again, can someone look?"
+        elif name == "options":
+            name = self.__unit()["name"].lower()
+            body["value"] = name[:self.__rng.randint(3, len(name))]
+        elif name == "view_submission":
+            unit = self.__unit()
+            body["view"]["id"] = f"V{n:08d}"
+            body["view"]["state"]["values"]["unit_block"]["unit"]["selected_option"] = {
+                "text": {"type": "plain_text", "text": unit["name"], "emoji": True}, "value": str(unit["id"])}
+        return body
+
+
+async def dispatch(app, body: dict):
+    """Returns (seconds until ack, seconds until the listener finished)"""
+    tracker = []
+    token = _listener.set(tracker)
+    started = time.perf_counter()
+    try:
+        await app.async_dispatch(AsyncBoltRequest(body=body, mode="socket_mode"))
+    finally:
+        _listener.reset(token)
+    acked = time.perf_counter()
+    if tracker:
+        await asyncio.gather(*tracker, return_exceptions=True)
+    return acked - started, time.perf_counter() - started
+
+
+async def bench_handler(app, make: Callable[[], dict], requests: int, concurrency: int) -> Dict[str, float]:
+    slots = asyncio.Semaphore(concurrency)
+    acks, dones = [], []
+
+    async def one():
+        async with slots:
+            ack, done = await dispatch(app, make())
+        acks.append(ack)
+        dones.append(done)
+
+    started = time.perf_counter()
+    await asyncio.gather(*(one() for _ in range(requests)))
+    elapsed = time.perf_counter() - started
+    return {"ack_p50": percentile(acks, 50), "ack_p95": percentile(acks, 95), "ack_p99": percentile(acks, 99),
+            "done_p50": percentile(dones, 50), "done_p95": percentile(dones, 95), "done_p99": percentile(dones, 99),
+            "throughput": requests / elapsed}
+
+
+def write_config(directory: str, breezeway_url: str, slack_url: str, processes: int = 0, shared: bool = False) -> str:
+    config = {
+        "slack": {"app-token": "xapp-bench", "bot-token": "xoxb-bench", "api-url": slack_url,
+                  "welcome-module": {"enabled": False, "channel": "C0001"}},
+        "breezeway": {"enabled": True, "client-id": "bench", "client-secret": "bench", "url": breezeway_url,
+                      "company-id": 1, "snapshot": os.path.join(directory, "inventory.db"),
+                      "submission-queue": os.path.join(directory, "submissions.db")},
+        "executor": {"processes": processes}
+    }
+    if shared:
+        config["shared-state"] = {"backend": "sqlite", "path": os.path.join(directory, "shared.db")}
+    path = os.path.join(directory, "config.yml")
+    with open(path, "w") as f:
+        yaml.safe_dump(config, f)
+    return path
+
+
+async def run(args):
+    asyncio.get_running_loop().set_task_factory(_task_factory)
+    fake_breezeway = FakeBreezeway(units=args.units, people=args.people, latency=args.breezeway_latency,
+                                   jitter=args.breezeway_latency / 3, error_rate=args.error_rate)
+    fake_slack = FakeSlack(latency=args.slack_latency, jitter=args.slack_latency / 3)
+    breezeway_url = await fake_breezeway.start()
+    slack_url = await fake_slack.start()
+
+    with tempfile.TemporaryDirectory() as directory:
+        os.environ["PRVRBOT_CONFIG"] = write_config(directory, breezeway_url, slack_url, args.processes, args.shared)
+        bot = importlib.import_module("main")
+        logging.getLogger().setLevel(logging.WARNING)
+
+        await bot.startup()
+        try:
+            if not args.cold:
+                await asyncio.gather(*(tenant.breezeway.warm() for tenant in bot.tenants))
+            replayer = Replayer(fake_breezeway.units)
+
+            print(f"{'handler':<18}{'ack p50':>9}{'p95':>9}{'p99':>9}{'done p50':>10}{'p95':>9}{'p99':>9}"
+                  f"{'req/s':>9}")
+            for name in args.handlers:
+                result = await bench_handler(bot.slack, lambda: replayer.make(name), args.requests, args.concurrency)
+                print(f"{name:<18}" + "".join(f"{result[key] * 1000:>{10 if key == 'done_p50' else 9}.1f}"
+                                              for key in ("ack_p50", "ack_p95", "ack_p99",
+                                                          "done_p50", "done_p95", "done_p99"))
+                      + f"{result['throughput']:>9.1f}")
+
+                if name == "view_submission":
+                    started = time.perf_counter()
+                    while any(len(tenant.submissions) for tenant in bot.tenants):
+                        await asyncio.sleep(0.01)
+                    print(f"{'':<18}submission queue drained in {(time.perf_counter() - started) * 1000:.0f} ms")
+
+            print(f"\nBreezeway requests: {fake_breezeway.requests}")
+            print(f"Slack API calls: {fake_slack.calls}")
+        finally:
+            await bot.shutdown()
+            await fake_breezeway.stop()
+            await fake_slack.stop()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--requests", type=int, default=200, help="requests per handler")
+    parser.add_argument("--concurrency", type=int, default=10, help="requests in flight at once")
+    parser.add_argument("--handlers", nargs="+", default=HANDLERS, choices=HANDLERS)
+    parser.add_argument("--units", type=int, default=10000)
+    parser.add_argument("--people", type=int, default=1000)
+    parser.add_argument("--breezeway-latency", type=float, default=0.05, help="mean Breezeway response time")
+    parser.add_argument("--slack-latency", type=float, default=0.03, help="mean Slack API response time")
+    parser.add_argument("--error-rate", type=float, default=0.0, help="fraction of Breezeway requests that fail")
+    parser.add_argument("--processes", type=int, default=2, help="executor processes for unit matching")
+    parser.add_argument("--shared", action="store_true", help="use shared state, as when running several replicas")
+    parser.add_argument("--cold", action="store_true", help="don't load units and people before starting")
+    asyncio.run(run(parser.parse_args()))
+
+
+if __name__ == "__main__":
+    main()
@@ -1,27 +1,480 @@
-from typing import Optional, List
+from typing import AsyncIterator, Awaitable, Callable, Dict, Optional, List
+import asyncio
+import base64
+import inspect
 import json
 import logging
+from operator import attrgetter
 import re
+import time
 import aiohttp
+from multidict import CIMultiDict
+
+import metrics
+from cache import AsyncTTLCache
+from logs import Payload
+from executor import Executor
+from jobs import JobScheduler
+from matching import NEED_UNITS, UnitMatcher, match_in_process, update_in_process
+from outbound import BACKGROUND, CircuitBreaker, CircuitOpenError, FairShare, RequestScheduler, request_priority
+from records import Person, Unit
+from search import UnitIndex
+from shared import SQLiteSharedState, SharedState
+from sync import ConditionalPages, Delta, diff
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+
+REQUEST_SECONDS = metrics.histogram("breezeway_request_seconds",
+                                    "Breezeway API call latency, including queueing and retries",
+                                    ("method", "endpoint"))
+RESPONSES = metrics.counter("breezeway_responses_total", "Breezeway API calls by final status",
+                            ("method", "endpoint", "status"))
+REQUESTS_IN_FLIGHT = metrics.gauge("breezeway_requests_in_flight", "Breezeway API calls in progress")
+INVENTORY_CHANGES = metrics.counter("breezeway_inventory_changes_total", "Units and people added, updated and "
+                                    "removed, as found by syncs", ("resource", "change"))
+
+
+def loads(data):
+    """Decode JSON, with orjson when it is installed: several times faster on inventory-sized bodies"""
+    return orjson.loads(data) if orjson is not None else json.loads(data)
+
+
+def dumps(value) -> bytes:
+    """Compact JSON, as bytes"""
+    if orjson is not None:
+        return orjson.dumps(value)
+    return json.dumps(value, separators=(",", ":")).encode()
+
+
+# Errors meaning a request never reached Breezeway, so sending it again later can't create anything twice
+UNAVAILABLE = (CircuitOpenError, aiohttp.ClientConnectorError)
+
+
+class PageError(Exception):
+    """A page of a list endpoint could not be fetched"""
+
+    def __init__(self, status, body):
+        super().__init__(f"HTTP {status}")
+        self.status = status
+        self.body = body
+
+
+# Shortest time between background token renewals, should a token arrive already (nearly) expired
+MIN_RENEWAL_INTERVAL = 1
+
+
+def token_expiry(token: str) -> Optional[float]:
+    """Read the exp claim (epoch seconds) of a JWT without verifying it"""
+    try:
+        payload = token.split(".")[1]
+        return float(json.loads(base64.urlsafe_b64decode(payload + "=" * (-len(payload) % 4)))["exp"])
+    except (IndexError, KeyError, TypeError, ValueError):
+        return None
+
+
+def filter_units(units: List[Unit], regex_filter: str) -> List[Unit]:
+    """Units whose name matches regex_filter, ignoring case"""
+    pattern = re.compile(regex_filter.lower())
+    return [unit for unit in units if pattern.search(unit.lower)]
+
+
+class TokenManager:
+    """Keeps a valid access token around.
+
+    login() and refresh(refresh_token) are coroutines returning the auth response body, or None on failure. The token
+    is renewed in the background refresh_margin seconds before it expires, or halfway through its lifetime if that is
+    sooner, with the refresh token when there is one and a full login otherwise. Concurrent renewals (e.g. several
+    requests getting a 401 at once) share a single request.
+
+    With shared state, replicas share the token under shared_key: a renewal first looks for a newer token another
+    replica has saved, and only one replica at a time renews while the others wait for its result.
+
+    A renewal in the background that fails is tried again after retry_after seconds. So is getting the first token,
+    once one has been asked for, so a bot started while Breezeway is down logs in when it is back."""
+
+    def __init__(self, login: Callable[[], Awaitable[Optional[dict]]],
+                 refresh: Callable[[str], Awaitable[Optional[dict]]], refresh_margin: float = 300,
+                 default_lifetime: float = 3600, shared: Optional[SharedState] = None,
+                 shared_key: str = "breezeway", shared_wait: float = 10, retry_after: float = 60):
+        self.__login = login
+        self.__refresh = refresh
+        self.__refresh_margin = refresh_margin
+        self.__default_lifetime = default_lifetime
+        self.__access_token: Optional[str] = None
+        self.__refresh_token: Optional[str] = None
+        self.__expires_at: Optional[float] = None
+        self.__renew_at: Optional[float] = None
+        # How long tokens Breezeway hands out last, as of the last one requested
+        self.__lifetime = default_lifetime
+        self.__renewal: Optional[asyncio.Task] = None
+        # Set once a token has been asked for, so the refresh loop keeps trying to get one if that failed
+        self.__wanted = False
+        self.__changed = asyncio.Event()
+        self.__refresher: Optional[asyncio.Task] = None
+        self.__shared = shared
+        self.__shared_key = shared_key
+        self.__shared_wait = shared_wait
+        self.__retry_after = retry_after
+
+    @property
+    def access_token(self) -> Optional[str]:
+        return self.__access_token
+
+    def valid(self) -> bool:
+        return self.__access_token is not None and (self.__expires_at is None or time.time() < self.__expires_at)
+
+    def set(self, body: dict):
+        self.__access_token = body["access_token"]
+        self.__refresh_token = body.get("refresh_token") or self.__refresh_token
+        self.__expires_at = token_expiry(self.__access_token) or time.time() + self.__default_lifetime
+        self.__renew_at = max(self.__expires_at - self.__margin(), time.time() + MIN_RENEWAL_INTERVAL)
+        self.__changed.set()
+
+    def __margin(self) -> float:
+        # A token that lives no longer than refresh_margin would otherwise be due for renewal as soon as it arrives
+        return min(self.__refresh_margin, self.__lifetime / 2)
+
+    async def get(self) -> Optional[str]:
+        """The current access token, renewing it first if it has expired"""
+        if self.valid():
+            return self.__access_token
+        return await self.renew()
+
+    async def renew(self, rejected: Optional[str] = None, login: bool = False) -> Optional[str]:
+        """Get a new access token. If rejected is given and another caller has already replaced that token, the
+        replacement is returned without another request. login skips the refresh token."""
+        if rejected is not None and rejected != self.__access_token and self.valid():
+            return self.__access_token
+        if not self.__wanted:
+            self.__wanted = True
+            self.__changed.set()
+        if self.__renewal is None or self.__renewal.done():
+            self.__renewal = asyncio.create_task(self.__renew(login))
+        return await asyncio.shield(self.__renewal)
+
+    async def __renew(self, login: bool) -> Optional[str]:
+        if self.__shared is None:
+            return await self.__request_token(login)
+
+        replaced = self.__access_token
+        if await self.__adopt_shared(replaced):
+            return self.__access_token
+        lock = f"token-renewal:{self.__shared_key}"
+        deadline = time.monotonic() + self.__shared_wait
+        while not await self.__shared.claim(lock, ttl=self.__shared_wait):
+            # Another replica is renewing; use its token once it's saved, or renew here if it takes too long
+            if time.monotonic() > deadline:
+                break
+            await asyncio.sleep(0.25)
+            if await self.__adopt_shared(replaced):
+                return self.__access_token
+        try:
+            token = await self.__request_token(login)
+            if token is not None:
+                await self.__shared.put("tokens", self.__shared_key, json.dumps(
+                    {"access_token": self.__access_token, "refresh_token": self.__refresh_token}).encode())
+            return token
+        finally:
+            await self.__shared.release(lock)
+
+    async def __adopt_shared(self, replaced: Optional[str]) -> bool:
+        """Take the token other replicas saved, if it is valid and not the one being replaced"""
+        row = await self.__shared.get("tokens", self.__shared_key)
+        if row is None:
+            return False
+        body = json.loads(row[0])
+        expires_at = token_expiry(body["access_token"])
+        if body["access_token"] == replaced or (expires_at is not None and expires_at - self.__margin() < time.time()):
+            return False
+        self.set(body)
+        return True
+
+    async def __request_token(self, login: bool) -> Optional[str]:
+        body = None
+        if self.__refresh_token is not None and not login:
+            body = await self.__refresh(self.__refresh_token)
+        if body is None:
+            body = await self.__login()
+        if body is None:
+            return None
+        expires_at = token_expiry(body["access_token"])
+        self.__lifetime = max(0.0, expires_at - time.time()) if expires_at is not None else self.__default_lifetime
+        self.set(body)
+        return self.__access_token
+
+    def start(self):
+        if self.__refresher is None or self.__refresher.done():
+            self.__refresher = asyncio.create_task(self.__refresh_loop())
+
+    async def stop(self):
+        if self.__refresher is not None:
+            self.__refresher.cancel()
+            try:
+                await self.__refresher
+            except asyncio.CancelledError:
+                pass
+            self.__refresher = None
+
+    async def __refresh_loop(self):
+        request_priority.set(BACKGROUND)
+        while True:
+            self.__changed.clear()
+            if self.__renew_at is not None:
+                delay = self.__renew_at - time.time()
+            else:
+                # No token yet: once one is asked for, keep trying until there is one, in case the first attempt
+                # (e.g. at startup, with Breezeway down) fails
+                delay = 0 if self.__wanted else None
+            if delay is None or delay > 0:
+                try:
+                    await asyncio.wait_for(self.__changed.wait(), delay)
+                except asyncio.TimeoutError:
+                    pass
+                continue
+
+            logging.info("Refreshing Breezeway access token")
+            try:
+                renewed = await self.renew()
+            except Exception:
+                logging.exception("Failed to refresh Breezeway access token")
+                renewed = None
+            if renewed is None:
+                await asyncio.sleep(self.__retry_after)
 
 
 class AsyncApp:
 
     def __init__(self, client_id: str, client_secret: str, url: Optional[str] = "api.breezeway.io",
-                 company_id: Optional[int] = None):
+                 company_id: Optional[int] = None, connection_limit: int = 20, dns_cache_ttl: int = 300,
+                 keepalive_timeout: float = 30, timeout: float = 10, units_ttl: float = 300,
+                 people_ttl: float = 900, max_stale: float = 86400, scorer: str = "fuzzywuzzy",
+                 token_refresh_margin: float = 300, rate_limit: float = 10, rate_burst: int = 20,
+                 concurrency: int = 8, retries: int = 3, snapshot_path: Optional[str] = None,
+                 executor: Optional[Executor] = None, shared: Optional[SharedState] = None, page_size: int = 500,
+                 sync_interval: Optional[float] = None, breaker_threshold: int = 5, breaker_reset: float = 30,
+                 name: str = "Breezeway", share: Optional[FairShare] = None, jobs: Optional[JobScheduler] = None):
+        """With an executor, unit matching runs in its process pool, and building the unit index and regex filtering
+        in its thread pool. Without one they run on the event loop.
+
+        shared is state shared with other replicas of the bot. The inventory snapshot is kept there instead of in
+        snapshot_path, and replicas reuse each other's units and people and access token rather than each loading
+        their own.
+
+        List endpoints are read page_size records at a time.
+
+        With sync_interval, units and people are reloaded that often in the background, as a job of jobs. A reload
+        (sync()) only changes what differs from the cached lists: when few units changed the unit index and matchers
+        are updated rather than rebuilt, unchanged lists are kept as they are, and listeners added with on_change()
+        are told what changed. Pages are requested conditionally, so if Breezeway sends ETag or Last-Modified,
+        unchanged pages cost a 304.
+
+        After breaker_threshold failed requests in a row, breaker opens and requests fail with CircuitOpenError
+        without being sent, until a probe breaker_reset seconds later succeeds. Meanwhile units and people are
+        served from the cache however old.
+
+        name tells this client apart from others (one per tenant) in logs. With share, its requests also need a slot
+        of that limit shared with the other clients."""
         self.__client_id = client_id
         self.__client_secret = client_secret
         self.__url = url
-        self.__access_token = None
-        self.__refresh_token = None
-        self.company_id = company_id or self.get_companies()[0]["id"]
+        # url is normally just the host, but a full base URL (e.g. http://localhost:8080 for testing) works too
+        self.__base_url = url if "://" in url else f"https://{url}"
+        self.__tokens = TokenManager(self.__login, self.__refresh, refresh_margin=token_refresh_margin, shared=shared,
+                                     shared_key=f"breezeway:{client_id}")
+        self.__connection_limit = connection_limit
+        self.__dns_cache_ttl = dns_cache_ttl
+        self.__keepalive_timeout = keepalive_timeout
+        self.__timeout = timeout
+        self.__session: Optional[aiohttp.ClientSession] = None
+        self.__inflight: Dict[tuple, asyncio.Task] = {}
+        self.name = name
+        self.breaker = CircuitBreaker(name, failure_threshold=breaker_threshold, reset_timeout=breaker_reset)
+        self.scheduler = RequestScheduler(rate=rate_limit, burst=rate_burst, concurrency=concurrency, retries=retries,
+                                          breaker=self.breaker, share=share, share_key=name)
+        self.stats = {"requests": 0, "coalesced": 0}
+        self.company_id = company_id
+        self.__page_size = page_size
+        self.__sync_interval = sync_interval
+        self.__jobs = jobs
+        self.__sync_job = f"{name} sync"
+        self.__conditional = {"units": ConditionalPages(), "people": ConditionalPages()}
+        self.__listeners: List[Callable[[str, Delta], object]] = []
+        self.__owns_snapshot = shared is None and snapshot_path is not None
+        self.__snapshot = shared or (SQLiteSharedState(snapshot_path) if snapshot_path else None)
+        self.cache = AsyncTTLCache()
+        self.cache.register("units", self.__load_units, ttl=units_ttl, max_stale=max_stale,
+                            restore=lambda: self.__restore_snapshot("units", Unit), shared=shared is not None,
+                            adopt=lambda current, units: self.__changed("units", "properties", current, units))
+        self.cache.register("people", self.__load_people, ttl=people_ttl, max_stale=max_stale,
+                            restore=lambda: self.__restore_snapshot("people", Person), shared=shared is not None,
+                            adopt=lambda current, people: self.__changed("people", "people", current, people))
+        self.__scorer = scorer
+        self.__executor = executor
+        self.__unit_index = UnitIndex()
+        self.__unit_matcher = UnitMatcher(scorer=scorer)
+        self.__units_indexed = None
+        self.__units_by_id: Dict[object, Unit] = {}
+        self.__units_version = 0
+        self.__indexing: Optional[asyncio.Task] = None
+        self.__indexing_units = None
+
+    async def __aenter__(self):
+        await self.start()
+        return self
+
+    async def __aexit__(self, *exc):
+        await self.close()
+
+    async def start(self):
+        """Open the pooled session shared by every request. Connections are kept alive between calls."""
+        if self.__session is not None and not self.__session.closed:
+            return
+        connector = aiohttp.TCPConnector(limit=self.__connection_limit, limit_per_host=self.__connection_limit,
+                                         ttl_dns_cache=self.__dns_cache_ttl,
+                                         keepalive_timeout=self.__keepalive_timeout)
+        self.__session = aiohttp.ClientSession(connector=connector,
+                                               timeout=aiohttp.ClientTimeout(total=self.__timeout))
+        self.__tokens.start()
+        if self.__sync_interval and self.__jobs is not None:
+            self.__jobs.add(self.__sync_job, self.sync, self.__sync_interval, jitter=self.__sync_interval / 10)
+        logging.info("Breezeway session started")
+
+    async def close(self):
+        if self.__sync_interval and self.__jobs is not None:
+            self.__jobs.remove(self.__sync_job)
+        await self.__tokens.stop()
+        if self.__session is not None and not self.__session.closed:
+            await self.__session.close()
+            logging.info("Breezeway session closed")
+        self.__session = None
+        if self.__owns_snapshot:
+            await self.__snapshot.close()
+
+    async def warm(self):
+        """Load units and people into the cache, from the snapshot if there is one, refreshing them in the
+        background, and build the unit index and matchers"""
+        await asyncio.gather(self.cache.get("units"), self.cache.get("people"))
+        await self.__indexed_units()
+
+    async def __save_snapshot(self, resource: str, records: list):
+        if self.__snapshot is None:
+            return
+        compact = [record.to_json() for record in records]
+        try:
+            await self.__snapshot.put("inventory", f"{resource}:{self.company_id}", dumps(compact))
+        except Exception:
+            logging.exception(f"Failed to save {resource} snapshot")
+
+    async def __touch_snapshot(self, resource: str, records: list):
+        """Mark the snapshot as current after a reload found nothing changed, so other replicas keep using it"""
+        if self.__snapshot is None:
+            return
+        try:
+            if await self.__snapshot.touch("inventory", f"{resource}:{self.company_id}"):
+                return
+        except Exception:
+            logging.exception(f"Failed to update {resource} snapshot")
+            return
+        await self.__save_snapshot(resource, records)
+
+    async def __restore_snapshot(self, resource: str, record_type):
+        if self.__snapshot is None:
+            return None
+        row = await self.__snapshot.get("inventory", f"{resource}:{self.company_id}")
+        if row is None:
+            return None
+        value, saved_at = row
+        records = [record_type.from_json(record) for record in await asyncio.to_thread(loads, value)]
+        logging.info(f"Restored {len(records)} {resource} from snapshot saved at {time.ctime(saved_at)}")
+        return records, time.time() - saved_at
 
     def get_url(self):
         return self.__url
 
-    async def authenticate(self) -> bool:
+    async def __request(self, method: str, path: str, **kwargs):
+        """Send a request over the pooled session and return (status, decoded body).
+
+        Identical GETs (same path and params) already in flight are not sent again; callers share the first one's
+        response, so they must not modify the body they get back."""
+        if method != "GET":
+            self.stats["requests"] += 1
+            return await self.__authenticated_request(method, path, **kwargs)
+
+        key = (method, path, tuple(sorted((kwargs.get("params") or {}).items())))
+        request = self.__inflight.get(key)
+        if request is not None:
+            self.stats["coalesced"] += 1
+        else:
+            self.stats["requests"] += 1
+            request = asyncio.create_task(self.__authenticated_request(method, path, **kwargs))
+            self.__inflight[key] = request
+            request.add_done_callback(lambda _: self.__inflight.pop(key, None))
+        return await asyncio.shield(request)
+
+    async def __authenticated_request(self, method: str, path: str, authenticated: bool = True,
+                                      headers: Optional[dict] = None, **kwargs):
+        """Authenticated requests carry the current access token. If it is rejected with a 401 the token is renewed
+        and the request retried once."""
+        headers = dict(headers or {})
+        if not authenticated:
+            return await self.__send(method, path, headers=headers, **kwargs)
+
+        token = await self.__tokens.get()
+        headers["Authorization"] = f"JWT {token}"
+        status, body = await self.__send(method, path, headers=headers, **kwargs)
+        if status == 401:
+            logging.info("Access token rejected, re-authenticating")
+            token = await self.__tokens.renew(rejected=token)
+            if token is not None:
+                headers["Authorization"] = f"JWT {token}"
+                status, body = await self.__send(method, path, headers=headers, **kwargs)
+        return status, body
+
+    async def __send(self, method: str, path: str, response_headers: Optional[CIMultiDict] = None, **kwargs):
+        """Send through the scheduler. Only GETs are retried on server errors, since a POST may have gone through.
+
+        response_headers, if given, receives the headers of the final response."""
+        if self.__session is None or self.__session.closed:
+            await self.start()
+        url = f"{self.__base_url}{path}"
+
+        async def attempt():
+            async with self.__session.request(method, url, **kwargs) as response:
+                data = await response.read()
+                if response_headers is not None:
+                    response_headers.clear()
+                    response_headers.extend(response.headers)
+            try:
+                body = loads(data) if data else None
+            except ValueError:
+                body = data.decode(errors="replace")
+            return response.status, body, response.headers
+
+        REQUESTS_IN_FLIGHT.inc()
+        started = time.perf_counter()
+        status = "error"
+        try:
+            if method == "GET":
+                status, body = await self.scheduler.run(attempt)
+            else:
+                status, body = await self.scheduler.run(attempt, retry_statuses={429}, retry_errors=False)
+            return status, body
+        except CircuitOpenError:
+            status = "circuit-open"
+            raise
+        finally:
+            elapsed = time.perf_counter() - started
+            REQUESTS_IN_FLIGHT.dec()
+            REQUEST_SECONDS.observe(elapsed, method=method, endpoint=path)
+            RESPONSES.inc(method=method, endpoint=path, status=status)
+            metrics.log_if_slow(f"Breezeway {method} {path}", elapsed)
+
+    async def __login(self) -> Optional[dict]:
         logging.info("Authenticating")
-        url = f"https://{self.__url}/public/auth/v1/"
 
         payload = json.dumps({
             "client_id": self.__client_id,
@@ -31,92 +484,311 @@ class AsyncApp:
             'Content-Type': 'application/json'
         }
 
-        async with aiohttp.ClientSession() as session:
-            async with session.post(url, headers=headers, data=payload) as response:
-                body = await response.json()
+        status, body = await self.__request("POST", "/public/auth/v1/", authenticated=False, headers=headers,
+                                            data=payload)
 
-        if self.company_id is None:
-            self.company_id = await self.get_companies()[0]["id"]
-
-        if response.status == 200:
-            logging.debug(f"Authentication successful, received data:\n {body}")
-            self.__access_token = body["access_token"]
-            self.__refresh_token = body["refresh_token"]
+        if status == 200:
+            logging.debug("Authentication successful, received data:\n %s", Payload(body))
+            return body
         else:
-            logging.error(f"Authentication failed, received data:\n {body}")
+            logging.error("Authentication failed, received data:\n %s", Payload(body))
 
-            return response.status == 200
-
-    async def get_companies(self):
-        logging.info("Getting companies")
-        url = f"https://{self.__url}/public/inventory/v1/companies"
+    async def __refresh(self, refresh_token: str) -> Optional[dict]:
+        logging.info("Refreshing access token")
 
         headers = {
-            "Authorization": f"JWT {self.__access_token}",
-            "Content-Type": "application/json"
+            'Authorization': f"JWT {refresh_token}",
+            'Content-Type': 'application/json'
         }
 
-        async with aiohttp.ClientSession() as session:
-            async with session.get(url, headers=headers) as response:
-                body = await response.json()
+        status, body = await self.__request("POST", "/public/auth/v1/refresh", authenticated=False, headers=headers)
 
-        if response.status == 200:
-            logging.debug(f"Successfully got companies. received data:\n {body}")
+        if status == 200:
+            logging.debug("Token refresh successful, received data:\n %s", Payload(body))
             return body
         else:
-            logging.error(f"Failed to get companies, received data:\n {body}")
+            logging.warning("Token refresh failed, received data:\n %s", Payload(body))
 
-    async def get_units(self, regex_filter=None):
-        logging.info("Getting properties")
-        url = f"https://{self.__url}/public/inventory/v1/property/external-id?reference_company_id={self.company_id}"
+    async def authenticate(self) -> bool:
+        """Log in with the client credentials. Later token renewals happen automatically."""
+        token = await self.__tokens.renew(login=True)
 
-        headers = {
-            'Authorization': f'JWT {self.__access_token}'
-        }
+        if token is not None and self.company_id is None:
+            companies = await self.get_companies()
+            if companies:
+                self.company_id = companies[0]["id"]
+
+        return token is not None
+
+    async def __pages(self, path: str, params: Optional[dict] = None,
+                      conditional: Optional[ConditionalPages] = None) -> AsyncIterator[list]:
+        """Yield the records of a list endpoint a page at a time.
+
+        Paginated endpoints answer {"results": [...], "total_pages": n}. Those that answer with a plain list send
+        everything at once, as a single page. Raises PageError if a page can't be fetched.
+
+        With conditional, pages are requested with the validators of the previous time and a 304 stands for the
+        page seen then."""
+        if conditional is not None:
+            conditional.begin()
+        headers = {"Content-Type": "application/json"}
+        page = 1
+        while True:
+            page_params = {**(params or {}), "page": page, "limit": self.__page_size}
+            if conditional is None:
+                status, body = await self.__request("GET", path, headers=headers, params=page_params)
+            else:
+                # Not coalesced: the answer depends on what this caller saw before
+                self.stats["requests"] += 1
+                response_headers = CIMultiDict()
+                status, body = await self.__authenticated_request("GET", path, params=page_params,
+                                                                  headers={**headers, **conditional.headers(page)},
+                                                                  response_headers=response_headers)
+                if status in (200, 304):
+                    body = conditional.update(page, status, response_headers, body)
+                    status = 200 if body is not None else status
+            if status != 200:
+                raise PageError(status, body)
+            logging.debug("Got page %d of %s, received data:\n %s", page, path, Payload(body))
+            if isinstance(body, list):
+                yield body
+                break
+            results = body.get("results") or []
+            yield results
+            if not results or page >= body.get("total_pages", page):
+                break
+            page += 1
+        if conditional is not None:
+            conditional.finish(page)
 
-        async with aiohttp.ClientSession() as session:
-            async with session.get(url, headers=headers) as response:
-                body = await response.json()
+    async def __records(self, record_type, path: str, params: Optional[dict] = None,
+                        conditional: Optional[ConditionalPages] = None):
+        async for page in self.__pages(path, params, conditional):
+            yield [record_type.from_json(record) for record in page]
 
-        if response.status == 200:
+    async def __collect(self, what: str, pages: AsyncIterator[list]) -> Optional[list]:
+        """All records from pages, or None if any page failed"""
+        records = []
+        try:
+            async for page in pages:
+                records.extend(page)
+        except PageError as e:
+            logging.error("Failed to get %s, received data:\n %s", what, Payload(e.body))
+            return None
+        except CircuitOpenError as e:
+            logging.warning(f"Not getting {what}: {e}")
+            return None
+        logging.info(f"Got {len(records)} {what}")
+        return records
+
+    async def get_companies(self):
+        logging.info("Getting companies")
+        return await self.__collect("companies", self.__pages("/public/inventory/v1/companies"))
+
+    def __unit_records(self, conditional: Optional[ConditionalPages] = None) -> AsyncIterator[List[Unit]]:
+        return self.__records(Unit, "/public/inventory/v1/property/external-id",
+                              params={"reference_company_id": self.company_id}, conditional=conditional)
+
+    def __people_records(self, conditional: Optional[ConditionalPages] = None) -> AsyncIterator[List[Person]]:
+        return self.__records(Person, "/public/inventory/v1/people", params={"status": "active"},
+                              conditional=conditional)
+
+    async def iter_units(self, regex_filter=None) -> AsyncIterator[List[Unit]]:
+        """Units page by page as they arrive from Breezeway, each page filtered by regex_filter"""
+        async for units in self.__unit_records():
             if regex_filter:
-                regex_filter = regex_filter.lower()
-                units = list(body)
-                body = []
-                for unit in units:
-                    if re.search(regex_filter, unit["name"].lower()):
-                        body.append(unit)
-            logging.debug(f"Successfully got properties. received data:\n {body}")
-            return body
-        else:
-            logging.error(f"Failed to get properties, received data:\n {body}")
+                units = await self.__run_blocking(filter_units, units, regex_filter)
+            yield units
+
+    async def get_units(self, regex_filter=None) -> Optional[List[Unit]]:
+        logging.info("Getting properties")
+        return await self.__collect("properties", self.iter_units(regex_filter))
+
+    async def __load_units(self):
+        logging.info("Getting properties")
+        return await self.__sync("units", "properties", self.__unit_records(self.__conditional["units"]))
 
     async def get_units_sorted(self, regex_filter=None):
-        units = await self.get_units(regex_filter)
-        return sorted(units, key=lambda k: k["name"])
+        """Units sorted by name, served from the cache. Empty if they could not be loaded."""
+        units = await self.cache.get("units") or []
+        if regex_filter:
+            units = await self.__run_blocking(filter_units, units, regex_filter)
+        return units
+
+    def iter_people(self) -> AsyncIterator[List[Person]]:
+        """Active people page by page as they arrive from Breezeway"""
+        return self.__people_records()
 
-    async def get_people(self):
+    async def get_people(self) -> Optional[List[Person]]:
         logging.info("Getting people")
-        url = f"https://{self.__url}/public/inventory/v1/people?status=active"
+        return await self.__collect("people", self.iter_people())
 
-        headers = {
-            'Authorization': f'JWT {self.__access_token}',
-            'Content-Type': 'application/json'
-        }
+    async def __run_blocking(self, fn, *args):
+        if self.__executor is None:
+            return fn(*args)
+        return await self.__executor.run_blocking(fn, *args)
 
-        async with aiohttp.ClientSession() as session:
-            async with session.get(url, headers=headers) as response:
-                body = await response.json()
+    async def __indexed_units(self) -> bool:
+        """Rebuild the unit search index and matcher whenever the cached units change"""
+        units = await self.cache.get("units")
+        if units is None:
+            return False
+        if units is not self.__units_indexed:
+            if self.__indexing is None or self.__indexing_units is not units:
+                self.__indexing_units = units
+                self.__indexing = asyncio.create_task(self.__build_indexes(units))
+            await asyncio.shield(self.__indexing)
+        return True
 
-        if response.status == 200:
-            logging.debug(f"Successfully got people. received data:\n {body}")
-            return body
-        else:
-            logging.error(f"Failed to get people, received data:\n {body}")
+    async def __build_indexes(self, units: List[Unit]):
+        try:
+            index = await self.__run_blocking(UnitIndex, units)
+            # Pool processes build their own matchers
+            remote = self.__executor is not None and self.__executor.processes > 0
+            matcher = None if remote else await self.__run_blocking(UnitMatcher, units, self.__scorer)
+            if self.__indexing_units is not units:
+                return
+            version = self.__units_version + 1
+            if remote:
+                # Have every pool process build its matcher now rather than on the first few matches
+                pairs = [(unit.id, unit.name) for unit in units]
+                await asyncio.gather(*(self.__executor.run_cpu(match_in_process, self.__matcher_key(version), "", 0,
+                                                               self.__scorer, pairs)
+                                       for _ in range(self.__executor.processes)))
+        except BaseException:
+            # Let the next search or match build again, rather than fail on this build for as long as units don't change
+            if self.__indexing_units is units:
+                self.__indexing = self.__indexing_units = None
+            raise
+        self.__unit_index, self.__unit_matcher, self.__units_indexed = index, matcher, units
+        self.__units_by_id = {unit.id: unit for unit in units}
+        self.__units_version = version
+
+    def __matcher_key(self, version: int) -> str:
+        # Pool processes are shared by every client, so keys name the Breezeway account and company too
+        return f"{self.__client_id}:{self.company_id}:{version}"
+
+    async def search_units(self, query: str, limit: int = 100):
+        """Type-ahead search over unit names. query is matched as plain text, not as a regex"""
+        if not await self.__indexed_units():
+            return []
+        return self.__unit_index.search(query, limit)
+
+    async def match_unit(self, text: str, threshold: float = 0):
+        """Return (unit, score) for the unit text most likely refers to, if it scores more than threshold"""
+        if not await self.__indexed_units():
+            return None
+        if self.__unit_matcher is not None:
+            return self.__unit_matcher.match(text, threshold)
+
+        units, units_by_id = self.__units_indexed, self.__units_by_id
+        key = self.__matcher_key(self.__units_version)
+        found = await self.__executor.run_cpu(match_in_process, key, text, threshold, self.__scorer)
+        if found == NEED_UNITS:
+            found = await self.__executor.run_cpu(match_in_process, key, text, threshold, self.__scorer,
+                                                  [(unit.id, unit.name) for unit in units])
+        if found is None:
+            return None
+        unit_id, score = found
+        return units_by_id[unit_id], score
+
+    async def __load_people(self):
+        logging.info("Getting people")
+        return await self.__sync("people", "people", self.__people_records(self.__conditional["people"]))
+
+    async def __sync(self, resource: str, what: str, records: AsyncIterator[list]):
+        """Load resource ("units" or "people") for the cache. When it was loaded before and nothing changed, the
+        cached list itself is returned; otherwise what changed is applied to the indexes and announced."""
+        fresh = await self.__collect(what, records)
+        if fresh is None:
+            return None
+        current = self.cache.peek(resource)
+        if current is not None and not self.__conditional[resource].modified:
+            logging.info(f"{what.capitalize()} not modified")
+            await self.__touch_snapshot(resource, current)
+            return current
+        fresh.sort(key=attrgetter("sort_key"))
+        if current is not None:
+            fresh = await self.__changed(resource, what, current, fresh)
+            if fresh is current:
+                await self.__touch_snapshot(resource, current)
+                return current
+        await self.__save_snapshot(resource, fresh)
+        return fresh
+
+    async def __changed(self, resource: str, what: str, current: list, fresh: list) -> list:
+        """Compare fresh, loaded or saved by another replica, with the cached list. current is returned if nothing
+        changed; otherwise what changed is applied to the indexes and announced, and fresh is returned."""
+        delta = await self.__run_blocking(diff, current, fresh)
+        if not delta:
+            return current
+        logging.info(f"{what.capitalize()} changed: {delta}")
+        if resource == "units":
+            await self.__apply_unit_delta(current, fresh, delta)
+        await self.__announce(resource, delta)
+        return fresh
+
+    async def __apply_unit_delta(self, current: List[Unit], units: List[Unit], delta: Delta):
+        """Update the unit index and matchers built for current so they match units. Left to a rebuild if they
+        aren't built for current, or if more than a few percent changed, as rebuilding is quicker then.
+
+        The new index and id lookup are built as copies in a thread and swapped in, so searches and matches that
+        started on the old ones can finish with them."""
+        if self.__units_indexed is not current or len(delta) > len(units) // 20:
+            return
+        changed = delta.added + delta.updated
+        removed_ids = [unit.id for unit in delta.removed]
+        version = self.__units_version + 1
+        index = await self.__run_blocking(self.__unit_index.updated, changed, removed_ids)
+        if self.__unit_matcher is None:
+            pairs = [(unit.id, unit.name) for unit in changed]
+            # Processes without the current matcher build the new one when they are first asked to match
+            await asyncio.gather(*(self.__executor.run_cpu(update_in_process, self.__matcher_key(version - 1),
+                                                           self.__matcher_key(version), pairs, removed_ids)
+                                   for _ in range(self.__executor.processes)))
+        if self.__units_indexed is not current:
+            return
+        if self.__unit_matcher is not None:
+            for unit_id in removed_ids:
+                self.__unit_matcher.remove(unit_id)
+            for unit in changed:
+                self.__unit_matcher.add(unit)
+        self.__unit_index = index
+        self.__units_by_id = {unit.id: unit for unit in units}
+        self.__units_indexed = self.__indexing_units = units
+        self.__units_version = version
+
+    def on_change(self, listener: Callable[[str, Delta], object]):
+        """Call listener(resource, delta) whenever a reload finds units or people changed. It may be a coroutine
+        function."""
+        self.__listeners.append(listener)
+        return listener
+
+    async def __announce(self, resource: str, delta: Delta):
+        for change in ("added", "updated", "removed"):
+            if getattr(delta, change):
+                INVENTORY_CHANGES.inc(len(getattr(delta, change)), resource=resource, change=change)
+        for listener in self.__listeners:
+            try:
+                result = listener(resource, delta)
+                if inspect.isawaitable(result):
+                    await result
+            except Exception:
+                logging.exception(f"Inventory change listener failed for {resource}")
+
+    async def sync(self):
+        """Reload units and people now, ahead of their TTL, so readers don't wait for them"""
+        for resource in ("units", "people"):
+            await self.cache.refresh(resource)
+        await self.__indexed_units()
 
     async def get_people_sorted(self):
-        people = await self.get_people()
-        return sorted(people, key=lambda k: k["first_name"])
+        """Active people sorted by first name, served from the cache. Empty if they could not be loaded."""
+        return await self.cache.get("people") or []
+
+    def invalidate(self, resource: Optional[str] = None):
+        """Drop cached units and/or people ("units", "people" or None for both) so the next read reloads them"""
+        self.cache.invalidate(resource)
 
     async def create_project(
             self, unit_id: int | str, department: str, priority: str = "normal", title: str = None,
@@ -126,7 +798,6 @@ class AsyncApp:
         """department: (housekeeping, inspection, or maintenance)
         priority: (urgent, high, normal, low, or watch)"""
         logging.info("Creating project")
-        url = f"https://{self.__url}/public/inventory/v1/task/"
 
         payload = json.dumps({
             "home_id": f"{unit_id}",
@@ -141,17 +812,45 @@ class AsyncApp:
             "tags": tag_ids
         })
         headers = {
-            'Authorization': f"JWT {self.__access_token}",
             'Content-Type': 'application/json'
         }
 
-        async with aiohttp.ClientSession() as session:
-            async with session.post(url, headers=headers, data=payload) as response:
-                body = await response.json()
+        status, body = await self.__request("POST", "/public/inventory/v1/task/", headers=headers, data=payload)
 
-        if response.status == 201:
-            logging.info(f"Successfully created task. received data:\n {body}")
+        if status == 201:
+            logging.info("Successfully created task. received data:\n %s", Payload(body))
         else:
-            logging.error(f"Failed to create task, received data:\n {body}")
+            logging.error("Failed to create task, received data:\n %s", Payload(body))
 
         return body
+
+    async def create_projects_bulk(
+            self, unit_ids: List[int | str], concurrency: int = 5,
+            on_result: Optional[Callable[[int | str, dict], Awaitable[None]]] = None, **kwargs):
+        """Create the same project for every unit, at most concurrency at a time. kwargs are passed on to
+        create_project. Returns (created, failed), each a dict of unit id to the response body (or error) for
+        that unit. on_result(unit_id, body) is awaited as each unit finishes. Units whose request couldn't be sent
+        because Breezeway is unavailable (see UNAVAILABLE) are in neither, and can be retried later."""
+        logging.info(f"Creating project for {len(unit_ids)} units")
+        slots = asyncio.Semaphore(concurrency)
+        created, failed = {}, {}
+
+        async def create(unit_id):
+            async with slots:
+                try:
+                    body = await self.create_project(unit_id=unit_id, **kwargs)
+                except UNAVAILABLE as e:
+                    logging.warning(f"Not creating task for unit {unit_id} now: {e!r}")
+                    return
+                except Exception as e:
+                    logging.error(f"Failed to create task for unit {unit_id}: {e!r}")
+                    body = {"error": repr(e)}
+            if not isinstance(body, dict):
+                body = {"error": body}
+            (created if "id" in body else failed)[unit_id] = body
+            if on_result is not None:
+                await on_result(unit_id, body)
+
+        await asyncio.gather(*(create(unit_id) for unit_id in unit_ids))
+        logging.info(f"Created {len(created)} projects, {len(failed)} failed")
+        return created, failed
@@ -0,0 +1,140 @@
+from typing import Any, Awaitable, Callable, Dict, Optional, Tuple, Union
+import asyncio
+import logging
+import time
+
+from outbound import BACKGROUND, request_priority
+
+
+class _Entry:
+    __slots__ = ("loader", "ttl", "max_stale", "restore", "reload", "adopt", "value", "fetched_at", "refresh")
+
+    def __init__(self, loader: Callable[[], Awaitable[Any]], ttl: float, max_stale: float,
+                 restore: Optional[Callable[[], Awaitable[Optional[Tuple[Any, float]]]]], shared: bool,
+                 adopt: Optional[Callable[[Any, Any], Awaitable[Any]]]):
+        self.loader = loader
+        self.ttl = ttl
+        self.max_stale = max_stale
+        self.restore: Optional[Union[Callable, asyncio.Task]] = restore
+        self.reload = restore if shared else None
+        self.adopt = adopt
+        self.value = None
+        self.fetched_at: Optional[float] = None
+        self.refresh: Optional[asyncio.Task] = None
+
+
+class AsyncTTLCache:
+    """Cache for named resources, each with its own loader and TTL.
+
+    A fresh entry is returned as is. An entry past its TTL but within max_stale is still returned, and a
+    background refresh is started so the next caller gets new data. Anything older is loaded before returning.
+    Concurrent loads of the same resource share one task."""
+
+    def __init__(self):
+        self.__entries: Dict[str, _Entry] = {}
+        self.stats = {"hits": 0, "stale_hits": 0, "misses": 0, "refresh_errors": 0}
+
+    def register(self, key: str, loader: Callable[[], Awaitable[Any]], ttl: float, max_stale: float = 0,
+                 restore: Optional[Callable[[], Awaitable[Optional[Tuple[Any, float]]]]] = None, shared: bool = False,
+                 adopt: Optional[Callable[[Any, Any], Awaitable[Any]]] = None):
+        """loader returns the new value, or None if it could not be loaded.
+
+        restore, if given, is awaited once before the first load and returns a previously saved (value, age in
+        seconds), or None. The restored value is then treated like one loaded age seconds ago. With shared, restore
+        reads a copy other processes save as well, so it is tried before every load and its value used if it is
+        younger than ttl. adopt(cached, value), if given, is awaited with a value about to be used that way and
+        returns what to cache instead, so the owner can compare it with what it has, as it would a loaded one."""
+        self.__entries[key] = _Entry(loader, ttl, max_stale, restore, shared, adopt)
+
+    async def get(self, key: str):
+        entry = self.__entries[key]
+        if entry.restore is not None:
+            await self.__restore(key, entry)
+        if entry.fetched_at is not None:
+            age = time.monotonic() - entry.fetched_at
+            if age < entry.ttl:
+                self.stats["hits"] += 1
+                return entry.value
+            if age < entry.ttl + entry.max_stale:
+                self.stats["stale_hits"] += 1
+                self.__refresh(key, entry, background=True)
+                return entry.value
+
+        self.stats["misses"] += 1
+        return await asyncio.shield(self.__refresh(key, entry))
+
+    async def refresh(self, key: str):
+        """Load key now whatever its age, at background priority, and return the new value"""
+        entry = self.__entries[key]
+        if entry.restore is not None:
+            await self.__restore(key, entry)
+        return await asyncio.shield(self.__refresh(key, entry, background=True))
+
+    def peek(self, key: str):
+        """Return whatever is cached, however old, without loading"""
+        return self.__entries[key].value
+
+    def set(self, key: str, value, age: float = 0):
+        entry = self.__entries[key]
+        entry.value = value
+        entry.fetched_at = time.monotonic() - age
+
+    def invalidate(self, key: Optional[str] = None):
+        """Force the next get() to load. Cached values are kept so a failed load can still fall back to them."""
+        for k, entry in self.__entries.items():
+            if key is None or k == key:
+                entry.fetched_at = None
+
+    async def __restore(self, key: str, entry: _Entry):
+        if not isinstance(entry.restore, asyncio.Task):
+            entry.restore = asyncio.create_task(self.__run_restore(key, entry, entry.restore))
+        await asyncio.shield(entry.restore)
+
+    async def __run_restore(self, key: str, entry: _Entry, restore):
+        try:
+            restored = await restore()
+        except Exception:
+            logging.exception(f"Failed to restore {key}")
+            restored = None
+        if restored is not None and entry.fetched_at is None:
+            value, age = restored
+            self.set(key, value, age)
+        entry.restore = None
+
+    def __refresh(self, key: str, entry: _Entry, background: bool = False) -> asyncio.Task:
+        if entry.refresh is None or entry.refresh.done():
+            entry.refresh = asyncio.create_task(self.__load(key, entry, background))
+        return entry.refresh
+
+    async def __load(self, key: str, entry: _Entry, background: bool):
+        if background:
+            # Nobody is waiting on this one, let interactive requests go first
+            request_priority.set(BACKGROUND)
+        if entry.reload is not None:
+            try:
+                restored = await entry.reload()
+            except Exception:
+                logging.exception(f"Failed to read shared {key}")
+                restored = None
+            if restored is not None and restored[1] < entry.ttl:
+                value, age = restored
+                if entry.adopt is not None and entry.value is not None:
+                    value = await entry.adopt(entry.value, value)
+                self.set(key, value, age)
+                return value
+
+        try:
+            value = await entry.loader()
+        except Exception:
+            logging.exception(f"Failed to refresh {key}")
+            value = None
+
+        if value is None:
+            self.stats["refresh_errors"] += 1
+            if entry.value is not None:
+                logging.warning(f"Serving stale {key}")
+            return entry.value
+
+        entry.value = value
+        entry.fetched_at = time.monotonic()
+        return value
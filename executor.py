@@ -0,0 +1,151 @@
+from concurrent.futures import Executor as _PoolExecutor, ProcessPoolExecutor, ThreadPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from typing import Callable, Optional, Set, TypeVar
+import asyncio
+import functools
+import logging
+import multiprocessing
+import time
+
+import metrics
+
+T = TypeVar("T")
+
+# Modules pool processes import up front, so their first task doesn't pay for it
+PROCESS_PRELOAD = ["matching", "records"]
+
+POOL_SECONDS = metrics.histogram("prvrbot_executor_seconds",
+                                 "Time calls spent in the executor pools, queueing included", ("pool",))
+LOOP_LAG = metrics.histogram("prvrbot_event_loop_lag_seconds", "How late the event loop woke up a sleeping task",
+                             buckets=(0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5))
+
+
+def _ready():
+    return True
+
+
+def _send_result(connection, fn, args):
+    try:
+        result = (True, fn(*args))
+    except Exception as e:
+        result = (False, e)
+    connection.send(result)
+    connection.close()
+
+
+class Executor:
+    """Runs work that would otherwise hold up the event loop.
+
+    run_blocking() is for calls that wait on something (files, libraries without async APIs) and runs them in a
+    thread pool. run_cpu() is for pure computation and runs it in a process pool, so it doesn't compete with the
+    event loop for the GIL; its function, arguments and result must be picklable. With processes=0 CPU-heavy calls
+    go to the thread pool too. Pool processes are started by a fork server that imports PROCESS_PRELOAD. Each also
+    imports the script the bot was started from, which is why prvrbot.py does nothing when imported. run_isolated()
+    is for calls that may not finish, and runs each in a process of its own that is killed when it takes too long."""
+
+    def __init__(self, threads: int = 4, processes: int = 0):
+        self.processes = processes
+        self.__threads = ThreadPoolExecutor(max_workers=threads, thread_name_prefix="blocking")
+        self.__processes: Optional[ProcessPoolExecutor] = None
+        self.__context = multiprocessing.get_context("forkserver")
+        self.__context.set_forkserver_preload(PROCESS_PRELOAD)
+        if processes > 0:
+            self.__processes = ProcessPoolExecutor(max_workers=processes, mp_context=self.__context)
+
+    async def start(self):
+        """Start the pool processes now rather than on the first call"""
+        if self.__processes is not None:
+            await asyncio.gather(*(self.run_cpu(_ready) for _ in range(self.processes)))
+
+    def shutdown(self):
+        self.__threads.shutdown(wait=False, cancel_futures=True)
+        if self.__processes is not None:
+            self.__processes.shutdown(wait=False, cancel_futures=True)
+
+    async def run_isolated(self, fn: Callable[..., T], *args, timeout: float) -> T:
+        """Run fn(*args) in a new process, killing it and raising asyncio.TimeoutError if it takes longer than timeout
+        seconds. For calls that can hang without releasing the GIL, like a regular expression from a user, which
+        would hold up the event loop even in a thread. Starting the process takes a few hundred milliseconds at worst.
+        fn, args and the result must be picklable."""
+        started = time.perf_counter()
+        receiver, sender = self.__context.Pipe(duplex=False)
+        process = self.__context.Process(target=_send_result, args=(sender, fn, args), daemon=True)
+        try:
+            await self.run_blocking(process.start)
+            sender.close()
+            if not await self.run_blocking(receiver.poll, timeout):
+                raise asyncio.TimeoutError()
+            try:
+                succeeded, result = await self.run_blocking(receiver.recv)
+            except EOFError:
+                raise ChildProcessError(f"{fn.__name__} exited without a result") from None
+        finally:
+            sender.close()
+            receiver.close()
+            if process.is_alive():
+                process.kill()
+            if process.pid is not None:
+                await self.run_blocking(process.join)
+            POOL_SECONDS.observe(time.perf_counter() - started, pool="isolated")
+        if not succeeded:
+            raise result
+        return result
+
+    async def __run(self, pool: _PoolExecutor, name: str, fn: Callable[..., T], *args, **kwargs) -> T:
+        started = time.perf_counter()
+        try:
+            return await asyncio.get_running_loop().run_in_executor(pool, functools.partial(fn, *args, **kwargs))
+        finally:
+            POOL_SECONDS.observe(time.perf_counter() - started, pool=name)
+
+    async def run_blocking(self, fn: Callable[..., T], *args, **kwargs) -> T:
+        return await self.__run(self.__threads, "threads", fn, *args, **kwargs)
+
+    async def run_cpu(self, fn: Callable[..., T], *args, **kwargs) -> T:
+        """A process that dies (killed, out of memory) breaks the whole pool, failing this call and those waiting
+        with it. The pool is then replaced, so later calls get fresh processes."""
+        if self.__processes is None:
+            return await self.run_blocking(fn, *args, **kwargs)
+        pool = self.__processes
+        try:
+            return await self.__run(pool, "processes", fn, *args, **kwargs)
+        except BrokenProcessPool:
+            if self.__processes is pool:
+                logging.error("A pool process died, starting a new pool")
+                self.__processes = ProcessPoolExecutor(max_workers=self.processes, mp_context=self.__context)
+                pool.shutdown(wait=False, cancel_futures=True)
+            raise
+
+
+class LoopLagMonitor:
+    """Measures how late the event loop is to wake up a task sleeping for interval seconds.
+
+    Lag means something ran on the loop without yielding for that long, delaying every other event. Each
+    measurement is recorded in LOOP_LAG, and lag over warn_after seconds is logged."""
+
+    def __init__(self, interval: float = 0.5, warn_after: Optional[float] = 0.1):
+        self.__interval = interval
+        self.__warn_after = warn_after
+        self.__tasks: Set[asyncio.Task] = set()
+        self.max_lag = 0.0
+
+    def start(self):
+        task = asyncio.create_task(self.__monitor())
+        self.__tasks.add(task)
+        task.add_done_callback(self.__tasks.discard)
+
+    async def stop(self):
+        for task in list(self.__tasks):
+            task.cancel()
+        await asyncio.gather(*self.__tasks, return_exceptions=True)
+
+    async def __monitor(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            started = loop.time()
+            await asyncio.sleep(self.__interval)
+            lag = max(0.0, loop.time() - started - self.__interval)
+            self.max_lag = max(self.max_lag, lag)
+            LOOP_LAG.observe(lag)
+            if self.__warn_after is not None and lag > self.__warn_after:
+                logging.warning(f"Event loop was blocked for {lag:.3f}s")
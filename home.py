@@ -0,0 +1,108 @@
+from typing import Awaitable, Callable, Dict, List, Optional
+import asyncio
+import functools
+import hashlib
+import json
+import logging
+import time
+
+from slack_sdk.web.async_client import AsyncWebClient
+
+from jobs import JobScheduler
+from store import SQLiteStore
+import views
+
+
+class _Section:
+    __slots__ = ("name", "loader", "interval", "blocks")
+
+    def __init__(self, name: str, loader: Callable[[], Awaitable[List[dict]]], interval: float):
+        self.name = name
+        self.loader = loader
+        self.interval = interval
+        self.blocks: List[dict] = []
+
+
+class HomeTab:
+    """Publishes the Home tab, skipping users who already have the current version.
+
+    The view is built once from views.home_view and fingerprinted. For every user the fingerprint of the last view
+    published to them is kept in memory and in the store, so reopening the tab (or a restart) doesn't cost a
+    views.publish unless the content changed. Dynamic sections are reloaded by their own loaders on start(), then
+    every interval seconds by the jobs scheduler, which rebuilds the view only if their blocks changed. Users are
+    published to again after republish_after seconds anyway, in case their tab was changed by something else.
+    Fingerprints are kept in the store under namespace, which also names the jobs."""
+
+    def __init__(self, client: AsyncWebClient, store: Optional[SQLiteStore] = None, republish_after: float = 86400,
+                 namespace: str = "home-tab", jobs: Optional[JobScheduler] = None):
+        self.__client = client
+        self.__store = store
+        self.__jobs = jobs
+        self.__namespace = namespace
+        self.__republish_after = republish_after
+        self.__sections: Dict[str, _Section] = {}
+        self.__published: Dict[str, tuple] = {}
+        self.stats = {"published": 0, "skipped": 0, "failed": 0}
+        self.__build()
+
+    def add_section(self, name: str, loader: Callable[[], Awaitable[List[dict]]], interval: float):
+        """Show the blocks loader returns, reloading them every interval seconds. Sections appear in the order
+        they were added."""
+        self.__sections[name] = _Section(name, loader, interval)
+
+    def __build(self):
+        self.__view = views.home_view(section.blocks for section in self.__sections.values())
+        self.__fingerprint = hashlib.sha1(json.dumps(self.__view, sort_keys=True).encode()).hexdigest()
+
+    async def start(self):
+        if self.__store is not None:
+            for user_id, fingerprint, published_at in await asyncio.to_thread(self.__store.items, self.__namespace):
+                self.__published[user_id] = (fingerprint.decode(), published_at)
+        await asyncio.gather(*(self.refresh(name) for name in self.__sections))
+        if self.__jobs is not None:
+            for section in self.__sections.values():
+                # Jittered so the same section of several tenants doesn't reload all at once
+                self.__jobs.add(f"{self.__namespace}:{section.name}", functools.partial(self.refresh, section.name),
+                                section.interval, jitter=section.interval / 10)
+
+    async def stop(self):
+        if self.__jobs is not None:
+            for name in self.__sections:
+                self.__jobs.remove(f"{self.__namespace}:{name}")
+
+    async def refresh(self, name: str):
+        """Reload one section now, rebuilding the view if it changed"""
+        section = self.__sections[name]
+        try:
+            blocks = await section.loader()
+        except Exception:
+            logging.exception(f"Failed to refresh Home tab section {name}")
+            return
+        if blocks != section.blocks:
+            section.blocks = blocks
+            self.__build()
+
+    async def publish(self, user_id: str):
+        fingerprint = self.__fingerprint
+        previous = self.__published.get(user_id)
+        if previous is not None and previous[0] == fingerprint \
+                and time.time() - previous[1] < self.__republish_after:
+            self.stats["skipped"] += 1
+            return
+
+        # Recorded before publishing, so the user opening the tab again meanwhile doesn't publish twice
+        self.__published[user_id] = (fingerprint, time.time())
+        try:
+            await self.__client.views_publish(user_id=user_id, view=self.__view)
+        except Exception as e:
+            self.stats["failed"] += 1
+            if previous is None:
+                self.__published.pop(user_id, None)
+            else:
+                self.__published[user_id] = previous
+            logging.error(f"Error publishing home tab: {e}")
+            return
+
+        self.stats["published"] += 1
+        if self.__store is not None:
+            await asyncio.to_thread(self.__store.put, self.__namespace, user_id, fingerprint.encode())
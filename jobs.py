@@ -0,0 +1,297 @@
+from datetime import datetime, timedelta
+from typing import Awaitable, Callable, Dict, FrozenSet, List, Optional, Union
+import asyncio
+import heapq
+import itertools
+import logging
+import random
+import time
+
+import metrics
+from outbound import BACKGROUND, request_priority
+from store import SQLiteStore
+
+JOB_SECONDS = metrics.histogram("prvrbot_job_seconds", "Background job run time", ("job",),
+                                buckets=(0.01, 0.05, 0.1, 0.5, 1, 5, 10, 30, 60, 300))
+JOB_RUNS = metrics.counter("prvrbot_job_runs_total", "Background job runs by outcome: ok, failed, timeout, skipped "
+                           "(the previous runs were still going) and missed (a run started late enough to miss more)",
+                           ("job", "outcome"))
+JOBS_RUNNING = metrics.gauge("prvrbot_jobs_running", "Background job runs in progress, including those waiting for a "
+                             "slot", ("job",))
+
+
+class Interval:
+    """Every seconds seconds"""
+
+    def __init__(self, seconds: float):
+        if seconds <= 0:
+            raise ValueError(f"Job interval must be positive, not {seconds}")
+        self.seconds = seconds
+
+    def next_after(self, moment: float) -> float:
+        return moment + self.seconds
+
+    def __repr__(self):
+        return f"every {self.seconds:g}s"
+
+
+_CRON_ALIASES = {"@hourly": "0 * * * *", "@daily": "0 0 * * *", "@weekly": "0 0 * * 0", "@monthly": "0 0 1 * *"}
+# Bounds of minute, hour, day of month, month and day of week (0 and 7 are both Sunday)
+_CRON_BOUNDS = ((0, 59), (0, 23), (1, 31), (1, 12), (0, 7))
+
+
+def _cron_field(field: str, low: int, high: int) -> FrozenSet[int]:
+    values = set()
+    for part in field.split(","):
+        spec, _, step = part.partition("/")
+        if spec == "*":
+            start, end = low, high
+        elif "-" in spec:
+            start, end = (int(bound) for bound in spec.split("-", 1))
+        else:
+            # "5/15" means every 15 starting at 5
+            start = int(spec)
+            end = high if step else start
+        step = int(step) if step else 1
+        if not low <= start <= end <= high or step < 1:
+            raise ValueError(f"Invalid cron field {field}")
+        values.update(range(start, end + 1, step))
+    return frozenset(values)
+
+
+class Cron:
+    """A crontab schedule: "minute hour day-of-month month day-of-week", in local time. Fields take *, numbers,
+    ranges (a-b), steps (*/n, a-b/n) and lists of those, and @hourly, @daily, @weekly and @monthly work too. As in
+    cron, when both day fields are restricted a day matching either one counts."""
+
+    def __init__(self, expression: str):
+        self.expression = expression
+        fields = _CRON_ALIASES.get(expression, expression).split()
+        if len(fields) != 5:
+            raise ValueError(f"Cron expression {expression!r} doesn't have 5 fields")
+        minutes, hours, days, months, weekdays = (_cron_field(field, *bounds)
+                                                  for field, bounds in zip(fields, _CRON_BOUNDS))
+        self.__minutes = sorted(minutes)
+        self.__hours = sorted(hours)
+        self.__days = days
+        self.__months = months
+        self.__weekdays = frozenset(weekday % 7 for weekday in weekdays)
+        self.__either_day = not fields[2].startswith("*") and not fields[4].startswith("*")
+
+    def __day_matches(self, day: datetime) -> bool:
+        in_days = day.day in self.__days
+        # datetime counts weekdays from Monday, cron from Sunday
+        in_weekdays = (day.weekday() + 1) % 7 in self.__weekdays
+        return in_days or in_weekdays if self.__either_day else in_days and in_weekdays
+
+    def next_after(self, moment: float) -> float:
+        """The first matching minute after moment. Skips whole months, days and hours that don't match rather than
+        trying every minute."""
+        candidate = datetime.fromtimestamp(moment).replace(second=0, microsecond=0) + timedelta(minutes=1)
+        # February 29th falling on a given weekday can be years away
+        last_year = candidate.year + 28
+        while candidate.year <= last_year:
+            if candidate.month not in self.__months:
+                candidate = (candidate.replace(day=1, hour=0, minute=0) + timedelta(days=32)).replace(day=1)
+                continue
+            if not self.__day_matches(candidate):
+                candidate = candidate.replace(hour=0, minute=0) + timedelta(days=1)
+                continue
+            hour = next((hour for hour in self.__hours if hour >= candidate.hour), None)
+            if hour is None:
+                candidate = candidate.replace(hour=0, minute=0) + timedelta(days=1)
+                continue
+            if hour != candidate.hour:
+                candidate = candidate.replace(hour=hour, minute=0)
+            minute = next((minute for minute in self.__minutes if minute >= candidate.minute), None)
+            if minute is None:
+                candidate = candidate.replace(minute=0) + timedelta(hours=1)
+                continue
+            return candidate.replace(minute=minute).timestamp()
+        raise ValueError(f"Cron expression {self.expression!r} never matches")
+
+    def __repr__(self):
+        return f"cron {self.expression}"
+
+
+class Job:
+    __slots__ = ("name", "fn", "schedule", "jitter", "max_concurrency", "catch_up", "timeout", "running",
+                 "scheduled", "due")
+
+    def __init__(self, name: str, fn: Callable[[], Awaitable[object]], schedule: Union[Interval, Cron], jitter: float,
+                 max_concurrency: int, catch_up: bool, timeout: Optional[float]):
+        self.name = name
+        self.fn = fn
+        self.schedule = schedule
+        self.jitter = jitter
+        self.max_concurrency = max_concurrency
+        self.catch_up = catch_up
+        self.timeout = timeout
+        self.running = 0
+        # When the next run is scheduled, and when it is actually due: later by up to jitter seconds
+        self.scheduled: Optional[float] = None
+        self.due: Optional[float] = None
+
+
+class JobScheduler:
+    """Runs background jobs (async functions without arguments) on interval or cron schedules.
+
+    Jobs wait in a heap ordered by when they are next due, and a single task sleeps until the first of them, so idle
+    jobs cost nothing however many there are. Runs are at BACKGROUND priority, so the outbound requests they make
+    wait behind those of users, and while yield_to() is true (Slack requests are being handled) due runs wait for it
+    to be false, up to max_yield seconds. At most concurrency runs of all jobs go at once.
+
+    Each run is due up to the job's jitter seconds after its scheduled time, so jobs on the same schedule don't all
+    start together. A job already running max_concurrency times skips its run. Runs missed because the bot was busy
+    aren't made up; runs of catch_up jobs missed while the bot was down are, once, on start(), which takes the time
+    of their last run from the store (under namespace)."""
+
+    def __init__(self, store: Optional[SQLiteStore] = None, namespace: str = "jobs", concurrency: int = 4,
+                 yield_to: Optional[Callable[[], bool]] = None, max_yield: float = 30, yield_check: float = 0.05):
+        self.__store = store
+        self.__namespace = namespace
+        self.__slots = asyncio.Semaphore(concurrency)
+        self.__yield_to = yield_to
+        self.__max_yield = max_yield
+        self.__yield_check = yield_check
+        self.__jobs: Dict[str, Job] = {}
+        self.__heap: List[tuple] = []
+        self.__counter = itertools.count()
+        self.__last_runs: Dict[str, float] = {}
+        self.__wakeup = asyncio.Event()
+        self.__runner: Optional[asyncio.Task] = None
+        self.__tasks = set()
+
+    def __len__(self):
+        return len(self.__jobs)
+
+    def add(self, name: str, fn: Callable[[], Awaitable[object]], schedule: Union[float, str, Interval, Cron],
+            jitter: float = 0, max_concurrency: int = 1, catch_up: bool = False, timeout: Optional[float] = None):
+        """Run fn on schedule: a number of seconds between runs, or a cron expression. Runs that take longer than
+        timeout seconds are cancelled."""
+        if name in self.__jobs:
+            raise ValueError(f"There already is a job named {name}")
+        if isinstance(schedule, (int, float)):
+            schedule = Interval(schedule)
+        elif isinstance(schedule, str):
+            schedule = Cron(schedule)
+        job = Job(name, fn, schedule, jitter, max_concurrency, catch_up, timeout)
+        self.__jobs[name] = job
+        if self.__runner is not None:
+            self.__schedule_first(job, time.time())
+
+    def remove(self, name: str):
+        """Stop scheduling a job. Runs already going are left to finish."""
+        job = self.__jobs.pop(name, None)
+        if job is not None:
+            # Its heap entry is dropped when it comes up
+            job.due = None
+
+    async def start(self):
+        if self.__runner is not None:
+            return
+        if self.__store is not None:
+            for name, _, ran_at in await asyncio.to_thread(self.__store.items, self.__namespace):
+                self.__last_runs[name] = ran_at
+        now = time.time()
+        for job in self.__jobs.values():
+            self.__schedule_first(job, now)
+        self.__runner = asyncio.create_task(self.__run())
+        logging.info(f"Scheduled {len(self.__jobs)} background jobs")
+
+    async def stop(self):
+        tasks = list(self.__tasks)
+        if self.__runner is not None:
+            tasks.append(self.__runner)
+            self.__runner = None
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+        self.__heap.clear()
+
+    def run_now(self, name: str):
+        """Start a run of a job now, outside of its schedule"""
+        self.__start(self.__jobs[name], time.time())
+
+    def __schedule_first(self, job: Job, now: float):
+        last_run = self.__last_runs.get(job.name) if job.catch_up else None
+        if last_run is not None and job.schedule.next_after(last_run) <= now:
+            logging.info(f"Catching up on job {job.name}, last run at {datetime.fromtimestamp(last_run)}")
+            self.__push(job, now, now)
+        else:
+            self.__schedule_next(job, now if last_run is None else last_run, now)
+
+    def __schedule_next(self, job: Job, after: float, now: float):
+        scheduled = job.schedule.next_after(after)
+        if scheduled <= now:
+            # The run that just started was late enough to miss more, which it stands in for
+            JOB_RUNS.inc(job=job.name, outcome="missed")
+            logging.warning(f"Job {job.name} ran late and missed runs")
+            scheduled = job.schedule.next_after(now)
+        self.__push(job, scheduled, scheduled + random.uniform(0, job.jitter) if job.jitter else scheduled)
+
+    def __push(self, job: Job, scheduled: float, due: float):
+        job.scheduled = scheduled
+        job.due = due
+        heapq.heappush(self.__heap, (due, next(self.__counter), job))
+        if self.__heap[0][2] is job:
+            self.__wakeup.set()
+
+    async def __run(self):
+        while True:
+            self.__wakeup.clear()
+            now = time.time()
+            while self.__heap and self.__heap[0][0] <= now:
+                due, _, job = heapq.heappop(self.__heap)
+                # Entries of removed jobs, and ones superseded by a later push, are stale
+                if due != job.due:
+                    continue
+                self.__start(job, job.scheduled)
+                self.__schedule_next(job, job.scheduled, now)
+            delay = self.__heap[0][0] - time.time() if self.__heap else None
+            try:
+                await asyncio.wait_for(self.__wakeup.wait(), delay)
+            except asyncio.TimeoutError:
+                pass
+
+    def __start(self, job: Job, scheduled: float):
+        if job.running >= job.max_concurrency:
+            JOB_RUNS.inc(job=job.name, outcome="skipped")
+            logging.warning(f"Skipping a run of job {job.name}, {job.running} still going")
+            return
+        job.running += 1
+        JOBS_RUNNING.inc(job=job.name)
+        task = asyncio.create_task(self.__execute(job, scheduled))
+        self.__tasks.add(task)
+        task.add_done_callback(self.__tasks.discard)
+
+    async def __execute(self, job: Job, scheduled: float):
+        request_priority.set(BACKGROUND)
+        try:
+            await self.__wait_for_quiet()
+            async with self.__slots:
+                if job.catch_up and self.__store is not None:
+                    await asyncio.to_thread(self.__store.put, self.__namespace, job.name, b"", scheduled)
+                started = time.monotonic()
+                try:
+                    await asyncio.wait_for(job.fn(), job.timeout)
+                except asyncio.TimeoutError:
+                    JOB_RUNS.inc(job=job.name, outcome="timeout")
+                    logging.error(f"Job {job.name} timed out after {job.timeout}s")
+                except Exception:
+                    JOB_RUNS.inc(job=job.name, outcome="failed")
+                    logging.exception(f"Job {job.name} failed")
+                else:
+                    JOB_RUNS.inc(job=job.name, outcome="ok")
+                finally:
+                    JOB_SECONDS.observe(time.monotonic() - started, job=job.name)
+        finally:
+            job.running -= 1
+            JOBS_RUNNING.dec(job=job.name)
+
+    async def __wait_for_quiet(self):
+        if self.__yield_to is None:
+            return
+        deadline = time.monotonic() + self.__max_yield
+        while self.__yield_to() and time.monotonic() < deadline:
+            await asyncio.sleep(self.__yield_check)
@@ -0,0 +1,110 @@
+from typing import Dict, Iterable, Optional, Union
+import json
+import logging
+import logging.handlers
+import math
+import queue
+
+FORMAT = "[%(asctime)s][%(levelname)s][%(filename)s]: %(message)s"
+DATE_FORMAT = "%Y-%m-%d %H:%M:%S"
+
+# Payloads are cut to this many characters when logged
+payload_limit = 500
+
+
+class Payload:
+    """Log argument for a request or event body, rendered only if the record is emitted.
+
+    Pass it as a %-style argument, not in an f-string, so nothing is serialized for records below the log level or
+    dropped by sampling. fields picks dotted paths ("event.user") out of a dict instead of logging all of it, and the
+    rendered text is cut to limit characters."""
+    __slots__ = ("value", "fields", "limit")
+
+    def __init__(self, value, fields: Optional[Iterable[str]] = None, limit: Optional[int] = None):
+        self.value = value
+        self.fields = fields
+        self.limit = limit
+
+    @staticmethod
+    def __pick(value, path: str):
+        for key in path.split("."):
+            if not isinstance(value, dict) or key not in value:
+                return None
+            value = value[key]
+        return value
+
+    def __str__(self):
+        value = self.value
+        if self.fields is not None and isinstance(value, dict):
+            value = {path: self.__pick(value, path) for path in self.fields}
+        if isinstance(value, str):
+            text = value
+        else:
+            try:
+                text = json.dumps(value, default=str, ensure_ascii=False)
+            except (TypeError, ValueError):
+                text = str(value)
+
+        limit = payload_limit if self.limit is None else self.limit
+        if len(text) > limit:
+            text = f"{text[:limit]}... ({len(text)} chars)"
+        return text
+
+
+class EventSampler(logging.Filter):
+    """Keep one in every 1/rate records per event type, given with extra={"event_type": ...}.
+
+    Records without an event type always pass. Rates are per type, with default for types not listed; 0 drops
+    them all."""
+
+    def __init__(self, rates: Optional[Dict[str, float]] = None, default: float = 1.0):
+        super().__init__()
+        self.__every = {event_type: self.__interval(rate) for event_type, rate in (rates or {}).items()}
+        self.__default = self.__interval(default)
+        self.__seen: Dict[str, int] = {}
+        self.stats = {"kept": 0, "dropped": 0}
+
+    @staticmethod
+    def __interval(rate: float) -> int:
+        return 0 if rate <= 0 else max(1, math.floor(1 / rate + 0.5))
+
+    def filter(self, record: logging.LogRecord) -> bool:
+        event_type = getattr(record, "event_type", None)
+        if event_type is None:
+            return True
+        every = self.__every.get(event_type, self.__default)
+        seen = self.__seen.get(event_type, 0)
+        self.__seen[event_type] = seen + 1
+        if every and seen % every == 0:
+            self.stats["kept"] += 1
+            return True
+        self.stats["dropped"] += 1
+        return False
+
+
+def setup(path: Optional[str] = None, level: Union[int, str] = logging.INFO, max_bytes: int = 10 * 1024 * 1024,
+          backups: int = 5, sampling: Optional[Dict[str, float]] = None) -> logging.handlers.QueueListener:
+    """Log to stderr and a rotating file from a background thread.
+
+    The root logger only puts records on a queue, so the event loop never waits on the console or disk. Call
+    stop() on the returned listener at exit to flush what is still queued."""
+    formatter = logging.Formatter(FORMAT, datefmt=DATE_FORMAT)
+    handlers = [logging.StreamHandler()]
+    if path:
+        handlers.append(logging.handlers.RotatingFileHandler(path, maxBytes=max_bytes, backupCount=backups,
+                                                             encoding="utf-8", delay=True))
+    for handler in handlers:
+        handler.setLevel(level)
+        handler.setFormatter(formatter)
+
+    records = queue.SimpleQueue()
+    queue_handler = logging.handlers.QueueHandler(records)
+    queue_handler.addFilter(EventSampler(sampling))
+
+    root = logging.getLogger()
+    root.setLevel(level)
+    root.addHandler(queue_handler)
+
+    listener = logging.handlers.QueueListener(records, *handlers, respect_handler_level=True)
+    listener.start()
+    return listener
@@ -1,20 +1,36 @@
-from datetime import date
+import asyncio
+import functools
 import json
 import logging
 import os
 import random
 import re
+import time
 
-from fuzzywuzzy import fuzz
 import pyjokes
+from slack_bolt import BoltResponse
 from slack_bolt.app.async_app import AsyncApp as Slack
 from slack_bolt.adapter.socket_mode.async_handler import AsyncSocketModeHandler
+from slack_sdk.web.async_client import AsyncWebClient
 import yaml
 
-from breezeway import AsyncApp as Breezeway
+from breezeway import UNAVAILABLE, AsyncApp as Breezeway
+from executor import Executor, LoopLagMonitor
+from home import HomeTab
+from jobs import JobScheduler
+import logs
+from matching import names_matching
+import metrics
+from outbound import FairShare
+from router import CommandRouter
+from shared import SQLiteSharedState
+from store import SQLiteStore
+from tenants import Tenant, Tenants
+import views
+from workqueue import DurableQueue, RetryLater
 
 
-# TODO: Add brivo code to home screen
+# TODO: Add brivo code to home screen (home_tab.add_section, refreshed on its own schedule)
 
 
 def get_file(filename):
@@ -23,18 +39,6 @@ def get_file(filename):
 
 
 logger = logging.getLogger()
-logger.setLevel(logging.INFO)
-formatter = logging.Formatter('[%(asctime)s][%(levelname)s][%(filename)s]: %(message)s',
-                              datefmt='%Y-%m-%d %H:%M:%S')
-ch = logging.StreamHandler()
-ch.setLevel(logging.INFO)
-ch.setFormatter(formatter)
-logger.addHandler(ch)
-
-fh = logging.FileHandler(get_file("prvrbot.log"))
-fh.setLevel(logging.INFO)
-fh.setFormatter(formatter)
-logger.addHandler(fh)
 
 
 def get_config(filename):
@@ -45,121 +49,153 @@ def get_config(filename):
         return yaml.safe_load(f)
 
 
-config = get_config("config/config.yml")
-
-
-slack = Slack(token=config["slack"]["bot-token"], name="PRVRbot")
-breezeway = Breezeway(
-    client_id=config["breezeway"]["client-id"], client_secret=config["breezeway"]["client-secret"],
-    company_id=config["breezeway"]["company-id"], url=config["breezeway"]["url"])
+config = get_config(os.environ.get("PRVRBOT_CONFIG", "config/config.yml"))
+
+logs.payload_limit = config.get("logging", {}).get("payload-length", 500)
+log_listener = logs.setup(path=get_file(config.get("logging", {}).get("file", "prvrbot.log")),
+                          level=config.get("logging", {}).get("level", "INFO"),
+                          max_bytes=config.get("logging", {}).get("max-bytes", 10 * 1024 * 1024),
+                          backups=config.get("logging", {}).get("backups", 5),
+                          sampling=config.get("logging", {}).get("sample"))
+
+
+def get_shared_state(options):
+    """Backend for state shared between replicas, or None when running a single one"""
+    backend = options.get("backend")
+    if not backend:
+        return None
+    if backend == "sqlite":
+        return SQLiteSharedState(get_file(options["path"]))
+    raise Exception(f"Unknown shared-state backend {backend}")
+
+
+shared_state = get_shared_state(config.get("shared-state", {}))
+
+executor = Executor(threads=config.get("executor", {}).get("threads", 4),
+                    processes=config.get("executor", {}).get("processes", 0))
+loop_lag = LoopLagMonitor(interval=config.get("executor", {}).get("lag-interval", 0.5),
+                          warn_after=config.get("executor", {}).get("lag-warning", 0.1))
+# Proactive work (inventory syncs, Home tab sections), deferred while Slack requests are being handled
+jobs = JobScheduler(store=SQLiteStore(get_file(config["jobs"]["store"])) if config.get("jobs", {}).get("store")
+                    else None,
+                    concurrency=config.get("jobs", {}).get("concurrency", 4),
+                    yield_to=lambda: metrics.in_flight() > 0,
+                    max_yield=config.get("jobs", {}).get("max-yield", 30))
+
+
+def tenant_config(tenant: dict) -> dict:
+    """The config as it applies to tenant: its own slack and breezeway settings over the top-level ones"""
+    return {**config, "slack": {**config["slack"], **tenant.get("slack", {})},
+            "breezeway": {**config["breezeway"], **tenant.get("breezeway", {})}}
+
+
+def make_breezeway(name, options, share):
+    return Breezeway(
+        client_id=options["client-id"], client_secret=options["client-secret"],
+        company_id=options["company-id"], url=options["url"],
+        connection_limit=options.get("connection-limit", 20),
+        dns_cache_ttl=options.get("dns-cache-ttl", 300),
+        keepalive_timeout=options.get("keepalive-timeout", 30),
+        timeout=options.get("timeout", 10),
+        units_ttl=options.get("cache", {}).get("units-ttl", 300),
+        people_ttl=options.get("cache", {}).get("people-ttl", 900),
+        max_stale=options.get("cache", {}).get("max-stale", 86400),
+        scorer=options.get("scorer", "fuzzywuzzy"),
+        token_refresh_margin=options.get("token-refresh-margin", 300),
+        rate_limit=options.get("rate-limit", 10),
+        rate_burst=options.get("rate-burst", 20),
+        concurrency=options.get("concurrency", 8),
+        retries=options.get("retries", 3),
+        snapshot_path=get_file(options["snapshot"]) if options.get("snapshot") else None,
+        page_size=options.get("page-size", 500),
+        sync_interval=options.get("sync-interval"),
+        breaker_threshold=options.get("breaker", {}).get("failure-threshold", 5),
+        breaker_reset=options.get("breaker", {}).get("reset-timeout", 30),
+        name=name, share=share, executor=executor, shared=shared_state, jobs=jobs)
+
+
+# Without a tenants section the bot serves one tenant, configured by the top-level slack and breezeway sections
+tenant_entries = config.get("tenants") or [{"name": "default"}]
+single_tenant = len(tenant_entries) == 1
+# Breezeway requests in flight across all tenants, split fairly between them
+breezeway_share = FairShare(config.get("tenancy", {}).get("breezeway-concurrency", 16))
+home_tab_store = SQLiteStore(get_file(config["home-tab"]["fingerprints"])) \
+    if config.get("home-tab", {}).get("fingerprints") else None
+tenants = Tenants()
+for entry in tenant_entries:
+    options = tenant_config(entry)
+    client = AsyncWebClient(token=options["slack"]["bot-token"],
+                            base_url=options["slack"].get("api-url", AsyncWebClient.BASE_URL))
+    tenants.add(Tenant(
+        entry["name"], entry.get("team-id"), options, client,
+        breezeway=make_breezeway("Breezeway" if single_tenant else f"Breezeway ({entry['name']})",
+                                 options["breezeway"], breezeway_share),
+        home_tab=HomeTab(client, store=home_tab_store,
+                         republish_after=config.get("home-tab", {}).get("republish-after", 86400),
+                         namespace="home-tab" if single_tenant else f"home-tab:{entry['name']}", jobs=jobs)))
+
+
+async def authorize(context, team_id, client):
+    # Bolt picks arguments by parameter name, and would try to fill in the self of a bound method
+    return await tenants.authorize(context, team_id, client)
+
+
+slack = Slack(name="PRVRbot", client=AsyncWebClient(base_url=config["slack"].get("api-url", AsyncWebClient.BASE_URL)),
+              authorize=authorize)
+
+
+def request_key(body):
+    """What identifies a request across Slack retries and replicas: the event id of events, the trigger id of
+    interactions. Option requests have neither, and whoever gets them answers."""
+    if body.get("type") == "event_callback":
+        return body.get("event_id")
+    return body.get("trigger_id")
+
+
+@slack.middleware
+async def claim_request(body, next):
+    """With several replicas, make sure only one handles each request. A busy replica waits a little before
+    claiming, so when a request reaches several replicas the least busy one tends to get it."""
+    key = request_key(body)
+    if shared_state is not None and key is not None:
+        await asyncio.sleep(min(metrics.in_flight() * config["shared-state"].get("claim-delay", 0.005),
+                                config["shared-state"].get("max-claim-delay", 0.1)))
+        if not await shared_state.claim(f"request:{key}", ttl=config["shared-state"].get("claim-ttl", 3600)):
+            logger.info(f"Skipping {key}, it is already being handled")
+            return BoltResponse(status=200, body="")
+    await next()
 
 
 @slack.action("none")
+@metrics.timed
 async def handle_some_action(ack):
     await ack()
 
 
 @slack.event("app_home_opened")
-async def update_home_tab(client, event):
-    user_id = event["user"]
-    try:
-        # views.publish is the method that your app uses to push a view to the Home tab
-        await client.views_publish(
-            # the user that opened your app's app home
-            user_id=user_id,
-            # the view object that appears in the app home
-            view={"type": "home", "callback_id": "home_view",
-
-                  # body of the view
-                  "blocks": [
-                      {
-                          "type": "header",
-                          "text": {
-                              "type": "plain_text",
-                              "text": ":wave: Howdy! I'm PRVRbot"
-                          }
-                      },
-                      {
-                          "type": "header",
-                          "text": {
-                              "type": "plain_text",
-                              "text": "What am I?"
-                          }
-                      },
-                      {
-                          "type": "divider"
-                      },
-                      {
-                          "type": "section",
-                          "text": {
-                              "type": "mrkdwn",
-                              "text": "I am a project started by Anthony. I want to learn to aid people in day to day "
-                                      "tasks by providing information when prompted. In time, these passive abilities "
-                                      "may be able to turn into tasks that I can do without needing to be prompted. "
-                          }
-                      },
-                      {
-                          "type": "header",
-                          "text": {
-                              "type": "plain_text",
-                              "text": "What can I do right now?"
-                          }
-                      },
-                      {
-                          "type": "divider"
-                      },
-                      {
-                          "type": "section",
-                          "text": {
-                              "type": "mrkdwn",
-                              "text": "Well, not much. I am still in my infancy, but here is a list of what I can "
-                                      "currently do...\n  - Automatically welcome new PRVR members in #general\n  - "
-                                      "Tell you a dumb joke. Send me a DM saying \"joke\". "
-                          }
-                      },
-                      {
-                          "type": "header",
-                          "text": {
-                              "type": "plain_text",
-                              "text": "What do I think I will do in the future?"
-                          }
-                      },
-                      {
-                          "type": "divider"
-                      },
-                      {
-                          "type": "section",
-                          "text": {
-                              "type": "mrkdwn",
-                              "text": "- Generate weekly :key: lockout codes and hand them out as needed while "
-                                      "keeping a log of who had access to them.\n- Send alerts from :ear: "
-                                      "NoiseAware\n- Generate projects in :breezeway:Breezeway for things like low "
-                                      "batteries on doorknobs.\n- Notify the team about changes in the weather. "
-                                      ":rain_cloud: Eg. Reminder to check pool cover pumps if it's going to rain.\n- "
-                                      "Sky is the limit. "
-                          }
-                      }
-                  ]
-                  })
-
-    except Exception as e:
-        logger.error(f"Error publishing home tab: {e}")
+@metrics.timed
+async def update_home_tab(event, context):
+    await context["tenant"].home_tab.publish(event["user"])
 
 
 @slack.event("team_join")
-async def ask_for_introduction(event, say):
+@metrics.timed
+async def ask_for_introduction(event, say, context):
     """When a user joins the workspace, send a message in #general asking them to introduce themselves"""
-    if config["slack"]["welcome-module"]["enabled"] and not event["user"]["is_bot"]:
+    welcome = context["tenant"].config["slack"]["welcome-module"]
+    if welcome["enabled"] and not event["user"]["is_bot"]:
         user_id = event["user"]["id"]
         logger.info(f"{user_id} joined!")
         text = f"Welcome to the PRVR team, <@{user_id}>! :tada:🎉 You can introduce yourself in this channel."
-        await say(text=text, channel=config["slack"]["welcome-module"]["channel"])
+        await say(text=text, channel=welcome["channel"])
 
 
 @slack.shortcut("create_breezeway_task")
-async def breezeway_shortcut(ack, body, client):
+@metrics.timed
+async def breezeway_shortcut(ack, body, client, context):
     task_ack = asyncio.create_task(ack())
-    if config["breezeway"]["enabled"] is False:
+    tenant = context["tenant"]
+    if tenant.config["breezeway"]["enabled"] is False:
         await task_ack
         return
 
@@ -169,313 +205,164 @@ async def breezeway_shortcut(ack, body, client):
         "react-to": body["message"]["ts"]
     }
 
-    units = await breezeway.get_units_sorted()
-
-    result = {"ratio": 0}
-    for unit in units:
-        weight = len(unit["name"]) * 0.007 + 1
-        ratio = fuzz.partial_ratio(unit["name"].lower(), body["message"]["text"].lower()) * weight
-        if ratio > result["ratio"]:
-            result = {"name": unit["name"], "id": unit["id"], "ratio": ratio}
-
-    unit_department_block = {
-        "type": "actions",
-        "elements": [
-            {
-                "action_id": "unit",
-                "type": "external_select",
-                "placeholder": {
-                    "type": "plain_text",
-                    "text": "Select Property"
-                },
-                "min_query_length": 3
-
-            },
-            {
-                "type": "static_select",
-                "placeholder": {
-                    "type": "plain_text",
-                    "text": "Select Department",
-                    "emoji": True
-                },
-                "initial_option": {
-                    "text": {
-                        "type": "plain_text",
-                        "text": "Maintenance",
-                        "emoji": True
-                    },
-                    "value": "maintenance"
-                },
-                "options": [
-                    {
-                        "text": {
-                            "type": "plain_text",
-                            "text": "Cleaning",
-                            "emoji": True
-                        },
-                        "value": "housekeeping"
-                    },
-                    {
-                        "text": {
-                            "type": "plain_text",
-                            "text": "Inspection",
-                            "emoji": True
-                        },
-                        "value": "inspection"
-                    },
-                    {
-                        "text": {
-                            "type": "plain_text",
-                            "text": "Maintenance",
-                            "emoji": True
-                        },
-                        "value": "maintenance"
-                    }
-                ],
-                "action_id": "department"
-            }
-        ]
-    }
-    if result["ratio"] > 65:
-        unit_department_block["elements"][0]["initial_option"] = {
-            "text": {
-                "type": "plain_text",
-                "text": result["name"],
-                "emoji": True
-            },
-            "value": str(result["id"])
-        }
-
-    title_block = {
-        "type": "input",
-        "label": {
-            "type": "plain_text",
-            "text": "Title",
-            "emoji": True
-        },
-        "element": {
-            "type": "plain_text_input",
-            "action_id": "title"
-        }
-    }
-    description_block = {
-        "type": "input",
-        "label": {
-            "type": "plain_text",
-            "text": "Description",
-            "emoji": True
-        },
-        "element": {
-            "type": "plain_text_input",
-            "multiline": True,
-            "action_id": "description",
-            "initial_value": body["message"]["text"]
-        }
-    }
-    due_date_block = {
-        "type": "input",
-        "block_id": "due_date",
-        "label": {
-            "type": "plain_text",
-            "text": "Due on",
-            "emoji": True
-        },
-        "element": {
-            "type": "datepicker",
-            "placeholder": {
-                "type": "plain_text",
-                "text": "Select a date",
-                "emoji": True
-            },
-            "initial_date": f"{date.today()}",
-            "action_id": "due_date"
-        }
-    }
-
-    people = await breezeway.get_people_sorted()
-    people_options = []
-
-    for person in people:
-        option = {
-            "text": {
-                "type": "plain_text",
-                "text": f"{person['first_name']} {person['last_name'][0]}.",
-                "emoji": True
-            },
-            "value": f"{person['id']}"
-        }
-        people_options.append(option)
-
-    assignees_block = {
-        "type": "input",
-        "label": {
-            "type": "plain_text",
-            "text": "Assignees",
-            "emoji": True
-        },
-        "element": {
-            "type": "multi_static_select",
-            "placeholder": {
-                "type": "plain_text",
-                "text": "Select options",
-                "emoji": True
-            },
-            "options": people_options,
-            "action_id": "assignees"
-        }
-    }
-
-    blocks = [unit_department_block,
-              title_block,
-              description_block,
-              due_date_block,
-              assignees_block]
-
-    modal = {
-        "type": "modal",
-        "callback_id": "breezeway_task",
-        "submit": {
-            "type": "plain_text",
-            "text": "Create",
-            "emoji": True
-        },
-        "close": {
-            "type": "plain_text",
-            "text": "Cancel",
-            "emoji": True
-        },
-        "title": {
-            "type": "plain_text",
-            "text": "New Breezeway task",
-            "emoji": True
-        },
-        "blocks": blocks,
-        "private_metadata": json.dumps(private_metadata)
-    }
-
-    await client.views_open(trigger_id=body["trigger_id"], view=modal)
+    # Open a placeholder right away so the trigger_id can't expire while Breezeway is slow, then fill it in
+    loading = await client.views_open(trigger_id=body["trigger_id"], view=views.LOADING_MODAL)
     await task_ack
 
+    breezeway = tenant.breezeway
+    try:
+        match, people = await asyncio.gather(breezeway.match_unit(body["message"]["text"], threshold=65),
+                                             breezeway.get_people_sorted())
+        modal = views.task_modal(people, body["message"]["text"], private_metadata,
+                                 unit=match[0] if match is not None else None,
+                                 offline=breezeway.breaker.state != breezeway.breaker.CLOSED)
+    except Exception as e:
+        # Don't leave the user looking at the loading modal
+        logger.error(f"Could not load the task form from {breezeway.name}: {e!r}")
+        modal = views.error_modal(":warning: Couldn't load properties and staff from Breezeway. Close this and try "
+                                  "again in a few minutes.")
 
-@slack.options("unit")
-async def handle_some_options(body, ack):
-    units = await breezeway.get_units_sorted(body["value"])
+    await client.views_update(view_id=loading["view"]["id"], hash=loading["view"]["hash"], view=modal)
 
-    unit_options = []
-    for unit in units:
-        option = {
-            "text": {
-                "type": "plain_text",
-                "text": unit["name"],
-                "emoji": True
-            },
-            "value": str(unit['id'])
-        }
-        unit_options.append(option)
 
-    await ack(options=unit_options)
+@slack.options(re.compile("^units?$"))
+@metrics.timed
+async def handle_some_options(body, ack, context):
+    units = await context["tenant"].breezeway.search_units(body["value"])
+    await ack(options=views.unit_options(units))
 
 
 @slack.action("unit")
+@metrics.timed
 async def handle_some_action(ack,):
     await ack()
 
 
 @slack.action("department")
-async def update_view(ack, body, client):
+@metrics.timed
+async def update_view(ack, body, client, context):
     await ack()
-    info = {}
-    for v in body["view"]["state"]["values"].values():
-        info |= v
-
-    blocks = body["view"]["blocks"]
+    # People come from the cache, and their options are only rebuilt when it has reloaded them
+    modal = views.updated_task_modal(body["view"], await context["tenant"].breezeway.get_people_sorted())
+    await client.views_update(trigger_id=body["trigger_id"], view=modal, view_id=body["view"]["id"])
 
-    people = await breezeway.get_people_sorted()
-    people_options = []
 
-    for person in people:
-        option = {
-            "text": {
-                "type": "plain_text",
-                "text": f"{person['first_name']} {person['last_name'][0]}.",
-                "emoji": True
-            },
-            "value": f"{person['id']}"
-        }
-        people_options.append(option)
-
-    blocks[4] = {
-        "type": "input",
-        "label": {
-            "type": "plain_text",
-            "text": "Assignees",
-            "emoji": True
-        },
-        "element": {
-            "type": "multi_static_select",
-            "placeholder": {
-                "type": "plain_text",
-                "text": "Select options",
-                "emoji": True
-            },
-            "options": people_options,
-            "action_id": "assignees"
-        }
-    }
+# How long matching a bulk pattern against the units may take
+PATTERN_TIMEOUT = 2
+# How long a submission may spend matching its pattern before it is acked, within Slack's 3 seconds. Patterns that take
+# longer are left to the queue worker.
+ACK_MATCH_TIMEOUT = 1.5
 
-    modal = {
-        "type": "modal",
-        "callback_id": "breezeway_task",
-        "submit": {
-            "type": "plain_text",
-            "text": "Create",
-            "emoji": True
-        },
-        "close": {
-            "type": "plain_text",
-            "text": "Cancel",
-            "emoji": True
-        },
-        "title": {
-            "type": "plain_text",
-            "text": "Create a Breezeway task",
-            "emoji": True
-        },
-        "blocks": blocks,
-        "private_metadata": body["view"]["private_metadata"]
-    }
 
-    await client.views_update(trigger_id=body["trigger_id"], view=modal, view_id=body["view"]["id"])
+async def units_matching(breezeway, unit_pattern, timeout=PATTERN_TIMEOUT):
+    """Units whose name matches unit_pattern, ignoring case. Raises re.error for an invalid pattern and
+    asyncio.TimeoutError if loading the units and matching take more than timeout seconds."""
+    deadline = time.monotonic() + timeout
+    units = await asyncio.wait_for(breezeway.get_units_sorted(), timeout)
+    remaining = deadline - time.monotonic()
+    if remaining <= 0:
+        raise asyncio.TimeoutError()
+    positions = await executor.run_isolated(names_matching, [unit.name for unit in units], unit_pattern,
+                                            timeout=remaining)
+    return [units[i] for i in positions]
 
 
 @slack.view("breezeway_task")
-async def breezeway_task_submission(ack, body, client):  # TODO: <- use "client"
+@metrics.timed
+async def breezeway_task_submission(ack, body, context):
     # TODO dont allow projects in past
-    # TODO enforce property
-    logger.info(f"Received view submission from {body['user']['username']}")
-    metadata = json.loads(body["view"]["private_metadata"])
-
     info = {}
     for v in body["view"]["state"]["values"].values():
         info |= v
 
-    unit_id = info["unit"]["selected_option"]["value"]
-    department = info["department"]["selected_option"]["value"]
-    title = info["title"]["value"]
-    description = info["description"]["value"]
-    due_date = info["due_date"]["selected_date"]
-    assignees = [int(v["value"]) for v in info['assignees']['selected_options']]
+    units = [{"id": option["value"], "name": option["text"]["text"]}
+             for option in [info["unit"]["selected_option"]] + info["units"]["selected_options"] if option]
+    unit_pattern = info["unit_pattern"]["value"]
+    breezeway = context["tenant"].breezeway
+    if unit_pattern:
+        try:
+            re.compile(unit_pattern, re.IGNORECASE)
+        except re.error as e:
+            await ack(response_action="errors", errors={"unit_pattern": f"Not a valid pattern: {e}"})
+            return
+        try:
+            matches = await units_matching(breezeway, unit_pattern, timeout=ACK_MATCH_TIMEOUT)
+        except (asyncio.TimeoutError, ChildProcessError) as e:
+            # Acked regardless: the worker matches again and reports back if it can't
+            logger.info(f"Leaving {unit_pattern} to the queue worker to match ({e!r})")
+            matches = []
+        limit = context["tenant"].config["breezeway"].get("bulk-limit", 50)
+        count = len({unit["id"] for unit in units} | {str(unit.id) for unit in matches})
+        if count > limit:
+            await ack(response_action="errors", errors={
+                "unit_pattern": f"Matches {count} properties, more than the {limit} a task can be created for at "
+                                f"once. Narrow it down."})
+            return
+    elif not units:
+        await ack(response_action="errors", errors={"bulk_units": "Select at least one property"})
+        return
+
+    await ack()
+    logger.info(f"Received view submission from {body['user']['username']}")
+
+    job = {
+        "user": body["user"]["id"],
+        "metadata": json.loads(body["view"]["private_metadata"]),
+        "units": list({unit["id"]: unit for unit in units}.values()),
+        "unit_pattern": unit_pattern,
+        "department": info["department"]["selected_option"]["value"],
+        "title": info["title"]["value"],
+        "description": info["description"]["value"],
+        "due_date": info["due_date"]["selected_date"],
+        "assignees": [int(v["value"]) for v in info['assignees']['selected_options']]
+    }
+    # The view id is the same for every submission of this modal, so resubmits and Slack retries are dropped
+    await context["tenant"].submissions.submit(body["view"]["id"], job)
+
+
+async def retry_when_available(tenant, key, job, error):
+    """Put a job Breezeway couldn't be reached for back in the queue until it can, telling the user the first time"""
+    if not job.get("deferred"):
+        job["deferred"] = True
+        await tenant.submissions.update(key, job)
+        metadata = job["metadata"]
+        await tenant.client.chat_postEphemeral(token=tenant.config["slack"]["bot-token"],
+                                              text="Breezeway isn't responding right now. Your task is saved and "
+                                                   "will be created as soon as it is back.",
+                                              channel=metadata["channel"], thread_ts=metadata["reply-to"],
+                                              user=job["user"])
+    # Spread out the retries so they don't all arrive at once when the circuit half-opens
+    raise RetryLater(tenant.breezeway.breaker.retry_in() + random.uniform(1, 10), repr(error))
+
+
+@metrics.timed
+async def create_breezeway_task(tenant, key, job):
+    """Worker for the tenant's submissions queue: create the project, then report back in the thread"""
+    if job["unit_pattern"] or len(job["units"]) > 1:
+        await create_breezeway_tasks_bulk(tenant, key, job)
+        return
+
+    metadata = job["metadata"]
+    unit = job["units"][0]
+    if "project" not in job:
+        try:
+            job["project"] = await tenant.breezeway.create_project(
+                unit_id=unit["id"], department=job["department"], title=job["title"],
+                description=job["description"], due_date=job["due_date"], assignees=job["assignees"])
+        except UNAVAILABLE as e:
+            await retry_when_available(tenant, key, job, e)
+        except Exception as e:
+            logger.error(f"Error creating project: {e!r}")
+            job["project"] = {}
+        await tenant.submissions.update(key, job)
+    project = job["project"]
 
-    project = await breezeway.create_project(unit_id=unit_id, department=department, title=title,
-                                             description=description,
-                                             due_date=due_date, assignees=assignees)
     if "id" in project:  # Successfully made project
-        await ack()
         blocks = [{
             "type": "section",
             "text": {
                 "type": "mrkdwn",
-                "text": f"{info['unit']['selected_option']['text']['text']}: {project['name']}"
+                "text": f"{unit['name']}: {project['name']}"
             },
             "accessory": {
                 "type": "button",
@@ -490,75 +377,246 @@ async def breezeway_task_submission(ack, body, client):  # TODO: <- use "client"
             }
         }]
 
-        await client.chat_postMessage(text=f"Project made\n{project['name']}", channel=metadata["channel"],
-                                      thread_ts=metadata["reply-to"], blocks=blocks, icon_emoji=":breezeway:")
-        await client.reactions_add(channel=metadata["channel"], timestamp=metadata["react-to"], name="breezeway")
+        await asyncio.gather(
+            tenant.client.chat_postMessage(text=f"Project made\n{project['name']}", channel=metadata["channel"],
+                                           thread_ts=metadata["reply-to"], blocks=blocks, icon_emoji=":breezeway:"),
+            tenant.client.reactions_add(channel=metadata["channel"], timestamp=metadata["react-to"],
+                                        name="breezeway"))
         # TODO add delete project button?
 
     else:
-        await ack()
-        await slack.client.chat_postEphemeral(token=config["slack"]["bot-token"],
-                                              text=f"Something went wrong. Please try again or make build project in "
-                                                   f"breezeway", channel=metadata["channel"],
-                                              thread_ts=metadata["reply-to"], user=body["user"]["id"])
+        await tenant.client.chat_postEphemeral(token=tenant.config["slack"]["bot-token"],
+                                               text=f"Something went wrong. Please try again or make build project in "
+                                                    f"breezeway", channel=metadata["channel"],
+                                               thread_ts=metadata["reply-to"], user=job["user"])
+
+
+async def create_breezeway_tasks_bulk(tenant, key, job):
+    """Create the task for every selected and matching property, then post one summary in the thread"""
+    metadata = job["metadata"]
+    breezeway, submissions = tenant.breezeway, tenant.submissions
+
+    async def tell_user(text):
+        await tenant.client.chat_postEphemeral(token=tenant.config["slack"]["bot-token"], channel=metadata["channel"],
+                                              thread_ts=metadata["reply-to"], user=job["user"], text=text)
+
+    if "results" not in job:
+        units = {unit["id"]: unit for unit in job["units"]}
+        if job["unit_pattern"]:
+            try:
+                matches = await units_matching(breezeway, job["unit_pattern"])
+            except (asyncio.TimeoutError, ChildProcessError, re.error) as e:
+                logger.warning(f"Not creating {job['title']}, could not match {job['unit_pattern']}: {e!r}")
+                reason = "takes too long to match" if isinstance(e, asyncio.TimeoutError) else \
+                    "could not be matched against the properties"
+                await tell_user(f"{job['unit_pattern']} {reason}, so no tasks were created for {job['title']}.")
+                return
+            for unit in matches:
+                units.setdefault(str(unit.id), {"id": str(unit.id), "name": unit.name})
+        limit = tenant.config["breezeway"].get("bulk-limit", 50)
+        if len(units) > limit:
+            # Usually caught on submission, unless matching was left to this worker or the properties changed since
+            logger.warning(f"Not creating {job['title']} for {len(units)} properties, more than {limit}")
+            await tell_user(f"{job['unit_pattern']} matches {len(units)} properties, more than the {limit} a task "
+                            f"can be created for at once, so no tasks were created.")
+            return
+        job["units"] = list(units.values())
+        job["results"] = {}
+        await submissions.update(key, job)
+
+    async def save_result(unit_id, project):
+        job["results"][unit_id] = project
+        await submissions.update(key, job)
+
+    remaining = [unit["id"] for unit in job["units"] if unit["id"] not in job["results"]]
+    await breezeway.create_projects_bulk(remaining, department=job["department"], title=job["title"],
+                                         description=job["description"], due_date=job["due_date"],
+                                         assignees=job["assignees"], on_result=save_result,
+                                         concurrency=tenant.config["breezeway"].get("bulk-concurrency", 5))
+    if any(unit["id"] not in job["results"] for unit in job["units"]):
+        await retry_when_available(tenant, key, job, "Breezeway unavailable")
+
+    created = [unit for unit in job["units"] if "id" in job["results"].get(unit["id"], {})]
+    failed = [unit for unit in job["units"] if "id" not in job["results"].get(unit["id"], {})]
+    text = f"Created {len(created)} of {len(job['units'])} tasks: {job['title']}"
+    if failed:
+        text += "\nFailed for " + ", ".join(unit["name"] for unit in failed)
+
+    replies = [tenant.client.chat_postMessage(text=text, channel=metadata["channel"], thread_ts=metadata["reply-to"],
+                                              icon_emoji=":breezeway:")]
+    if created:
+        replies.append(tenant.client.reactions_add(channel=metadata["channel"], timestamp=metadata["react-to"],
+                                                   name="breezeway"))
+    await asyncio.gather(*replies)
+
+
+submission_stores = {}
+for tenant in tenants:
+    # Every tenant has its own queue and workers, so a big bulk job only holds up its own tenant's tasks
+    path = tenant.config["breezeway"].get("submission-queue")
+    if path and path not in submission_stores:
+        submission_stores[path] = SQLiteStore(get_file(path))
+    tenant.submissions = DurableQueue(
+        "breezeway-submissions" if single_tenant else f"breezeway-submissions:{tenant.name}",
+        functools.partial(create_breezeway_task, tenant), store=submission_stores.get(path),
+        workers=tenant.config["breezeway"].get("submission-workers", 4), shared=shared_state,
+        claim_ttl=config.get("shared-state", {}).get("claim-ttl", 3600))
 
 
 @slack.event("reaction_added")
+@metrics.timed
 async def handle_reaction_added_events():
     ...
 
 
 @slack.event("reaction_removed")
+@metrics.timed
 async def handle_reaction_removed_events(body):
-    logger.info(body)
+    logger.info("Reaction removed: %s",
+                logs.Payload(body["event"], fields=("user", "reaction", "item.channel", "item.ts")),
+                extra={"event_type": "reaction_removed"})
+
+
+commands = CommandRouter()
+# Message subtypes that can carry a command, as with slack.message() listeners
+COMMAND_SUBTYPES = (None, "bot_message", "thread_broadcast", "file_share")
 
 
 # When a user says Hi in a DM, say Hi back
-@slack.message(re.compile("^([Hh]i)|([Hh]ello)|([Hh]owdy)|(:wave:)"))
+@commands.command("^([Hh]i)|([Hh]ello)|([Hh]owdy)|(:wave:)")
+@metrics.timed
 async def greet(message, say):
-    channel_type = message["channel_type"]
-    if channel_type != "im":
-        return
-
     user_id = message["user"]
-    logger.info(f"{user_id} -> {slack.name}: {message['text']}")
+    logger.info("%s -> %s: %s", user_id, slack.name, logs.Payload(message["text"]))
     dm_channel = message["channel"]
 
     greeting = random.choice(["Hi!", "Hello.", "Howdy!", ":wave:"])
     await say(text=greeting, channel=dm_channel)
-    logger.info(f"{slack.name} -> {user_id}: {greeting}")
+    logger.info("%s -> %s: %s", slack.name, user_id, greeting)
 
 
 # When a user says joke, send a joke
-@slack.message(re.compile("^[jJ]oke$"))  # type: ignore
+@commands.command("^[jJ]oke$")
+@metrics.timed
 async def show_random_joke(message, say):
-    channel_type = message["channel_type"]
-    if channel_type != "im":
-        return
-
     user_id = message["user"]
-    logger.info(f"{user_id} -> {slack.name}: {message['text']}")
+    logger.info("%s -> %s: %s", user_id, slack.name, logs.Payload(message["text"]))
     dm_channel = message["channel"]
 
-    # TODO make async or remove
-    joke = pyjokes.get_joke("en", "all")
-    logger.info(f"{slack.name} -> {user_id}: {joke}")
+    joke = await executor.run_blocking(pyjokes.get_joke, "en", "all")
+    logger.info("%s -> %s: %s", slack.name, user_id, joke)
 
     await say(text=joke, channel=dm_channel)
 
 
 @slack.event("message")
-async def handle_message_events(body, ):
-    logger.info(body)
+@metrics.timed
+async def handle_message_events(body, say):
+    """Every message event comes through here. Only DMs are checked for commands, everything else is just logged."""
+    event = body["event"]
+    if event.get("channel_type") == "im" and event.get("subtype") in COMMAND_SUBTYPES \
+            and await commands.dispatch(event, say):
+        return
+    logger.info("Message event: %s", logs.Payload(event, fields=("subtype", "channel_type", "channel", "user",
+                                                                 "ts", "text")),
+                extra={"event_type": "message"})
+
+
+background_tasks = set()
+
+
+def run_in_background(coro):
+    """Start coro without waiting for it, keeping a reference until it is done"""
+    task = asyncio.create_task(coro)
+    background_tasks.add(task)
+    task.add_done_callback(background_tasks.discard)
+    return task
+
+
+metrics.slow_call_threshold = config.get("metrics", {}).get("slow-call-threshold")
+metrics.stats_per("tenant", "breezeway_cache_total", "Breezeway inventory cache lookups by result",
+                  lambda: {tenant.name: tenant.breezeway.cache.stats for tenant in tenants}, label="result")
+metrics.stats_per("tenant", "breezeway_calls_total",
+                  "Breezeway calls sent, and calls answered by one already in flight",
+                  lambda: {tenant.name: tenant.breezeway.stats for tenant in tenants})
+metrics.stats_per("tenant", "breezeway_scheduler_total", "Breezeway requests sent and retried by the scheduler",
+                  lambda: {tenant.name: tenant.breezeway.scheduler.stats for tenant in tenants})
+metrics.stats_per("tenant", "breezeway_circuit_total",
+                  "Times the Breezeway circuit breaker opened, and requests it refused",
+                  lambda: {tenant.name: tenant.breezeway.breaker.stats for tenant in tenants})
+metrics.stats_per("tenant", "breezeway_circuit_state", "State of the Breezeway circuit breaker: 1 for the current one",
+                  lambda: {tenant.name: {state: int(state == tenant.breezeway.breaker.state)
+                                         for state in ("closed", "open", "half-open")} for tenant in tenants},
+                  label="state", type="gauge")
+metrics.stats_per("tenant", "breezeway_share_in_use", "Slots of the Breezeway concurrency shared by tenants in use",
+                  lambda: {tenant.name: {"in-use": breezeway_share.holding(tenant.breezeway.name)}
+                           for tenant in tenants}, label="state", type="gauge")
+metrics.stats_per("tenant", "breezeway_submissions_total", "Task submissions by outcome",
+                  lambda: {tenant.name: tenant.submissions.stats for tenant in tenants})
+metrics.stats_per("tenant", "prvrbot_home_tab_total", "Home tab opens by whether the view was published",
+                  lambda: {tenant.name: tenant.home_tab.stats for tenant in tenants})
+metrics.stats_per("tenant", "breezeway_submissions_pending", "Task submissions waiting to be created",
+                  lambda: {tenant.name: {"pending": len(tenant.submissions)} for tenant in tenants},
+                  label="state", type="gauge")
+metrics_server = None
+
+
+async def authenticate(tenant: Tenant):
+    """Log in to the tenant's Breezeway. If it can't be reached the bot starts anyway, serving the inventory snapshot,
+    while the token manager keeps trying to log in."""
+    try:
+        if not await tenant.breezeway.authenticate():
+            logger.error(f"Could not log in to {tenant.breezeway.name}")
+    except UNAVAILABLE + (asyncio.TimeoutError,) as e:
+        logger.error(f"{tenant.breezeway.name} is unavailable at startup ({e}), serving cached units and people "
+                     f"until it is back")
+
+
+async def startup():
+    global metrics_server
+    loop_lag.start()
+    await executor.start()
+    if config.get("metrics", {}).get("enabled"):
+        metrics_server = await metrics.serve(config["metrics"].get("host", "0.0.0.0"),
+                                             config["metrics"].get("port", 9100))
+    for tenant in tenants:
+        await tenant.breezeway.start()
+    await asyncio.gather(*(authenticate(tenant) for tenant in tenants))
+    for tenant in tenants:
+        run_in_background(tenant.breezeway.warm())
+        await tenant.submissions.start()
+        await tenant.home_tab.start()
+    await jobs.start()
+
+
+async def shutdown():
+    await jobs.stop()
+    for task in list(background_tasks):
+        task.cancel()
+    for tenant in tenants:
+        await tenant.home_tab.stop()
+        await tenant.submissions.stop()
+        await tenant.breezeway.close()
+    await loop_lag.stop()
+    executor.shutdown()
+    if metrics_server is not None:
+        await metrics_server.cleanup()
+    if shared_state is not None:
+        await shared_state.close()
 
 
 async def main():
-    handler = AsyncSocketModeHandler(app=slack, app_token=config["slack"]["app-token"])
-    await breezeway.authenticate()
-    await handler.start_async()
+    # One Socket Mode connection per Slack app: tenants installed from an app of their own have its app-level token
+    app_tokens = dict.fromkeys(tenant.config["slack"]["app-token"] for tenant in tenants)
+    handlers = [AsyncSocketModeHandler(app=slack, app_token=app_token) for app_token in app_tokens]
+    await startup()
+    try:
+        await asyncio.gather(*(handler.start_async() for handler in handlers))
+    finally:
+        await shutdown()
+        log_listener.stop()
 
 
 if __name__ == "__main__":
-    import asyncio
-
-    asyncio.run(main())
+    # Executor processes would run this whole module again; prvrbot.py starts the bot without that
+    raise SystemExit("Start the bot with python3 prvrbot.py")
@@ -0,0 +1,187 @@
+from collections import Counter, OrderedDict, defaultdict
+from typing import Dict, Iterable, List, Optional, Sequence, Set, Tuple
+import re
+
+from fuzzywuzzy import fuzz
+
+from records import Unit
+
+try:
+    from rapidfuzz import fuzz as rapid_fuzz, process as rapid_process
+except ImportError:
+    rapid_fuzz = rapid_process = None
+
+
+def length_weight(name: str) -> float:
+    """Longer names are less likely to match by accident, so their score counts for a little more"""
+    return len(name) * 0.007 + 1
+
+
+class _Candidate:
+    __slots__ = ("unit", "name", "weight", "chars")
+
+    def __init__(self, unit: Unit):
+        self.unit = unit
+        self.name = unit.lower
+        self.weight = length_weight(unit.name)
+        # ("a", 1), ("a", 2) ... for every occurrence of every character in the name
+        self.chars = [(char, k) for char, n in Counter(self.name).items() for k in range(1, n + 1)]
+
+
+class UnitMatcher:
+    """Finds the unit a message is most likely about.
+
+    The score is fuzz.partial_ratio between the lowercased unit name and message, weighted by name length, and the
+    best scoring unit wins (ties go to the first name in sorted order). Names and their character counts are prepared
+    once. Each unit's score is bounded by how many of its characters also occur in the message, so units are scored
+    best bound first and the search stops as soon as no remaining bound can beat the best score found.
+
+    scorer selects the partial_ratio implementation: "fuzzywuzzy" gives exactly the scores of fuzzywuzzy, "rapidfuzz"
+    uses rapidfuzz's C implementation, scoring units of the same length together with process.extractOne. Its
+    partial_ratio finds the optimal alignment, so scores can be slightly higher than fuzzywuzzy's."""
+
+    def __init__(self, units: Iterable[Unit] = (), scorer: str = "fuzzywuzzy"):
+        if scorer not in ("fuzzywuzzy", "rapidfuzz"):
+            raise ValueError(f"Unknown scorer {scorer}")
+        if scorer == "rapidfuzz" and rapid_process is None:
+            raise ValueError("The rapidfuzz scorer needs the rapidfuzz package installed")
+        self.__scorer = scorer
+        self.__candidates: Dict[object, _Candidate] = {}
+        self.__occurrences: Dict[Tuple[str, int], Set[object]] = defaultdict(set)
+        for unit in units:
+            self.add(unit)
+
+    def __len__(self):
+        return len(self.__candidates)
+
+    def add(self, unit: Unit):
+        self.remove(unit.id)
+        self.__candidates[unit.id] = candidate = _Candidate(unit)
+        for occurrence in candidate.chars:
+            self.__occurrences[occurrence].add(unit.id)
+
+    def remove(self, unit_id):
+        candidate = self.__candidates.pop(unit_id, None)
+        if candidate is None:
+            return
+        for occurrence in candidate.chars:
+            self.__occurrences[occurrence].discard(unit_id)
+            if not self.__occurrences[occurrence]:
+                del self.__occurrences[occurrence]
+
+    def match(self, text: str, threshold: float = 0) -> Optional[Tuple[Unit, float]]:
+        """Return (unit, weighted score) of the best match scoring more than threshold, or None"""
+        text = text.lower()
+        if not text:
+            return None
+        text_chars = Counter(text)
+
+        # Count, per unit, the characters of its name that the message doesn't have enough of
+        missing = Counter()
+        for (char, k), unit_ids in self.__occurrences.items():
+            if k > text_chars[char]:
+                missing.update(unit_ids)
+
+        bounded = []
+        for unit_id, candidate in self.__candidates.items():
+            overlap = len(candidate.name) - missing[unit_id]
+            shorter = min(len(candidate.name), len(text))
+            # partial_ratio is 2 * matches / (len(shorter) + len(window)), and matches can't exceed overlap
+            bound = (200 * overlap / (shorter + overlap) + 0.5) * candidate.weight if overlap else 0
+            if bound > threshold:
+                bounded.append((bound, candidate))
+
+        if self.__scorer == "rapidfuzz":
+            return self.__match_grouped(text, bounded, threshold)
+
+        bounded.sort(key=lambda entry: entry[0], reverse=True)
+        best: Optional[_Candidate] = None
+        best_ratio = threshold
+        for bound, candidate in bounded:
+            if bound < best_ratio:
+                break
+            ratio = fuzz.partial_ratio(candidate.name, text) * candidate.weight
+            if ratio > best_ratio or (ratio == best_ratio and best is not None and _before(candidate, best)):
+                best, best_ratio = candidate, ratio
+
+        return (best.unit, best_ratio) if best is not None else None
+
+    @staticmethod
+    def __match_grouped(text: str, bounded: List[Tuple[float, _Candidate]], threshold: float):
+        groups: Dict[float, List[Tuple[float, _Candidate]]] = {}
+        for bound, candidate in bounded:
+            groups.setdefault(candidate.weight, []).append((bound, candidate))
+
+        best: Optional[_Candidate] = None
+        best_ratio = threshold
+        for weight, group in sorted(groups.items(), key=lambda item: item[0], reverse=True):
+            if max(bound for bound, _ in group) < best_ratio:
+                continue
+            group.sort(key=lambda entry: _sort_key(entry[1]))
+            found = rapid_process.extractOne(text, [candidate.name for _, candidate in group],
+                                             scorer=rapid_fuzz.partial_ratio, processor=None,
+                                             score_cutoff=best_ratio / weight)
+            if found is None:
+                continue
+            candidate = group[found[2]][1]
+            ratio = found[1] * weight
+            if ratio > best_ratio or (ratio == best_ratio and best is not None and _before(candidate, best)):
+                best, best_ratio = candidate, ratio
+
+        return (best.unit, best_ratio) if best is not None else None
+
+
+def _sort_key(candidate: _Candidate):
+    return candidate.unit.name
+
+
+def _before(a: _Candidate, b: _Candidate) -> bool:
+    return _sort_key(a) < _sort_key(b)
+
+
+# How many matchers a pool process keeps, by the key their units were sent under: two versions (while a sync rolls
+# out) for each of a few clients
+MATCHERS_PER_PROCESS = 8
+_process_matchers: "OrderedDict[str, UnitMatcher]" = OrderedDict()
+NEED_UNITS = "need-units"
+
+
+def match_in_process(key: str, text: str, threshold: float = 0, scorer: str = "fuzzywuzzy",
+                     units: Optional[Sequence[Tuple[object, str]]] = None):
+    """UnitMatcher.match, for running in a process pool. Returns (unit id, score) instead of the unit.
+
+    A pool process keeps the matchers it built for the last few keys, so units ((id, name) pairs) only have to be
+    sent when it returns NEED_UNITS because it hasn't seen key before."""
+    matcher = _process_matchers.get(key)
+    if matcher is None:
+        if units is None:
+            return NEED_UNITS
+        matcher = _process_matchers[key] = UnitMatcher((Unit(id, name) for id, name in units), scorer=scorer)
+        while len(_process_matchers) > MATCHERS_PER_PROCESS:
+            _process_matchers.popitem(last=False)
+    _process_matchers.move_to_end(key)
+    found = matcher.match(text, threshold)
+    return None if found is None else (found[0].id, found[1])
+
+
+def update_in_process(key: str, new_key: str, units: Sequence[Tuple[object, str]],
+                      removed_ids: Sequence[object]) -> bool:
+    """Turn this pool process's matcher for key into the one for new_key, adding units ((id, name) pairs, replacing
+    those with the same id) and removing removed_ids. False if the process has no matcher for key."""
+    matcher = _process_matchers.pop(key, None)
+    if matcher is None:
+        return False
+    for unit_id in removed_ids:
+        matcher.remove(unit_id)
+    for unit_id, name in units:
+        matcher.add(Unit(unit_id, name))
+    _process_matchers[new_key] = matcher
+    return True
+
+
+def names_matching(names: Sequence[str], pattern: str) -> List[int]:
+    """Positions of the names pattern matches, ignoring case. A pattern from a user can take practically forever on
+    some names, without letting other threads run meanwhile, so run this where it can be killed
+    (Executor.run_isolated)."""
+    compiled = re.compile(pattern, re.IGNORECASE)
+    return [i for i, name in enumerate(names) if compiled.search(name)]
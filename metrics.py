@@ -0,0 +1,236 @@
+from typing import Callable, Dict, Iterable, Mapping, Optional, Sequence, Tuple
+import functools
+import logging
+import time
+
+from aiohttp import web
+
+# Calls slower than this many seconds are logged as warnings. None disables it.
+slow_call_threshold: Optional[float] = None
+
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+
+
+def _escape(value) -> str:
+    return str(value).replace("\\", "\\\\").replace("\"", "\\\"").replace("\n", "\\n")
+
+
+def _labels(names: Sequence[str], values: Sequence) -> str:
+    if not names:
+        return ""
+    return "{" + ",".join(f"{name}=\"{_escape(value)}\"" for name, value in zip(names, values)) + "}"
+
+
+class Metric:
+    type = "untyped"
+
+    def __init__(self, name: str, documentation: str, labelnames: Sequence[str] = ()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+
+    def _key(self, labels: Mapping[str, object]) -> Tuple:
+        return tuple(labels.get(name, "") for name in self.labelnames)
+
+    def samples(self) -> Iterable[Tuple[str, str, float]]:
+        """(name suffix, rendered labels, value) for every time series"""
+        return ()
+
+    def render(self) -> str:
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} {self.type}"]
+        lines.extend(f"{self.name}{suffix}{labels} {value!r}" for suffix, labels, value in self.samples())
+        return "\n".join(lines)
+
+
+class Counter(Metric):
+    type = "counter"
+
+    def __init__(self, name: str, documentation: str, labelnames: Sequence[str] = ()):
+        super().__init__(name, documentation, labelnames)
+        self.__values: Dict[Tuple, float] = {}
+
+    def inc(self, amount: float = 1, **labels):
+        key = self._key(labels)
+        self.__values[key] = self.__values.get(key, 0) + amount
+
+    def samples(self):
+        for key, value in self.__values.items():
+            yield "", _labels(self.labelnames, key), value
+
+
+class Gauge(Metric):
+    type = "gauge"
+
+    def __init__(self, name: str, documentation: str, labelnames: Sequence[str] = ()):
+        super().__init__(name, documentation, labelnames)
+        self.__values: Dict[Tuple, float] = {}
+
+    def set(self, value: float, **labels):
+        self.__values[self._key(labels)] = value
+
+    def inc(self, amount: float = 1, **labels):
+        key = self._key(labels)
+        self.__values[key] = self.__values.get(key, 0) + amount
+
+    def dec(self, amount: float = 1, **labels):
+        self.inc(-amount, **labels)
+
+    def total(self) -> float:
+        """The sum over every label set"""
+        return sum(self.__values.values())
+
+    def samples(self):
+        for key, value in self.__values.items():
+            yield "", _labels(self.labelnames, key), value
+
+
+class Histogram(Metric):
+    type = "histogram"
+
+    def __init__(self, name: str, documentation: str, labelnames: Sequence[str] = (),
+                 buckets: Sequence[float] = DEFAULT_BUCKETS):
+        super().__init__(name, documentation, labelnames)
+        self.buckets = tuple(sorted(buckets))
+        self.__counts: Dict[Tuple, list] = {}
+        self.__sums: Dict[Tuple, float] = {}
+
+    def observe(self, value: float, **labels):
+        key = self._key(labels)
+        counts = self.__counts.setdefault(key, [0] * (len(self.buckets) + 1))
+        for i, bound in enumerate(self.buckets):
+            if value <= bound:
+                counts[i] += 1
+                break
+        else:
+            counts[-1] += 1
+        self.__sums[key] = self.__sums.get(key, 0) + value
+
+    def samples(self):
+        for key, counts in self.__counts.items():
+            total = 0
+            for bound, count in zip(self.buckets + (float("inf"),), counts):
+                total += count
+                le = "+Inf" if bound == float("inf") else f"{bound:g}"
+                yield "_bucket", _labels(self.labelnames + ("le",), key + (le,)), total
+            yield "_sum", _labels(self.labelnames, key), self.__sums[key]
+            yield "_count", _labels(self.labelnames, key), total
+
+
+class Callback(Metric):
+    """A metric read at scrape time. fn returns {label value tuple: value}."""
+
+    def __init__(self, name: str, documentation: str, fn: Callable[[], Mapping[Tuple, float]],
+                 labelnames: Sequence[str] = (), type: str = "gauge"):
+        super().__init__(name, documentation, labelnames)
+        self.type = type
+        self.__fn = fn
+
+    def samples(self):
+        for key, value in self.__fn().items():
+            yield "", _labels(self.labelnames, key), value
+
+
+class Registry:
+
+    def __init__(self):
+        self.__metrics: Dict[str, Metric] = {}
+
+    def register(self, metric: Metric) -> Metric:
+        """Register metric, or return the one already registered under its name"""
+        return self.__metrics.setdefault(metric.name, metric)
+
+    def render(self) -> str:
+        return "\n".join(metric.render() for metric in self.__metrics.values()) + "\n"
+
+
+registry = Registry()
+
+
+def counter(name: str, documentation: str, labelnames: Sequence[str] = ()) -> Counter:
+    return registry.register(Counter(name, documentation, labelnames))
+
+
+def gauge(name: str, documentation: str, labelnames: Sequence[str] = ()) -> Gauge:
+    return registry.register(Gauge(name, documentation, labelnames))
+
+
+def histogram(name: str, documentation: str, labelnames: Sequence[str] = (),
+              buckets: Sequence[float] = DEFAULT_BUCKETS) -> Histogram:
+    return registry.register(Histogram(name, documentation, labelnames, buckets))
+
+
+def stats(name: str, documentation: str, values: Callable[[], Mapping[str, float]], label: str = "event",
+          type: str = "counter", **constant_labels) -> Callback:
+    """Expose a stats dict (like AsyncApp.stats) as one time series per key"""
+    labelnames = tuple(constant_labels) + (label,)
+    constants = tuple(constant_labels.values())
+    return registry.register(Callback(name, documentation,
+                                      lambda: {constants + (key,): value for key, value in values().items()},
+                                      labelnames, type))
+
+
+def stats_per(group: str, name: str, documentation: str, values: Callable[[], Mapping[str, Mapping[str, float]]],
+              label: str = "event", type: str = "counter") -> Callback:
+    """Like stats, for one stats dict per member of a group (e.g. per tenant). values returns {member: stats dict},
+    and every series is labelled with its member under group."""
+    return registry.register(Callback(name, documentation,
+                                      lambda: {(member, key): value for member, member_values in values().items()
+                                               for key, value in member_values.items()},
+                                      (group, label), type))
+
+
+def log_if_slow(what: str, elapsed: float):
+    if slow_call_threshold is not None and elapsed >= slow_call_threshold:
+        logging.warning(f"Slow call: {what} took {elapsed:.3f}s")
+
+
+HANDLER_SECONDS = histogram("prvrbot_handler_seconds", "Time spent in each Slack listener and queue handler",
+                            ("handler",))
+HANDLER_CALLS = counter("prvrbot_handler_calls_total", "Listener and handler calls by outcome", ("handler", "outcome"))
+HANDLER_IN_FLIGHT = gauge("prvrbot_handler_in_flight", "Listener and handler calls in progress", ("handler",))
+
+
+def timed(func):
+    """Record latency, outcome and in-flight count of a listener. Bolt still sees the listener's own arguments."""
+    handler = func.__name__
+
+    @functools.wraps(func)
+    async def wrapper(*args, **kwargs):
+        HANDLER_IN_FLIGHT.inc(handler=handler)
+        started = time.perf_counter()
+        outcome = "ok"
+        try:
+            return await func(*args, **kwargs)
+        except BaseException:
+            outcome = "error"
+            raise
+        finally:
+            elapsed = time.perf_counter() - started
+            HANDLER_IN_FLIGHT.dec(handler=handler)
+            HANDLER_SECONDS.observe(elapsed, handler=handler)
+            HANDLER_CALLS.inc(handler=handler, outcome=outcome)
+            log_if_slow(handler, elapsed)
+
+    return wrapper
+
+
+def in_flight() -> int:
+    """How many timed listener and handler calls are in progress. Unlike the middleware chain, which Bolt leaves as
+    soon as a listener acks, this counts listeners until they finish."""
+    return int(HANDLER_IN_FLIGHT.total())
+
+
+async def serve(host: str = "0.0.0.0", port: int = 9100) -> web.AppRunner:
+    """Serve the registry in Prometheus text format at /metrics on the running event loop"""
+
+    async def handle(request: web.Request):
+        return web.Response(text=registry.render(), content_type="text/plain", charset="utf-8",
+                            headers={"X-Content-Type-Options": "nosniff"})
+
+    app = web.Application()
+    app.router.add_get("/metrics", handle)
+    runner = web.AppRunner(app, access_log=None)
+    await runner.setup()
+    await web.TCPSite(runner, host, port).start()
+    logging.info(f"Serving metrics on {host}:{port}")
+    return runner
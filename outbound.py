@@ -0,0 +1,297 @@
+from email.utils import parsedate_to_datetime
+from collections import defaultdict, deque
+from typing import Any, Awaitable, Callable, Collection, Deque, Dict, List, Mapping, Optional, Tuple
+import asyncio
+import contextvars
+import heapq
+import itertools
+import logging
+import random
+import time
+
+import aiohttp
+
+INTERACTIVE = 0
+BACKGROUND = 1
+
+# Priority of the requests made from the current task. Background jobs set this to BACKGROUND so anything a user is
+# waiting on gets ahead of them.
+request_priority = contextvars.ContextVar("request_priority", default=INTERACTIVE)
+
+RETRY_STATUSES = frozenset({429, 500, 502, 503, 504})
+
+
+class TokenBucket:
+    """Allows rate requests per second on average, with bursts of up to burst requests. A rate of 0 disables it."""
+
+    def __init__(self, rate: float, burst: int):
+        self.__rate = rate
+        self.__burst = burst
+        self.__tokens = float(burst)
+        self.__updated = time.monotonic()
+        self.__lock = asyncio.Lock()
+
+    async def acquire(self):
+        if self.__rate <= 0:
+            return
+        async with self.__lock:
+            while True:
+                now = time.monotonic()
+                self.__tokens = min(self.__burst, self.__tokens + (now - self.__updated) * self.__rate)
+                self.__updated = now
+                if self.__tokens >= 1:
+                    self.__tokens -= 1
+                    return
+                await asyncio.sleep((1 - self.__tokens) / self.__rate)
+
+
+class PrioritySemaphore:
+    """A semaphore whose waiters are woken lowest priority value first, then in arrival order"""
+
+    def __init__(self, value: int):
+        self.__value = value
+        self.__waiters: List[Tuple[int, int, asyncio.Future]] = []
+        self.__counter = itertools.count()
+
+    def waiting(self) -> int:
+        return len(self.__waiters)
+
+    async def acquire(self, priority: int = INTERACTIVE):
+        if self.__value > 0 and not self.__waiters:
+            self.__value -= 1
+            return
+
+        waiter = asyncio.get_running_loop().create_future()
+        heapq.heappush(self.__waiters, (priority, next(self.__counter), waiter))
+        try:
+            await waiter
+        except asyncio.CancelledError:
+            if waiter.done() and not waiter.cancelled():
+                # Woken up and cancelled before getting to run, pass the slot on
+                self.release()
+            raise
+
+    def release(self):
+        while self.__waiters:
+            _, _, waiter = heapq.heappop(self.__waiters)
+            if not waiter.done():
+                waiter.set_result(None)
+                return
+        self.__value += 1
+
+
+class FairShare:
+    """A concurrency limit shared by several users (tenants), handing out freed slots fairly.
+
+    At most total holders at once. When slots are short, a freed one goes to the waiting user holding the fewest,
+    so a user with a burst of work gets its share but can't keep the others waiting."""
+
+    def __init__(self, total: int):
+        self.__total = total
+        self.__held = 0
+        self.__holding: Dict[str, int] = defaultdict(int)
+        self.__waiters: Dict[str, Deque[Tuple[int, asyncio.Future]]] = defaultdict(deque)
+        self.__counter = itertools.count()
+
+    def holding(self, user: str) -> int:
+        return self.__holding[user]
+
+    async def acquire(self, user: str):
+        if self.__held < self.__total and not any(self.__waiters.values()):
+            self.__grant(user)
+            return
+
+        waiter = asyncio.get_running_loop().create_future()
+        entry = (next(self.__counter), waiter)
+        self.__waiters[user].append(entry)
+        try:
+            await waiter
+        except asyncio.CancelledError:
+            if waiter.done() and not waiter.cancelled():
+                # Granted and cancelled before getting to run, pass the slot on
+                self.release(user)
+            elif entry in self.__waiters[user]:
+                # Otherwise __wake() may have dropped it already, skipping it as cancelled
+                self.__waiters[user].remove(entry)
+            raise
+
+    def release(self, user: str):
+        self.__held -= 1
+        self.__holding[user] -= 1
+        self.__wake()
+
+    def __grant(self, user: str):
+        self.__held += 1
+        self.__holding[user] += 1
+
+    def __wake(self):
+        while self.__held < self.__total:
+            waiting = [user for user, waiters in self.__waiters.items() if waiters]
+            if not waiting:
+                return
+            # Fewest slots held first, then whoever has waited longest
+            user = min(waiting, key=lambda user: (self.__holding[user], self.__waiters[user][0][0]))
+            _, waiter = self.__waiters[user].popleft()
+            if not waiter.done():
+                self.__grant(user)
+                waiter.set_result(None)
+
+
+def retry_after(headers: Mapping[str, str]) -> Optional[float]:
+    """Seconds to wait according to a Retry-After header, given either as seconds or as an HTTP date"""
+    value = headers.get("Retry-After")
+    if value is None:
+        return None
+    try:
+        return max(0.0, float(value))
+    except ValueError:
+        pass
+    try:
+        return max(0.0, parsedate_to_datetime(value).timestamp() - time.time())
+    except (TypeError, ValueError):
+        return None
+
+
+class CircuitOpenError(Exception):
+    """Raised instead of sending a request while the circuit breaker is open"""
+
+
+class CircuitBreaker:
+    """Stops sending requests to a service that keeps failing, so callers fail fast instead of each waiting for it
+    to time out.
+
+    After failure_threshold failures in a row (connection errors, timeouts and 5xx responses) the breaker opens and
+    requests are refused with CircuitOpenError. reset_timeout seconds later it is half-open: up to probes requests
+    are let through, and a success closes the breaker again while a failure keeps it open for another
+    reset_timeout."""
+
+    CLOSED, OPEN, HALF_OPEN = "closed", "open", "half-open"
+
+    def __init__(self, name: str, failure_threshold: int = 5, reset_timeout: float = 30, probes: int = 1):
+        self.__name = name
+        self.__failure_threshold = failure_threshold
+        self.__reset_timeout = reset_timeout
+        self.__probes = probes
+        self.__failures = 0
+        self.__opened_at: Optional[float] = None
+        self.__probing = 0
+        self.stats = {"opened": 0, "rejected": 0}
+
+    @property
+    def state(self) -> str:
+        if self.__opened_at is None:
+            return self.CLOSED
+        if self.retry_in() > 0:
+            return self.OPEN
+        return self.HALF_OPEN
+
+    def retry_in(self) -> float:
+        """Seconds until the breaker lets a probe through, 0 if it would now"""
+        if self.__opened_at is None:
+            return 0
+        return max(0.0, self.__opened_at + self.__reset_timeout - time.monotonic())
+
+    def before(self) -> bool:
+        """Call before sending a request. Raises CircuitOpenError if it may not be sent, and returns whether it is a
+        probe. Every call that doesn't raise must be followed by after()."""
+        state = self.state
+        if state == self.CLOSED:
+            return False
+        if state == self.HALF_OPEN and self.__probing < self.__probes:
+            self.__probing += 1
+            return True
+        self.stats["rejected"] += 1
+        raise CircuitOpenError(f"{self.__name} is unavailable, trying again in {self.retry_in():.0f}s")
+
+    def after(self, succeeded: Optional[bool], probe: bool):
+        """Record how a request went. succeeded is None for one that was abandoned before getting an answer."""
+        if probe:
+            self.__probing -= 1
+        if succeeded is None:
+            return
+        if succeeded:
+            if self.__opened_at is not None:
+                logging.info(f"{self.__name} is back, closing the circuit")
+            self.__failures = 0
+            self.__opened_at = None
+            return
+        self.__failures += 1
+        if probe or (self.__opened_at is None and self.__failures >= self.__failure_threshold):
+            if self.__opened_at is None:
+                self.stats["opened"] += 1
+                logging.warning(f"{self.__name} failed {self.__failures} times in a row, opening the circuit for "
+                                f"{self.__reset_timeout:.0f}s")
+            self.__opened_at = time.monotonic()
+
+
+class RequestScheduler:
+    """Runs outbound requests under a rate limit and a concurrency cap, retrying failures.
+
+    Requests wait for a free slot in priority order (see request_priority) and then for the rate limiter. Responses
+    with a status in retry_statuses and connection errors are retried up to retries times with jittered exponential
+    backoff, waiting at least as long as the server's Retry-After says. The slot is given up while backing off.
+
+    With a breaker, every attempt goes through it, and once it opens the remaining retries are given up. With a
+    share, attempts also need one of its slots, held as share_key, so schedulers of different tenants split it
+    fairly."""
+
+    def __init__(self, rate: float = 10, burst: int = 20, concurrency: int = 8, retries: int = 3,
+                 backoff_base: float = 0.5, backoff_max: float = 30, breaker: Optional[CircuitBreaker] = None,
+                 share: Optional[FairShare] = None, share_key: str = ""):
+        self.__bucket = TokenBucket(rate, burst)
+        self.__slots = PrioritySemaphore(concurrency)
+        self.__retries = retries
+        self.__backoff_base = backoff_base
+        self.__backoff_max = backoff_max
+        self.__breaker = breaker
+        self.__share = share
+        self.__share_key = share_key
+        self.stats = {"sent": 0, "retried": 0}
+
+    def backoff(self, attempt: int) -> float:
+        return random.uniform(0, min(self.__backoff_max, self.__backoff_base * 2 ** attempt))
+
+    async def run(self, send: Callable[[], Awaitable[Tuple[int, Any, Mapping[str, str]]]],
+                  retry_statuses: Collection[int] = RETRY_STATUSES, retry_errors: bool = True,
+                  priority: Optional[int] = None) -> Tuple[int, Any]:
+        """send() performs one attempt and returns (status, body, headers). Returns the final (status, body)."""
+        priority = request_priority.get() if priority is None else priority
+        attempt = 0
+        while True:
+            await self.__slots.acquire(priority)
+            if self.__share is not None:
+                try:
+                    await self.__share.acquire(self.__share_key)
+                except BaseException:
+                    self.__slots.release()
+                    raise
+            probe = None
+            succeeded = None
+            try:
+                if self.__breaker is not None:
+                    probe = self.__breaker.before()
+                await self.__bucket.acquire()
+                self.stats["sent"] += 1
+                status, body, headers = await send()
+            except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+                succeeded = False
+                if not retry_errors or attempt >= self.__retries:
+                    raise
+                delay = self.backoff(attempt)
+                logging.warning(f"Request failed ({e!r}), retrying in {delay:.1f}s")
+            else:
+                succeeded = status < 500
+                if status not in retry_statuses or attempt >= self.__retries:
+                    return status, body
+                delay = max(self.backoff(attempt), retry_after(headers) or 0)
+                logging.warning(f"Request got HTTP {status}, retrying in {delay:.1f}s")
+            finally:
+                self.__slots.release()
+                if self.__share is not None:
+                    self.__share.release(self.__share_key)
+                if probe is not None:
+                    self.__breaker.after(succeeded, probe)
+
+            self.stats["retried"] += 1
+            attempt += 1
+            await asyncio.sleep(delay)
@@ -0,0 +1,11 @@
+"""Starts the bot: python3 prvrbot.py
+
+The bot itself is set up when main is imported. Executor processes import the script the bot was started from, so
+that script is kept to this, and they don't set up a second bot of their own."""
+
+if __name__ == "__main__":
+    import asyncio
+
+    import main
+
+    asyncio.run(main.main())
@@ -0,0 +1,56 @@
+import sys
+
+from search import normalize
+
+
+class Unit:
+    """A Breezeway property, keeping only the fields the bot uses.
+
+    Names are interned, so reloading the same units doesn't keep a second copy of every string, and the forms used
+    for sorting, filtering and searching are worked out once when the record is built."""
+    __slots__ = ("id", "name", "lower", "search_name")
+
+    def __init__(self, id: int, name: str):
+        self.id = id
+        self.name = sys.intern(name)
+        self.lower = sys.intern(name.lower())
+        self.search_name = sys.intern(normalize(name))
+
+    @classmethod
+    def from_json(cls, data: dict) -> "Unit":
+        return cls(data["id"], data.get("name") or "")
+
+    def to_json(self) -> dict:
+        return {"id": self.id, "name": self.name}
+
+    @property
+    def sort_key(self) -> str:
+        return self.name
+
+    def __repr__(self):
+        return f"Unit({self.id!r}, {self.name!r})"
+
+
+class Person:
+    """A Breezeway staff member, with the short name shown in assignee lists ("Ana B.")"""
+    __slots__ = ("id", "first_name", "last_name", "label")
+
+    def __init__(self, id: int, first_name: str, last_name: str):
+        self.id = id
+        self.first_name = sys.intern(first_name)
+        self.last_name = sys.intern(last_name)
+        self.label = f"{first_name} {last_name[:1]}."
+
+    @classmethod
+    def from_json(cls, data: dict) -> "Person":
+        return cls(data["id"], data.get("first_name") or "", data.get("last_name") or "")
+
+    def to_json(self) -> dict:
+        return {"id": self.id, "first_name": self.first_name, "last_name": self.last_name}
+
+    @property
+    def sort_key(self) -> str:
+        return self.first_name
+
+    def __repr__(self):
+        return f"Person({self.id!r}, {self.first_name!r}, {self.last_name!r})"
@@ -0,0 +1,50 @@
+from typing import Awaitable, Callable, Dict, List, Optional, Tuple
+import re
+
+Handler = Callable[..., Awaitable[None]]
+
+
+class CommandRouter:
+    """Dispatches a message to the first command whose pattern matches its text.
+
+    Patterns are searched for in the text like Bolt's slack.message(keyword) listeners, and when several match, the one
+    registered first wins, as with listeners. All patterns are compiled into one alternation, so a message that is no
+    command (most of them) is rejected in a single scan however many commands there are. Only when the leftmost match
+    belongs to a later command are the commands registered before it checked on their own."""
+
+    def __init__(self):
+        self.__commands: List[Tuple[str, re.Pattern, Handler]] = []
+        self.__positions: Dict[str, int] = {}
+        self.__pattern: Optional[re.Pattern] = None
+
+    def command(self, pattern: str):
+        """Decorator registering handler(message, say) for messages matching pattern"""
+        def register(handler: Handler) -> Handler:
+            # Groups are named by position, so patterns can't clash over group names
+            name = f"command{len(self.__commands)}"
+            self.__positions[name] = len(self.__commands)
+            self.__commands.append((name, re.compile(pattern), handler))
+            self.__pattern = re.compile("|".join(f"(?P<{name}>{command.pattern})"
+                                                 for name, command, _ in self.__commands))
+            return handler
+        return register
+
+    def match(self, text: str) -> Optional[Handler]:
+        if self.__pattern is None or not text:
+            return None
+        found = self.__pattern.search(text)
+        if found is None:
+            return None
+        position = self.__positions[found.lastgroup]
+        for _, command, handler in self.__commands[:position]:
+            if command.search(text):
+                return handler
+        return self.__commands[position][2]
+
+    async def dispatch(self, message: dict, say) -> bool:
+        """Run the command for message, if any. Returns whether one ran."""
+        handler = self.match(message.get("text", ""))
+        if handler is None:
+            return False
+        await handler(message, say)
+        return True
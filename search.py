@@ -0,0 +1,130 @@
+from bisect import bisect_left
+from collections import OrderedDict, defaultdict
+from typing import TYPE_CHECKING, Dict, Iterable, List, Optional, Set, Tuple
+
+if TYPE_CHECKING:
+    from records import Unit
+
+
+def normalize(text: str) -> str:
+    """Case-fold and collapse whitespace so "Sea  Breeze" and "sea breeze" compare equal"""
+    return " ".join(text.casefold().split())
+
+
+def trigrams(text: str) -> Set[str]:
+    return {text[i:i + 3] for i in range(len(text) - 2)}
+
+
+def word_starts(name: str) -> List[int]:
+    return [0] + [i + 1 for i, char in enumerate(name) if char == " "]
+
+
+class UnitIndex:
+    """In-memory type-ahead index over unit names.
+
+    Names are normalized once and kept in two sorted lists, one of whole names and one of every word-to-end suffix,
+    so prefix matches are found by bisection. Only when those don't fill the result are the remaining substring
+    matches looked up through a trigram index. Recent queries are memoized, and when the user types another character
+    the previous query's substring matches are narrowed down instead of searching again."""
+
+    def __init__(self, units: Iterable["Unit"] = (), memo_size: int = 256):
+        self.__units: Dict[object, "Unit"] = {}
+        self.__names: Dict[object, str] = {}
+        self.__sorted_names: List[Tuple[str, object]] = []
+        self.__sorted_words: List[Tuple[str, str, object]] = []
+        self.__trigrams: Dict[str, Set[object]] = defaultdict(set)
+        self.__memo: "OrderedDict[str, Tuple[int, Optional[List[object]], List[Unit]]]" = OrderedDict()
+        self.__memo_size = memo_size
+
+        for unit in units:
+            self.__units[unit.id] = unit
+            self.__names[unit.id] = name = unit.search_name
+            self.__sorted_names.append((name, unit.id))
+            self.__sorted_words.extend((name[i:], name, unit.id) for i in word_starts(name)[1:])
+            for gram in trigrams(name):
+                self.__trigrams[gram].add(unit.id)
+        self.__sorted_names.sort(key=lambda entry: entry[0])
+        self.__sorted_words.sort(key=lambda entry: entry[:2])
+
+    def __len__(self):
+        return len(self.__units)
+
+    def updated(self, changed: Iterable["Unit"], removed_ids: Iterable[object]) -> "UnitIndex":
+        """A copy of this index with changed units added (replacing those with the same id) and removed_ids removed.
+        This one is left as it is, so it can keep serving searches while the copy is made in another thread. Takes
+        time in proportion to the size of the index, not to the number of changes."""
+        changed = list(changed)
+        gone = set(removed_ids) | {unit.id for unit in changed}
+        index = UnitIndex(memo_size=self.__memo_size)
+        index.__units = {unit_id: unit for unit_id, unit in self.__units.items() if unit_id not in gone}
+        index.__names = {unit_id: name for unit_id, name in self.__names.items() if unit_id not in gone}
+        index.__sorted_names = [entry for entry in self.__sorted_names if entry[1] not in gone]
+        index.__sorted_words = [entry for entry in self.__sorted_words if entry[2] not in gone]
+        for gram, postings in self.__trigrams.items():
+            kept = postings - gone
+            if kept:
+                index.__trigrams[gram] = kept
+        for unit in changed:
+            index.__units[unit.id] = unit
+            index.__names[unit.id] = name = unit.search_name
+            index.__sorted_names.append((name, unit.id))
+            index.__sorted_words.extend((name[i:], name, unit.id) for i in word_starts(name)[1:])
+            for gram in trigrams(name):
+                index.__trigrams[gram].add(unit.id)
+        # Sorted runs with a few entries appended, which sort() merges in about linear time
+        index.__sorted_names.sort(key=lambda entry: entry[0])
+        index.__sorted_words.sort(key=lambda entry: entry[:2])
+        return index
+
+    def search(self, query: str, limit: int = 100) -> List["Unit"]:
+        """Units whose name contains query, best first: names starting with it, then names with a word starting with
+        it, then any other match."""
+        query = normalize(query)
+        if query in self.__memo:
+            self.__memo.move_to_end(query)
+            memo_limit, _, result = self.__memo[query]
+            if limit <= memo_limit:
+                return result[:limit]
+
+        seen = set()
+        result = []
+        for unit_id in self.__prefix_matches(query):
+            if len(result) >= limit:
+                break
+            if unit_id not in seen:
+                seen.add(unit_id)
+                result.append(self.__units[unit_id])
+
+        substring_ids = None
+        if len(result) < limit:
+            substring_ids = [unit_id for unit_id in self.__candidates(query) if query in self.__names[unit_id]]
+            rest = sorted((unit_id for unit_id in substring_ids if unit_id not in seen), key=self.__names.__getitem__)
+            result.extend(self.__units[unit_id] for unit_id in rest[:limit - len(result)])
+
+        self.__memo[query] = (limit, substring_ids, result)
+        if len(self.__memo) > self.__memo_size:
+            self.__memo.popitem(last=False)
+        return result
+
+    def __prefix_matches(self, query: str) -> Iterable[object]:
+        i = bisect_left(self.__sorted_names, query, key=lambda entry: entry[0])
+        while i < len(self.__sorted_names) and self.__sorted_names[i][0].startswith(query):
+            yield self.__sorted_names[i][1]
+            i += 1
+
+        i = bisect_left(self.__sorted_words, query, key=lambda entry: entry[0])
+        while i < len(self.__sorted_words) and self.__sorted_words[i][0].startswith(query):
+            yield self.__sorted_words[i][2]
+            i += 1
+
+    def __candidates(self, query: str) -> Iterable[object]:
+        for end in range(len(query) - 1, 0, -1):
+            substring_ids = self.__memo.get(query[:end], (0, None))[1]
+            if substring_ids is not None:
+                return substring_ids
+
+        grams = trigrams(query)
+        if not grams:
+            return self.__units.keys()
+        postings = sorted((self.__trigrams.get(gram, set()) for gram in grams), key=len)
+        return set.intersection(*postings)
@@ -0,0 +1,81 @@
+from abc import ABC, abstractmethod
+from typing import Optional, Tuple
+import asyncio
+import os
+import socket
+import time
+
+from store import SQLiteStore
+
+
+def replica_id() -> str:
+    """Identifies this process among the bot's replicas"""
+    return f"{socket.gethostname()}:{os.getpid()}"
+
+
+class SharedState(ABC):
+    """State shared between the bot's replicas: values that any replica can read and write, and claims that only one
+    replica at a time can hold.
+
+    Values are bytes grouped into namespaces, and come back with the time they were written. A claim is held by
+    owner until it expires or is released, so a replica that dies while holding one only blocks others for ttl."""
+
+    def __init__(self, owner: Optional[str] = None):
+        self.owner = owner or replica_id()
+
+    @abstractmethod
+    async def get(self, namespace: str, key: str) -> Optional[Tuple[bytes, float]]:
+        """Return (value, written at as epoch seconds), or None"""
+
+    @abstractmethod
+    async def put(self, namespace: str, key: str, value: bytes):
+        ...
+
+    @abstractmethod
+    async def touch(self, namespace: str, key: str) -> bool:
+        """Mark a value as written now, as when it is found to be still current. False if there is no such value."""
+
+    @abstractmethod
+    async def claim(self, key: str, ttl: float) -> bool:
+        """Take key for ttl seconds. False if it is already claimed, by anyone, and the claim hasn't expired."""
+
+    @abstractmethod
+    async def release(self, key: str):
+        """Give up a claim this replica holds before it expires"""
+
+    async def close(self):
+        pass
+
+
+class SQLiteSharedState(SharedState):
+    """SharedState in a SQLite file, for replicas on one host (or sharing a volume), tests and local use.
+
+    Expired claims are deleted every prune_interval seconds."""
+
+    def __init__(self, path: str, owner: Optional[str] = None, prune_interval: float = 600):
+        super().__init__(owner)
+        self.__store = SQLiteStore(path)
+        self.__prune_interval = prune_interval
+        self.__pruned_at = time.time()
+
+    async def get(self, namespace: str, key: str) -> Optional[Tuple[bytes, float]]:
+        return await asyncio.to_thread(self.__store.get, namespace, key)
+
+    async def put(self, namespace: str, key: str, value: bytes):
+        await asyncio.to_thread(self.__store.put, namespace, key, value)
+
+    async def touch(self, namespace: str, key: str) -> bool:
+        return await asyncio.to_thread(self.__store.touch, namespace, key)
+
+    async def claim(self, key: str, ttl: float) -> bool:
+        now = time.time()
+        if now - self.__pruned_at > self.__prune_interval:
+            self.__pruned_at = now
+            await asyncio.to_thread(self.__store.prune, "claims", now)
+        return await asyncio.to_thread(self.__store.claim, "claims", key, self.owner.encode(), now + ttl)
+
+    async def release(self, key: str):
+        await asyncio.to_thread(self.__store.release, "claims", key, self.owner.encode())
+
+    async def close(self):
+        await asyncio.to_thread(self.__store.close)
@@ -0,0 +1,85 @@
+from typing import Iterator, Optional, Tuple
+import os
+import sqlite3
+import threading
+import time
+
+
+class SQLiteStore:
+    """Small key-value store in a single SQLite file, grouped into namespaces.
+
+    Every call does blocking disk I/O, so async code should run them in a thread (asyncio.to_thread). Several processes
+    can share the file; they wait up to busy_timeout seconds for each other's writes."""
+
+    def __init__(self, path: str, busy_timeout: float = 5):
+        self.path = path
+        self.__busy_timeout = busy_timeout
+        self.__lock = threading.Lock()
+        self.__connection: Optional[sqlite3.Connection] = None
+
+    def __connect(self) -> sqlite3.Connection:
+        if self.__connection is None:
+            os.makedirs(os.path.dirname(os.path.abspath(self.path)), exist_ok=True)
+            connection = sqlite3.connect(self.path, check_same_thread=False, isolation_level=None)
+            connection.execute(f"PRAGMA busy_timeout={int(self.__busy_timeout * 1000)}")
+            connection.execute("PRAGMA journal_mode=WAL")
+            connection.execute("CREATE TABLE IF NOT EXISTS kv (namespace TEXT NOT NULL, key TEXT NOT NULL, "
+                               "value BLOB, updated_at REAL NOT NULL, PRIMARY KEY (namespace, key))")
+            self.__connection = connection
+        return self.__connection
+
+    def get(self, namespace: str, key: str) -> Optional[Tuple[bytes, float]]:
+        """Return (value, updated_at) or None"""
+        with self.__lock:
+            return self.__connect().execute("SELECT value, updated_at FROM kv WHERE namespace = ? AND key = ?",
+                                            (namespace, key)).fetchone()
+
+    def put(self, namespace: str, key: str, value: bytes, updated_at: Optional[float] = None):
+        with self.__lock:
+            self.__connect().execute(
+                "INSERT OR REPLACE INTO kv (namespace, key, value, updated_at) VALUES (?, ?, ?, ?)",
+                (namespace, key, value, time.time() if updated_at is None else updated_at))
+
+    def touch(self, namespace: str, key: str) -> bool:
+        """Mark key as updated now, keeping its value. False if there is no such key."""
+        with self.__lock:
+            cursor = self.__connect().execute("UPDATE kv SET updated_at = ? WHERE namespace = ? AND key = ?",
+                                              (time.time(), namespace, key))
+            return cursor.rowcount == 1
+
+    def delete(self, namespace: str, key: str):
+        with self.__lock:
+            self.__connect().execute("DELETE FROM kv WHERE namespace = ? AND key = ?", (namespace, key))
+
+    def claim(self, namespace: str, key: str, owner: bytes, expires_at: float) -> bool:
+        """Atomically take key for owner until expires_at, unless there is an unexpired claim on it already (the
+        owner's own included). Claims are stored like values, with the expiry time as updated_at."""
+        with self.__lock:
+            cursor = self.__connect().execute(
+                "INSERT INTO kv (namespace, key, value, updated_at) VALUES (?, ?, ?, ?) "
+                "ON CONFLICT (namespace, key) DO UPDATE SET value = excluded.value, updated_at = excluded.updated_at "
+                "WHERE kv.updated_at < ?",
+                (namespace, key, owner, expires_at, time.time()))
+            return cursor.rowcount == 1
+
+    def release(self, namespace: str, key: str, owner: bytes):
+        with self.__lock:
+            self.__connect().execute("DELETE FROM kv WHERE namespace = ? AND key = ? AND value = ?",
+                                     (namespace, key, owner))
+
+    def prune(self, namespace: str, before: float):
+        """Delete everything in namespace last updated (or, for claims, expiring) before the given time"""
+        with self.__lock:
+            self.__connect().execute("DELETE FROM kv WHERE namespace = ? AND updated_at < ?", (namespace, before))
+
+    def items(self, namespace: str) -> Iterator[Tuple[str, bytes, float]]:
+        with self.__lock:
+            rows = self.__connect().execute("SELECT key, value, updated_at FROM kv WHERE namespace = ? ORDER BY key",
+                                            (namespace,)).fetchall()
+        return iter(rows)
+
+    def close(self):
+        with self.__lock:
+            if self.__connection is not None:
+                self.__connection.close()
+                self.__connection = None
@@ -0,0 +1,87 @@
+from typing import Any, Dict, Iterable, List, Optional, Tuple
+
+
+class Delta:
+    """What changed between two loads of a list of records (units or people), matched by id"""
+    __slots__ = ("added", "updated", "removed")
+
+    def __init__(self, added: List = None, updated: List = None, removed: List = None):
+        self.added = added or []
+        # New versions of records whose other fields changed
+        self.updated = updated or []
+        # The records as they were before being removed
+        self.removed = removed or []
+
+    def __len__(self):
+        return len(self.added) + len(self.updated) + len(self.removed)
+
+    def __repr__(self):
+        return f"{len(self.added)} added, {len(self.updated)} updated, {len(self.removed)} removed"
+
+
+def diff(old: Iterable, new: Iterable) -> Delta:
+    """Compare records by id, and by their JSON form for updates"""
+    before = {record.id: record for record in old}
+    delta = Delta()
+    for record in new:
+        previous = before.pop(record.id, None)
+        if previous is None:
+            delta.added.append(record)
+        elif previous.to_json() != record.to_json():
+            delta.updated.append(record)
+    delta.removed.extend(before.values())
+    return delta
+
+
+class ConditionalPages:
+    """Validators (ETag, Last-Modified) of the pages of one list endpoint, for requesting them conditionally.
+
+    Only pages whose response had validators are kept, along with their body, which stands in for the response when
+    the page comes back 304 Not Modified. What a run (begin() to finish()) saw is only kept once it finishes: if it
+    fails part way, the pages it did get are requested as before next time, so they aren't taken to be unchanged
+    while the caller still has the old list. modified tells whether any page changed since begin()."""
+
+    def __init__(self):
+        self.__pages: Dict[int, Tuple[Optional[str], Optional[str], Any]] = {}
+        # Pages seen by the current run, None for those without validators
+        self.__seen: Dict[int, Optional[Tuple[Optional[str], Optional[str], Any]]] = {}
+        self.modified = True
+
+    def begin(self):
+        self.__seen = {}
+        self.modified = False
+
+    def headers(self, page: int) -> Dict[str, str]:
+        etag, last_modified, _ = self.__pages.get(page, (None, None, None))
+        headers = {}
+        if etag:
+            headers["If-None-Match"] = etag
+        if last_modified:
+            headers["If-Modified-Since"] = last_modified
+        return headers
+
+    def update(self, page: int, status: int, headers, body):
+        """The body of page given its response: body, or for a 304 the saved one. None if there is nothing saved."""
+        if status == 304:
+            saved = self.__pages.get(page)
+            if saved is None:
+                self.modified = True
+                return None
+            return saved[2]
+
+        self.modified = True
+        etag, last_modified = headers.get("ETag"), headers.get("Last-Modified")
+        self.__seen[page] = (etag, last_modified, body) if etag or last_modified else None
+        return body
+
+    def finish(self, last_page: int):
+        """Keep what this run saw, and forget pages past the last one, which means the list got shorter"""
+        for page, seen in self.__seen.items():
+            if seen is None:
+                self.__pages.pop(page, None)
+            else:
+                self.__pages[page] = seen
+        self.__seen = {}
+        for page in [page for page in self.__pages if page > last_page]:
+            del self.__pages[page]
+            self.modified = True
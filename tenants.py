@@ -0,0 +1,83 @@
+from typing import TYPE_CHECKING, Dict, Iterator, List, Optional
+import asyncio
+
+from slack_bolt.authorization import AuthorizeResult
+from slack_sdk.web.async_client import AsyncWebClient
+
+if TYPE_CHECKING:
+    from breezeway import AsyncApp
+    from home import HomeTab
+    from workqueue import DurableQueue
+
+
+class Tenant:
+    """A Slack workspace and the Breezeway company it files tasks in, with everything kept separately for it: its
+    Slack client, Breezeway client (connection pool, token, inventory cache), Home tab and submission queue.
+
+    config is the bot's config with the tenant's own slack and breezeway settings merged in."""
+
+    def __init__(self, name: str, team_id: Optional[str], config: dict, client: AsyncWebClient,
+                 breezeway: "AsyncApp", home_tab: "HomeTab"):
+        self.name = name
+        self.team_id = team_id
+        self.config = config
+        self.client = client
+        self.breezeway = breezeway
+        self.home_tab = home_tab
+        self.submissions: Optional["DurableQueue"] = None
+        self.authorization: Optional[asyncio.Task] = None
+
+
+class Tenants:
+    """The tenants the bot serves, by Slack team id.
+
+    A tenant configured without a team id serves any workspace no other tenant claims, so a bot with a single tenant
+    works wherever it is installed."""
+
+    def __init__(self):
+        self.__tenants: List[Tenant] = []
+        self.__by_team: Dict[str, Tenant] = {}
+        self.__fallback: Optional[Tenant] = None
+
+    def add(self, tenant: Tenant):
+        if tenant.team_id is None:
+            if self.__fallback is not None:
+                raise ValueError(f"Tenants {self.__fallback.name} and {tenant.name} both lack a team-id")
+            self.__fallback = tenant
+        elif tenant.team_id in self.__by_team:
+            raise ValueError(f"Tenants {self.__by_team[tenant.team_id].name} and {tenant.name} have the same team-id")
+        else:
+            self.__by_team[tenant.team_id] = tenant
+        self.__tenants.append(tenant)
+
+    def __iter__(self) -> Iterator[Tenant]:
+        return iter(self.__tenants)
+
+    def __len__(self):
+        return len(self.__tenants)
+
+    def resolve(self, team_id: Optional[str]) -> Optional[Tenant]:
+        return self.__by_team.get(team_id, self.__fallback)
+
+    async def authorize(self, context, team_id: Optional[str], client: AsyncWebClient) -> Optional[AuthorizeResult]:
+        """Bolt authorize function: answers with the bot token of the team's tenant, and puts the tenant in the
+        request context as context["tenant"]. The auth.test behind the result is made once per tenant."""
+        tenant = self.resolve(team_id)
+        if tenant is None:
+            return None
+        if tenant.authorization is None:
+            tenant.authorization = asyncio.create_task(self.__auth_test(tenant, client))
+        try:
+            result = await asyncio.shield(tenant.authorization)
+        except Exception:
+            # Try again with the next request
+            tenant.authorization = None
+            raise
+        context["tenant"] = tenant
+        return result
+
+    @staticmethod
+    async def __auth_test(tenant: Tenant, client: AsyncWebClient) -> AuthorizeResult:
+        token = tenant.config["slack"]["bot-token"]
+        return AuthorizeResult.from_auth_test_response(bot_token=token,
+                                                       auth_test_response=await client.auth_test(token=token))
@@ -0,0 +1,122 @@
+import asyncio
+import time
+
+import aiohttp
+import pytest
+
+from bench.fake_breezeway import FakeBreezeway, make_token
+from breezeway import UNAVAILABLE, AsyncApp, TokenManager
+from search import UnitIndex
+
+
+def test_token_manager_keeps_trying_to_log_in_after_a_failure():
+    async def run():
+        attempts = []
+
+        async def login():
+            attempts.append(None)
+            if len(attempts) == 1:
+                raise aiohttp.ClientConnectionError("Breezeway is down")
+            return {"access_token": make_token(3600)}
+
+        async def refresh(_):
+            return None
+
+        tokens = TokenManager(login, refresh, retry_after=0.01)
+        tokens.start()
+        try:
+            with pytest.raises(aiohttp.ClientConnectionError):
+                await tokens.renew(login=True)
+            for _ in range(100):
+                if tokens.valid():
+                    break
+                await asyncio.sleep(0.01)
+        finally:
+            await tokens.stop()
+        assert tokens.valid()
+        assert len(attempts) == 2
+
+    asyncio.run(run())
+
+
+def test_tokens_shorter_lived_than_the_refresh_margin_are_renewed_halfway_through():
+    async def run():
+        logins = []
+
+        async def login():
+            logins.append(time.monotonic())
+            return {"access_token": make_token(2)}
+
+        async def refresh(_):
+            return None
+
+        tokens = TokenManager(login, refresh, refresh_margin=300)
+        tokens.start()
+        try:
+            await tokens.renew(login=True)
+            await asyncio.sleep(2.5)
+        finally:
+            await tokens.stop()
+        assert tokens.valid()
+        assert 2 <= len(logins) <= 4
+        assert min(b - a for a, b in zip(logins, logins[1:])) > 0.5
+
+    asyncio.run(run())
+
+
+def test_serves_the_snapshot_and_holds_tasks_back_when_breezeway_is_down_at_startup(tmp_path):
+    snapshot = str(tmp_path / "inventory.db")
+
+    async def run():
+        fake = FakeBreezeway(units=20, people=3, latency=0, jitter=0)
+        url = await fake.start()
+        try:
+            async with AsyncApp("id", "secret", url=url, company_id=1, snapshot_path=snapshot) as breezeway:
+                await breezeway.authenticate()
+                await breezeway.warm()
+        finally:
+            await fake.stop()
+
+        breezeway = AsyncApp("id", "secret", url="http://127.0.0.1:1", company_id=1, snapshot_path=snapshot,
+                             breaker_threshold=2)
+        await breezeway.start()
+        try:
+            with pytest.raises(UNAVAILABLE):
+                await breezeway.authenticate()
+            await breezeway.warm()
+            assert len(await breezeway.get_units_sorted()) == 20
+            with pytest.raises(UNAVAILABLE):
+                await breezeway.create_project(unit_id=100000, department="maintenance")
+            assert breezeway.breaker.state == breezeway.breaker.OPEN
+        finally:
+            await breezeway.close()
+
+    asyncio.run(run())
+
+
+def test_a_failed_index_build_is_retried_by_the_next_search(monkeypatch):
+    builds = []
+
+    def failing_once(units=()):
+        if units:
+            builds.append(None)
+            if len(builds) == 1:
+                raise MemoryError()
+        return UnitIndex(units)
+
+    async def run():
+        fake = FakeBreezeway(units=20, people=3, latency=0, jitter=0)
+        url = await fake.start()
+        try:
+            async with AsyncApp("id", "secret", url=url, company_id=1) as breezeway:
+                await breezeway.authenticate()
+                with pytest.raises(MemoryError):
+                    await breezeway.search_units(fake.units[0]["name"])
+                assert [unit.id for unit in await breezeway.search_units(fake.units[0]["name"])][:1] == \
+                       [fake.units[0]["id"]]
+        finally:
+            await fake.stop()
+
+    monkeypatch.setattr("breezeway.UnitIndex", failing_once)
+    asyncio.run(run())
+    assert len(builds) == 2
@@ -0,0 +1,63 @@
+from concurrent.futures.process import BrokenProcessPool
+import asyncio
+import os
+import re
+import time
+
+import pytest
+
+from executor import Executor
+from matching import names_matching
+
+NAMES = ["Sea Breeze 1", "Pine Cove 2", "Ocean Villa 3", "a" * 40 + "b"]
+
+
+def test_run_isolated_returns_the_result_or_raises_the_error():
+    async def run():
+        executor = Executor(threads=2)
+        try:
+            assert await executor.run_isolated(names_matching, NAMES, "sea|cove", timeout=10) == [0, 1]
+            with pytest.raises(re.error):
+                await executor.run_isolated(names_matching, NAMES, "(", timeout=10)
+        finally:
+            executor.shutdown()
+
+    asyncio.run(run())
+
+
+def test_run_isolated_kills_a_pattern_that_never_finishes_without_blocking_the_loop():
+    async def run():
+        executor = Executor(threads=2)
+        ticks = 0
+
+        async def tick():
+            nonlocal ticks
+            while True:
+                await asyncio.sleep(0.01)
+                ticks += 1
+
+        ticker = asyncio.create_task(tick())
+        started = time.monotonic()
+        try:
+            with pytest.raises(asyncio.TimeoutError):
+                await executor.run_isolated(names_matching, NAMES, "(a|aa)+$", timeout=1)
+        finally:
+            ticker.cancel()
+            executor.shutdown()
+        assert time.monotonic() - started < 5
+        assert ticks > 20
+
+    asyncio.run(run())
+
+
+def test_a_broken_process_pool_is_replaced():
+    async def run():
+        executor = Executor(threads=2, processes=1)
+        try:
+            with pytest.raises(BrokenProcessPool):
+                await executor.run_cpu(os._exit, 1)
+            assert await executor.run_cpu(names_matching, NAMES, "pine") == [1]
+        finally:
+            executor.shutdown()
+
+    asyncio.run(run())
@@ -0,0 +1,122 @@
+from datetime import datetime
+import asyncio
+import time
+
+import pytest
+
+from jobs import Cron, JobScheduler
+from store import SQLiteStore
+
+
+def next_after(expression: str, moment: datetime) -> datetime:
+    return datetime.fromtimestamp(Cron(expression).next_after(moment.timestamp()))
+
+
+def test_cron_finds_the_next_matching_minute():
+    assert next_after("*/15 * * * *", datetime(2026, 10, 16, 10, 7, 30)) == datetime(2026, 10, 16, 10, 15)
+    assert next_after("*/15 * * * *", datetime(2026, 10, 16, 10, 45)) == datetime(2026, 10, 16, 11, 0)
+    # Friday evening to Monday morning
+    assert next_after("0 9 * * 1-5", datetime(2026, 10, 16, 17, 0)) == datetime(2026, 10, 19, 9, 0)
+    assert next_after("@daily", datetime(2026, 12, 31, 23, 59)) == datetime(2027, 1, 1, 0, 0)
+    assert next_after("30 2 1 */3 *", datetime(2026, 10, 16)) == datetime(2027, 1, 1, 2, 30)
+    assert next_after("0 0 29 2 *", datetime(2026, 3, 1)) == datetime(2028, 2, 29)
+    # Both day fields restricted: the 13th or a Friday, whichever comes first
+    assert next_after("0 12 13 * 5", datetime(2026, 10, 10)) == datetime(2026, 10, 13, 12, 0)
+    assert next_after("0 12 13 * 5", datetime(2026, 10, 13, 12, 0)) == datetime(2026, 10, 16, 12, 0)
+    # 7 is Sunday too
+    assert next_after("0 8 * * 7", datetime(2026, 10, 16)) == datetime(2026, 10, 18, 8, 0)
+
+
+@pytest.mark.parametrize("expression", ["* * * *", "60 * * * *", "* 24 * * *", "0 0 0 * *", "*/0 * * * *",
+                                        "5-1 * * * *", "0 0 31 2 *"])
+def test_cron_rejects_invalid_expressions(expression):
+    with pytest.raises(ValueError):
+        Cron(expression).next_after(time.time())
+
+
+def test_catch_up_jobs_run_once_on_start_for_runs_missed_while_down(tmp_path):
+    async def run():
+        store = SQLiteStore(str(tmp_path / "jobs.db"))
+        two_hours_ago = time.time() - 7200
+        for name in ("catching up", "not catching up", "not due"):
+            store.put("jobs", name, b"", two_hours_ago)
+        runs = []
+
+        async def job(name):
+            runs.append(name)
+
+        scheduler = JobScheduler(store=store)
+        scheduler.add("catching up", lambda: job("catching up"), 3600, catch_up=True)
+        scheduler.add("not catching up", lambda: job("not catching up"), 3600)
+        scheduler.add("not due", lambda: job("not due"), 3 * 3600, catch_up=True)
+        await scheduler.start()
+        try:
+            await asyncio.sleep(0.2)
+        finally:
+            await scheduler.stop()
+        assert runs == ["catching up"]
+        # The run is recorded, so a restart now doesn't catch up again
+        assert store.get("jobs", "catching up")[1] > two_hours_ago
+        store.close()
+
+    asyncio.run(run())
+
+
+def test_due_runs_wait_while_requests_are_handled_but_no_longer_than_max_yield():
+    async def run():
+        busy = True
+        started = {}
+
+        async def job(name):
+            started[name] = time.monotonic()
+
+        scheduler = JobScheduler(yield_to=lambda: busy, max_yield=0.3, yield_check=0.01)
+        scheduler.add("yielding", lambda: job("yielding"), 3600)
+        scheduler.add("waiting for quiet", lambda: job("waiting for quiet"), 3600)
+        await scheduler.start()
+        try:
+            began = time.monotonic()
+            scheduler.run_now("yielding")
+            await asyncio.sleep(0.5)
+            assert 0.25 < started["yielding"] - began < 0.45
+
+            began = time.monotonic()
+            scheduler.run_now("waiting for quiet")
+            await asyncio.sleep(0.1)
+            assert "waiting for quiet" not in started
+            busy = False
+            await asyncio.sleep(0.05)
+            assert started["waiting for quiet"] - began < 0.2
+        finally:
+            await scheduler.stop()
+
+    asyncio.run(run())
+
+
+def test_a_run_is_skipped_while_the_job_is_still_running_max_concurrency_times():
+    async def run():
+        release = asyncio.Event()
+        runs = 0
+
+        async def job():
+            nonlocal runs
+            runs += 1
+            await release.wait()
+
+        scheduler = JobScheduler()
+        scheduler.add("slow", job, 3600)
+        await scheduler.start()
+        try:
+            scheduler.run_now("slow")
+            scheduler.run_now("slow")
+            await asyncio.sleep(0.05)
+            assert runs == 1
+            release.set()
+            await asyncio.sleep(0.05)
+            scheduler.run_now("slow")
+            await asyncio.sleep(0.05)
+            assert runs == 2
+        finally:
+            await scheduler.stop()
+
+    asyncio.run(run())
@@ -0,0 +1,41 @@
+import random
+
+from fuzzywuzzy import fuzz
+
+from bench.fake_breezeway import make_units
+from matching import UnitMatcher
+from records import Unit
+
+
+def full_scan(units, text):
+    """How the shortcut matched before UnitMatcher: score every unit, the first best in name order wins"""
+    best, best_ratio = None, 0
+    for unit in units:
+        weight = len(unit.name) * 0.007 + 1
+        ratio = fuzz.partial_ratio(unit.name.lower(), text.lower()) * weight
+        if ratio > best_ratio:
+            best, best_ratio = unit, ratio
+    return best, best_ratio
+
+
+def test_pruned_matching_finds_what_scoring_every_unit_does():
+    rng = random.Random(4)
+    units = sorted((Unit.from_json(unit) for unit in make_units(400)), key=lambda unit: unit.name)
+    matcher = UnitMatcher(units)
+    messages = []
+    for unit in rng.sample(units, 150):
+        name = unit.name
+        if rng.random() < 0.5:
+            # A typo, as people type them
+            i = rng.randrange(len(name))
+            name = name[:i] + rng.choice("abcdefghijklmnopqrstuvwxyz") + name[i + 1:]
+        messages.append(rng.choice(["The sink at {} is leaking", "{} needs a deep clean", "Guest at {} locked out",
+                                    "{}"]).format(name.lower() if rng.random() < 0.3 else name))
+    messages += ["Nothing to do with any property", "ok", "thanks!", "x" * 60]
+
+    for text in messages:
+        expected, expected_ratio = full_scan(units, text)
+        found = matcher.match(text)
+        assert found is not None or expected is None, text
+        if found is not None:
+            assert (found[0].id, found[1]) == (expected.id, expected_ratio), text
@@ -0,0 +1,23 @@
+import asyncio
+
+import metrics
+
+
+def test_in_flight_counts_a_listener_until_it_finishes_not_until_it_acks():
+    async def run():
+        acked, release = asyncio.Event(), asyncio.Event()
+
+        @metrics.timed
+        async def listener():
+            acked.set()
+            await release.wait()
+
+        before = metrics.in_flight()
+        task = asyncio.create_task(listener())
+        await acked.wait()
+        assert metrics.in_flight() == before + 1
+        release.set()
+        await task
+        assert metrics.in_flight() == before
+
+    asyncio.run(run())
@@ -0,0 +1,113 @@
+import asyncio
+
+import pytest
+
+from outbound import BACKGROUND, INTERACTIVE, FairShare, RequestScheduler, request_priority
+
+
+def test_a_waiter_cancelled_as_its_turn_comes_leaves_the_share_to_the_others():
+    async def run():
+        share = FairShare(1)
+        await share.acquire("first")
+        waiting = asyncio.create_task(share.acquire("second"))
+        await asyncio.sleep(0)
+        waiting.cancel()
+        # Released before the cancelled waiter gets to run, so the release skips it
+        share.release("first")
+        with pytest.raises(asyncio.CancelledError):
+            await waiting
+        await asyncio.wait_for(share.acquire("third"), timeout=1)
+        assert share.holding("third") == 1
+
+    asyncio.run(run())
+
+
+def test_a_request_cancelled_while_waiting_for_the_share_gives_its_slot_back():
+    async def run():
+        share = FairShare(1)
+        scheduler = RequestScheduler(rate=1000, concurrency=1, share=share, share_key="tenant")
+
+        async def send():
+            return 200, "ok", {}
+
+        await share.acquire("other")
+        waiting = asyncio.create_task(scheduler.run(send))
+        await asyncio.sleep(0)
+        waiting.cancel()
+        share.release("other")
+        with pytest.raises(asyncio.CancelledError):
+            await waiting
+        assert await asyncio.wait_for(scheduler.run(send), timeout=1) == (200, "ok")
+
+    asyncio.run(run())
+
+
+def test_no_more_requests_than_the_concurrency_limit_are_in_flight():
+    async def run():
+        scheduler = RequestScheduler(rate=0, concurrency=2)
+        in_flight = peak = 0
+
+        async def send():
+            nonlocal in_flight, peak
+            in_flight += 1
+            peak = max(peak, in_flight)
+            await asyncio.sleep(0.02)
+            in_flight -= 1
+            return 200, None, {}
+
+        await asyncio.gather(*(scheduler.run(send) for _ in range(8)))
+        assert peak == 2
+        assert scheduler.stats["sent"] == 8
+
+    asyncio.run(run())
+
+
+def test_interactive_requests_get_a_free_slot_before_background_ones():
+    async def run():
+        scheduler = RequestScheduler(rate=0, concurrency=1)
+        release = asyncio.Event()
+        order = []
+
+        def request(name):
+            async def send():
+                order.append(name)
+                if name == "first":
+                    await release.wait()
+                return 200, None, {}
+            return send
+
+        async def background(name):
+            request_priority.set(BACKGROUND)
+            return await scheduler.run(request(name))
+
+        first = asyncio.create_task(scheduler.run(request("first")))
+        await asyncio.sleep(0)
+        waiting = [asyncio.create_task(background("sync 1")), asyncio.create_task(background("sync 2")),
+                   asyncio.create_task(scheduler.run(request("user 1"))),
+                   asyncio.create_task(scheduler.run(request("user 2"), priority=INTERACTIVE))]
+        await asyncio.sleep(0.01)
+        release.set()
+        await asyncio.gather(first, *waiting)
+        assert order == ["first", "user 1", "user 2", "sync 1", "sync 2"]
+
+    asyncio.run(run())
+
+
+def test_failed_attempts_are_retried_and_give_up_after_retries():
+    async def run():
+        scheduler = RequestScheduler(rate=0, retries=2, backoff_base=0.001)
+        statuses = [503, 429, 200]
+
+        async def flaky():
+            return statuses.pop(0), "body", {}
+
+        assert await scheduler.run(flaky) == (200, "body")
+        assert scheduler.stats["retried"] == 2
+
+        async def down():
+            return 503, "down", {"Retry-After": "0"}
+
+        assert await scheduler.run(down) == (503, "down")
+        assert scheduler.stats["sent"] == 6
+
+    asyncio.run(run())
@@ -0,0 +1,82 @@
+import asyncio
+import copy
+import importlib
+import os
+
+import yaml
+
+from bench.fake_slack import FakeSlack
+from bench.run import _task_factory, dispatch, load_payload, write_config
+from router import CommandRouter
+
+
+def make_router(calls):
+    router = CommandRouter()
+
+    def handler(name):
+        async def handle(message, say):
+            calls.append(name)
+        return handle
+
+    router.command("^hi")(handler("greet"))
+    router.command("joke")(handler("joke"))
+    router.command("^hi there$")(handler("never"))
+    return router
+
+
+def test_the_first_registered_matching_command_runs():
+    async def run():
+        calls = []
+        router = make_router(calls)
+        assert await router.dispatch({"text": "hi there"}, None)
+        # The leftmost match is joke's, but greet was registered first and matches too
+        assert await router.dispatch({"text": "hi, tell me a joke"}, None)
+        assert await router.dispatch({"text": "another joke please"}, None)
+        assert not await router.dispatch({"text": "say hi"}, None)
+        assert not await router.dispatch({}, None)
+        assert calls == ["greet", "greet", "joke"]
+
+    asyncio.run(run())
+
+
+def test_commands_are_answered_in_dms_only(tmp_path):
+    async def run():
+        # Lets dispatch() wait for the listener Bolt runs after the ack
+        asyncio.get_running_loop().set_task_factory(_task_factory)
+        slack = FakeSlack(latency=0, jitter=0)
+        url = await slack.start()
+        path = write_config(str(tmp_path), "http://127.0.0.1:1", url)
+        with open(path) as f:
+            config = yaml.safe_load(f)
+        config["logging"] = {"file": str(tmp_path / "prvrbot.log")}
+        with open(path, "w") as f:
+            yaml.safe_dump(config, f)
+        os.environ["PRVRBOT_CONFIG"] = path
+        bot = importlib.import_module("main")
+        try:
+            dm, channel = load_payload("message_dm"), load_payload("message_channel")
+
+            def message(template, text, **fields):
+                body = copy.deepcopy(template)
+                body["event"] |= {"text": text, **fields}
+                return body
+
+            async def replies(body):
+                before = slack.calls.get("chat.postMessage", 0)
+                await dispatch(bot.slack, body)
+                return slack.calls.get("chat.postMessage", 0) - before
+
+            # The first request also authorizes the workspace, in a task of its own that dispatch() would wait on
+            await dispatch(bot.slack, message(channel, "hello everyone"))
+            assert await replies(message(dm, "hi")) == 1
+            assert await replies(message(dm, "joke")) == 1
+            assert await replies(message(dm, "nothing for the bot")) == 0
+            assert await replies(message(channel, "hi")) == 0
+            assert await replies(message(dm, "hi", subtype="message_changed")) == 0
+            assert await replies(message(dm, "hi", subtype="thread_broadcast")) == 1
+        finally:
+            await bot.shutdown()
+            bot.log_listener.stop()
+            await slack.stop()
+
+    asyncio.run(run())
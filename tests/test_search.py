@@ -0,0 +1,20 @@
+from records import Unit
+from search import UnitIndex
+
+NAMES = ["Sea Breeze", "Sea View Cottage", "Harbour View", "Old Mill", "Mill House", "Breeze Point", "Seaside Loft"]
+QUERIES = ["sea", "view", "mill", "breeze", "ll", "o", "side loft", "house"]
+
+
+def test_updated_index_searches_like_a_rebuilt_one_and_leaves_the_original_as_it_was():
+    units = [Unit(i, name) for i, name in enumerate(NAMES)]
+    index = UnitIndex(units)
+    before = {query: [unit.id for unit in index.search(query)] for query in QUERIES}
+
+    changed = [Unit(1, "Hillside Cottage"), Unit(10, "Sea Mill")]
+    updated = index.updated(changed, [3, 42])
+    rebuilt = UnitIndex([unit for unit in units if unit.id not in (1, 3)] + changed)
+
+    assert len(updated) == len(rebuilt) == 7
+    for query in QUERIES:
+        assert [unit.id for unit in updated.search(query)] == [unit.id for unit in rebuilt.search(query)]
+        assert [unit.id for unit in index.search(query)] == before[query]
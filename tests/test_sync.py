@@ -0,0 +1,83 @@
+import asyncio
+
+from bench.fake_breezeway import FakeBreezeway
+from breezeway import AsyncApp
+from shared import SQLiteSharedState
+from sync import ConditionalPages
+
+UNITS = "/public/inventory/v1/property/external-id"
+
+
+def test_pages_of_a_failed_run_are_requested_unconditionally_again():
+    pages = ConditionalPages()
+    pages.begin()
+    pages.update(1, 200, {"ETag": '"a"'}, ["old"])
+    pages.finish(1)
+    assert pages.headers(1) == {"If-None-Match": '"a"'}
+
+    pages.begin()
+    pages.update(1, 200, {"ETag": '"b"'}, ["new"])
+    # The run fails before finish()
+    pages.begin()
+    assert pages.headers(1) == {"If-None-Match": '"a"'}
+    assert pages.update(1, 200, {"ETag": '"b"'}, ["new"]) == ["new"]
+    assert pages.modified
+
+
+def test_a_sync_that_fails_part_way_is_caught_up_by_the_next_one():
+    async def run():
+        fake = FakeBreezeway(units=30, people=3, latency=0, jitter=0)
+        url = await fake.start()
+        try:
+            async with AsyncApp("id", "secret", url=url, company_id=1, page_size=10, retries=0) as breezeway:
+                await breezeway.authenticate()
+                await breezeway.warm()
+
+                fake.units[0]["name"] = "Renamed Villa"
+                fake.failing_pages[(UNITS, 2)] = 1
+                await breezeway.sync()
+                assert "Renamed Villa" not in [unit.name for unit in await breezeway.get_units_sorted()]
+
+                await breezeway.sync()
+                assert "Renamed Villa" in [unit.name for unit in await breezeway.get_units_sorted()]
+        finally:
+            await fake.stop()
+
+    asyncio.run(run())
+
+
+def test_replicas_keep_the_shared_snapshot_current_and_apply_what_another_one_loaded(tmp_path):
+    async def run():
+        fake = FakeBreezeway(units=30, people=3, latency=0, jitter=0)
+        url = await fake.start()
+        shared = SQLiteSharedState(str(tmp_path / "shared.db"))
+        changes = []
+        try:
+            async with AsyncApp("id", "secret", url=url, company_id=1, shared=shared, units_ttl=0.5) as first, \
+                    AsyncApp("id", "secret", url=url, company_id=1, shared=shared, units_ttl=0.5) as second:
+                second.on_change(lambda resource, delta: changes.append((resource, delta)))
+                await first.authenticate()
+                await first.warm()
+                await second.warm()
+                _, saved_at = await shared.get("inventory", "units:1")
+
+                # Nothing changed, but the snapshot is marked current so the other replica doesn't load it again
+                await asyncio.sleep(0.6)
+                await first.sync()
+                _, touched_at = await shared.get("inventory", "units:1")
+                assert touched_at > saved_at
+
+                fake.units[0]["name"] = "Renamed Villa"
+                await asyncio.sleep(0.6)
+                await first.sync()
+                units_requests = fake.requests[UNITS]
+                await second.sync()
+                assert fake.requests[UNITS] == units_requests
+                assert [(resource, [unit.name for unit in delta.updated]) for resource, delta in changes] == \
+                       [("units", ["Renamed Villa"])]
+                assert [unit.name for unit in await second.search_units("renamed villa")] == ["Renamed Villa"]
+        finally:
+            await shared.close()
+            await fake.stop()
+
+    asyncio.run(run())
@@ -0,0 +1,58 @@
+import asyncio
+import json
+
+from shared import SQLiteSharedState
+from store import SQLiteStore
+from workqueue import DurableQueue, RetryLater
+
+
+def test_replicas_sharing_a_queue_file_run_each_job_once(tmp_path):
+    async def run():
+        store = SQLiteStore(str(tmp_path / "submissions.db"))
+        store.put("submissions", "V123", json.dumps({"title": "Fix the door"}).encode())
+        runs = []
+
+        async def handler(key, job):
+            runs.append(key)
+            await asyncio.sleep(0.05)
+
+        queues = [DurableQueue("submissions", handler, store=store,
+                               shared=SQLiteSharedState(str(tmp_path / "shared.db"), owner=owner))
+                  for owner in ("replica-1", "replica-2")]
+        await asyncio.gather(*(queue.start() for queue in queues))
+        await asyncio.sleep(0.3)
+        for queue in queues:
+            await queue.stop()
+        assert runs == ["V123"]
+        assert sum(queue.stats["elsewhere"] for queue in queues) == 1
+
+    asyncio.run(run())
+
+
+def test_a_deferred_job_is_not_run_again_once_another_replica_finished_it(tmp_path):
+    async def run():
+        store = SQLiteStore(str(tmp_path / "submissions.db"))
+        store.put("submissions", "V123", json.dumps({"title": "Fix the door"}).encode())
+        runs = []
+
+        async def deferring(key, job):
+            runs.append(("first", key))
+            raise RetryLater(0.2)
+
+        async def handler(key, job):
+            runs.append(("second", key))
+
+        shared = str(tmp_path / "shared.db")
+        first = DurableQueue("submissions", deferring, store=store, shared=SQLiteSharedState(shared, owner="one"))
+        await first.start()
+        await asyncio.sleep(0.05)
+        # Another replica starts while the job is deferred, and creates it
+        second = DurableQueue("submissions", handler, store=store, shared=SQLiteSharedState(shared, owner="two"))
+        await second.start()
+        await asyncio.sleep(0.4)
+        await first.stop()
+        await second.stop()
+        assert runs == [("first", "V123"), ("second", "V123")]
+        assert len(first) == 0
+
+    asyncio.run(run())
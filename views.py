@@ -0,0 +1,295 @@
+"""Block Kit views for the Breezeway task modal and the Home tab.
+
+The parts of the modal that never change are built once when the module is loaded and shared between requests; each
+request only builds the few blocks that carry per-request values (the matched property, the message text, today's date)
+around them. Slack only reads the views it is sent, so the shared parts must not be modified by callers."""
+from collections import OrderedDict
+from datetime import date
+from typing import TYPE_CHECKING, Iterable, List, Optional, Sequence, Tuple
+import json
+
+if TYPE_CHECKING:
+    from records import Person, Unit
+
+
+def plain_text(text: str, emoji: bool = True) -> dict:
+    return {"type": "plain_text", "text": text, "emoji": emoji}
+
+
+def option(text: str, value: str) -> dict:
+    return {"text": plain_text(text), "value": value}
+
+
+CLOSE = plain_text("Cancel")
+SUBMIT = plain_text("Create")
+
+# Shown while the shortcut loads properties and staff, so the trigger_id can't expire while Breezeway is slow
+LOADING_MODAL = {
+    "type": "modal",
+    "callback_id": "breezeway_task_loading",
+    "close": CLOSE,
+    "title": plain_text("New Breezeway task"),
+    "blocks": [
+        {
+            "type": "section",
+            "text": {
+                "type": "mrkdwn",
+                "text": ":hourglass_flowing_sand: Loading properties and staff from Breezeway..."
+            }
+        }
+    ]
+}
+
+UNIT_SELECT = {
+    "action_id": "unit",
+    "type": "external_select",
+    "placeholder": {
+        "type": "plain_text",
+        "text": "Select Property"
+    },
+    "min_query_length": 3
+}
+
+DEPARTMENT_SELECT = {
+    "type": "static_select",
+    "placeholder": plain_text("Select Department"),
+    "initial_option": option("Maintenance", "maintenance"),
+    "options": [
+        option("Cleaning", "housekeeping"),
+        option("Inspection", "inspection"),
+        option("Maintenance", "maintenance")
+    ],
+    "action_id": "department"
+}
+
+OFFLINE_NOTICE = {
+    "type": "context",
+    "elements": [{"type": "mrkdwn", "text": ":warning: Breezeway isn't responding, so properties and staff may be out "
+                                            "of date. Your task will be created once it is back."}]
+}
+
+TITLE_BLOCK = {
+    "type": "input",
+    "label": plain_text("Title"),
+    "element": {
+        "type": "plain_text_input",
+        "action_id": "title"
+    }
+}
+
+DUE_DATE_PLACEHOLDER = plain_text("Select a date")
+
+# Optional extra properties, to create the same task for many properties at once
+BULK_UNITS_BLOCK = {
+    "type": "input",
+    "block_id": "bulk_units",
+    "optional": True,
+    "label": plain_text("Also create for"),
+    "element": {
+        "type": "multi_external_select",
+        "placeholder": plain_text("Select properties"),
+        "min_query_length": 3,
+        "action_id": "units"
+    }
+}
+
+UNIT_PATTERN_BLOCK = {
+    "type": "input",
+    "block_id": "unit_pattern",
+    "optional": True,
+    "label": plain_text("And every property matching"),
+    "hint": plain_text("A regular expression, matched against property names ignoring case"),
+    "element": {
+        "type": "plain_text_input",
+        "action_id": "unit_pattern"
+    }
+}
+
+# Position of the assignees block in the task modal
+ASSIGNEES = 4
+
+
+class _AssigneesBlocks:
+    """The assignees input for each people list, built only the first time that list is passed in.
+
+    The people cache hands out the same list until it reloads, so this is one option per person built once per
+    reload rather than on every shortcut and department change. Every tenant has its own list, so the blocks of the
+    size most recently used lists are kept."""
+
+    def __init__(self, size: int = 16):
+        self.__size = size
+        # By id() of the list, which is kept alongside so the id can't be reused while the entry exists
+        self.__blocks: "OrderedDict[int, Tuple[Sequence[Person], dict]]" = OrderedDict()
+
+    def get(self, people: Sequence["Person"]) -> dict:
+        entry = self.__blocks.get(id(people))
+        if entry is not None and entry[0] is people:
+            self.__blocks.move_to_end(id(people))
+            return entry[1]
+        block = {
+            "type": "input",
+            "label": plain_text("Assignees"),
+            "element": {
+                "type": "multi_static_select",
+                "placeholder": plain_text("Select options"),
+                "options": [option(person.label, f"{person.id}") for person in people],
+                "action_id": "assignees"
+            }
+        }
+        self.__blocks[id(people)] = (people, block)
+        if len(self.__blocks) > self.__size:
+            self.__blocks.popitem(last=False)
+        return block
+
+
+assignees_block = _AssigneesBlocks().get
+
+
+def error_modal(text: str) -> dict:
+    """Takes the place of LOADING_MODAL when the task form couldn't be built"""
+    return {**LOADING_MODAL, "callback_id": "breezeway_task_error",
+            "blocks": [{"type": "section", "text": {"type": "mrkdwn", "text": text}}]}
+
+
+def unit_options(units: Iterable["Unit"]) -> List[dict]:
+    return [option(unit.name, str(unit.id)) for unit in units]
+
+
+def _task_modal(title: str, blocks: list, private_metadata: str) -> dict:
+    return {
+        "type": "modal",
+        "callback_id": "breezeway_task",
+        "submit": SUBMIT,
+        "close": CLOSE,
+        "title": plain_text(title),
+        "blocks": blocks,
+        "private_metadata": private_metadata
+    }
+
+
+def task_modal(people: Sequence["Person"], description: str, metadata: dict, unit: Optional["Unit"] = None,
+               offline: bool = False) -> dict:
+    """The task form, with unit preselected if the message matched one. offline adds a notice that Breezeway is
+    unavailable."""
+    unit_select = UNIT_SELECT
+    if unit is not None:
+        unit_select = {**UNIT_SELECT, "initial_option": option(unit.name, str(unit.id))}
+
+    blocks = [
+        {"type": "actions", "elements": [unit_select, DEPARTMENT_SELECT]},
+        TITLE_BLOCK,
+        {
+            "type": "input",
+            "label": plain_text("Description"),
+            "element": {
+                "type": "plain_text_input",
+                "multiline": True,
+                "action_id": "description",
+                "initial_value": description
+            }
+        },
+        {
+            "type": "input",
+            "block_id": "due_date",
+            "label": plain_text("Due on"),
+            "element": {
+                "type": "datepicker",
+                "placeholder": DUE_DATE_PLACEHOLDER,
+                "initial_date": f"{date.today()}",
+                "action_id": "due_date"
+            }
+        },
+        assignees_block(people),
+        BULK_UNITS_BLOCK,
+        UNIT_PATTERN_BLOCK
+    ]
+    if offline:
+        blocks.append(OFFLINE_NOTICE)
+    return _task_modal("New Breezeway task", blocks, json.dumps(metadata))
+
+
+def updated_task_modal(view: dict, people: Sequence["Person"]) -> dict:
+    """The task form as the user has it in view, with the assignee list refreshed"""
+    blocks = list(view["blocks"])
+    blocks[ASSIGNEES] = assignees_block(people)
+    return _task_modal("Create a Breezeway task", blocks, view["private_metadata"])
+
+
+# The Home tab's fixed content. Dynamic sections (see home.HomeTab) go between the greeting and the rest.
+HOME_BLOCKS = [
+    {
+        "type": "header",
+        "text": {
+            "type": "plain_text",
+            "text": ":wave: Howdy! I'm PRVRbot"
+        }
+    },
+    {
+        "type": "header",
+        "text": {
+            "type": "plain_text",
+            "text": "What am I?"
+        }
+    },
+    {
+        "type": "divider"
+    },
+    {
+        "type": "section",
+        "text": {
+            "type": "mrkdwn",
+            "text": "I am a project started by Anthony. I want to learn to aid people in day to day "
+                    "tasks by providing information when prompted. In time, these passive abilities "
+                    "may be able to turn into tasks that I can do without needing to be prompted. "
+        }
+    },
+    {
+        "type": "header",
+        "text": {
+            "type": "plain_text",
+            "text": "What can I do right now?"
+        }
+    },
+    {
+        "type": "divider"
+    },
+    {
+        "type": "section",
+        "text": {
+            "type": "mrkdwn",
+            "text": "Well, not much. I am still in my infancy, but here is a list of what I can "
+                    "currently do...\n  - Automatically welcome new PRVR members in #general\n  - "
+                    "Tell you a dumb joke. Send me a DM saying \"joke\". "
+        }
+    },
+    {
+        "type": "header",
+        "text": {
+            "type": "plain_text",
+            "text": "What do I think I will do in the future?"
+        }
+    },
+    {
+        "type": "divider"
+    },
+    {
+        "type": "section",
+        "text": {
+            "type": "mrkdwn",
+            "text": "- Generate weekly :key: lockout codes and hand them out as needed while "
+                    "keeping a log of who had access to them.\n- Send alerts from :ear: "
+                    "NoiseAware\n- Generate projects in :breezeway:Breezeway for things like low "
+                    "batteries on doorknobs.\n- Notify the team about changes in the weather. "
+                    ":rain_cloud: Eg. Reminder to check pool cover pumps if it's going to rain.\n- "
+                    "Sky is the limit. "
+        }
+    }
+]
+
+
+def home_view(sections: Iterable[List[dict]] = ()) -> dict:
+    blocks = HOME_BLOCKS[:1]
+    for section in sections:
+        blocks.extend(section)
+    blocks.extend(HOME_BLOCKS[1:])
+    return {"type": "home", "callback_id": "home_view", "blocks": blocks}
@@ -0,0 +1,155 @@
+from typing import Awaitable, Callable, Dict, Optional, Set
+import asyncio
+import json
+import logging
+import time
+
+from shared import SharedState
+from store import SQLiteStore
+
+
+class RetryLater(Exception):
+    """Raised by a handler to have its job run again after delay seconds rather than be finished. Progress saved with
+    update() is kept."""
+
+    def __init__(self, delay: float, reason: str = ""):
+        super().__init__(reason)
+        self.delay = delay
+
+
+class DurableQueue:
+    """In-process work queue whose jobs survive a restart.
+
+    Every job has an idempotency key; submitting a key that is queued or was completed within keep_done seconds is a
+    no-op, so retried submissions don't run twice. Pending jobs are written to the store and queued again on start().
+    handler(key, job) is run by a pool of workers and can save progress with update(key, job), so a restart part way
+    through resumes from the last update instead of from the beginning. A handler that can't make progress for now
+    raises RetryLater.
+
+    Replicas sharing the store file all queue its pending jobs on start(). With shared state, a worker claims each job
+    (for claim_ttl seconds) before running it, so only one replica does. A job another replica holds is tried again
+    once that claim could have expired, and dropped if it is gone from the store by then."""
+
+    def __init__(self, name: str, handler: Callable[[str, dict], Awaitable[None]], store: Optional[SQLiteStore] = None,
+                 workers: int = 4, keep_done: float = 86400, shared: Optional[SharedState] = None,
+                 claim_ttl: float = 3600):
+        self.__name = name
+        self.__handler = handler
+        self.__store = store
+        self.__shared = shared
+        self.__claim_ttl = claim_ttl
+        self.__workers = workers
+        self.__keep_done = keep_done
+        self.__queue: "asyncio.Queue[str]" = asyncio.Queue()
+        self.__pending: Dict[str, dict] = {}
+        self.__done: Dict[str, float] = {}
+        self.__tasks: Set[asyncio.Task] = set()
+        self.stats = {"submitted": 0, "duplicates": 0, "completed": 0, "failed": 0, "deferred": 0, "elsewhere": 0}
+
+    async def start(self):
+        if self.__store is not None:
+            now = time.time()
+            for key, _, done_at in await asyncio.to_thread(self.__store.items, f"{self.__name}-done"):
+                if now - done_at < self.__keep_done:
+                    self.__done[key] = done_at
+                else:
+                    await asyncio.to_thread(self.__store.delete, f"{self.__name}-done", key)
+            for key, value, _ in await asyncio.to_thread(self.__store.items, self.__name):
+                if key not in self.__pending:
+                    self.__pending[key] = json.loads(value)
+                    self.__queue.put_nowait(key)
+            if self.__pending:
+                logging.info(f"Resuming {len(self.__pending)} queued {self.__name}")
+
+        for _ in range(self.__workers - len(self.__tasks)):
+            task = asyncio.create_task(self.__work())
+            self.__tasks.add(task)
+            task.add_done_callback(self.__tasks.discard)
+
+    async def stop(self):
+        for task in list(self.__tasks):
+            task.cancel()
+        await asyncio.gather(*self.__tasks, return_exceptions=True)
+
+    def __len__(self):
+        return len(self.__pending)
+
+    async def submit(self, key: str, job: dict) -> bool:
+        """Queue job under key. Returns False if the key is already queued or done."""
+        self.__prune()
+        if key in self.__pending or key in self.__done:
+            self.stats["duplicates"] += 1
+            logging.info(f"Ignoring duplicate {self.__name} {key}")
+            return False
+        self.__pending[key] = job
+        self.stats["submitted"] += 1
+        await self.__save(key, job)
+        self.__queue.put_nowait(key)
+        return True
+
+    async def update(self, key: str, job: dict):
+        self.__pending[key] = job
+        await self.__save(key, job)
+
+    async def __save(self, key: str, job: dict):
+        if self.__store is not None:
+            await asyncio.to_thread(self.__store.put, self.__name, key, json.dumps(job).encode())
+
+    async def __finish(self, key: str):
+        self.__pending.pop(key, None)
+        self.__done[key] = time.time()
+        if self.__store is not None:
+            await asyncio.to_thread(self.__store.delete, self.__name, key)
+            await asyncio.to_thread(self.__store.put, f"{self.__name}-done", key, b"")
+
+    async def __claim(self, key: str) -> bool:
+        """Whether this replica gets to run the job now"""
+        if self.__shared is None:
+            return True
+        claim = f"{self.__name}:{key}"
+        if not await self.__shared.claim(claim, ttl=self.__claim_ttl):
+            self.stats["elsewhere"] += 1
+            logging.info(f"{self.__name} {key} is being handled by another replica, checking again later")
+            asyncio.get_running_loop().call_later(self.__claim_ttl, self.__queue.put_nowait, key)
+            return False
+        if self.__store is not None and await asyncio.to_thread(self.__store.get, self.__name, key) is None:
+            # Another replica finished it since this one queued it
+            await self.__shared.release(claim)
+            self.__pending.pop(key, None)
+            self.__done[key] = time.time()
+            return False
+        return True
+
+    async def __release(self, key: str):
+        if self.__shared is not None:
+            await self.__shared.release(f"{self.__name}:{key}")
+
+    def __prune(self):
+        cutoff = time.time() - self.__keep_done
+        for key in [key for key, done_at in self.__done.items() if done_at < cutoff]:
+            del self.__done[key]
+
+    async def __work(self):
+        while True:
+            key = await self.__queue.get()
+            if key not in self.__pending or not await self.__claim(key):
+                continue
+            try:
+                await self.__handler(key, self.__pending[key])
+                self.stats["completed"] += 1
+            except asyncio.CancelledError:
+                # Let another replica take it over now rather than when the claim expires
+                await self.__release(key)
+                raise
+            except RetryLater as e:
+                self.stats["deferred"] += 1
+                logging.info(f"Retrying {self.__name} {key} in {e.delay:.0f}s: {e}")
+                # Whichever replica claims it next retries it
+                await self.__release(key)
+                asyncio.get_running_loop().call_later(e.delay, self.__queue.put_nowait, key)
+                continue
+            except Exception:
+                self.stats["failed"] += 1
+                logging.exception(f"Failed to process {self.__name} {key}")
+            await self.__finish(key)
+            await self.__release(key)